@@ -1,5 +1,9 @@
 import pytest
 import os
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+import json
+import datetime
 
 import sys
 sys.path.append('../../tinytroupe/')
@@ -149,3 +153,330 @@ def test_begin_checkpoint_end_with_factory(setup):
 
     assert age_1 == age_2, "The age should be the same in both simulations."
     assert nationality_1 == nationality_2, "The nationality should be the same in both simulations."
+
+def test_trace_stores_deltas_between_keyframes(setup):
+    remove_file_if_exists("control_test_deltas.cache.json")
+
+    def aux_simulation_to_repeat():
+        control.reset()
+        control.begin("control_test_deltas.cache.json")
+
+        agent = create_oscar_the_architect()
+        for age in range(30, 60):
+            agent.define("age", age)
+        
+        simulation = control._current_simulations["default"]
+        control.end()
+
+        return agent, simulation
+
+    agent_1, simulation_1 = aux_simulation_to_repeat()
+
+    # only every KEYFRAME_INTERVAL-th state is complete, the others are deltas
+    trace_states = [entry[3] for entry in simulation_1.cached_trace]
+    for i, trace_state in enumerate(trace_states):
+        expected_type = "keyframe" if i % Simulation.KEYFRAME_INTERVAL == 0 else "delta"
+        assert trace_state["type"] == expected_type, f"State {i} should be a {expected_type}."
+
+    # any state can be reconstructed from the nearest keyframe
+    last_state = simulation_1._cached_state_at(len(simulation_1.cached_trace) - 1)
+    assert last_state == simulation_1._current_state, "The reconstructed state should match the actual one."
+
+    # replaying the simulation from the cache file should lead to the same agent
+    agent_2, simulation_2 = aux_simulation_to_repeat()
+    assert len(simulation_2.execution_trace) == len(simulation_1.cached_trace), "The whole simulation should have been replayed from the cache."
+    assert agent_2.get("age") == agent_1.get("age") == 59, "The replayed agent should be in the same final state."
+
+    remove_file_if_exists("control_test_deltas.cache.json")
+
+def test_checkpoints_append_to_cache_file(setup):
+    remove_file_if_exists("control_test_append.cache.json")
+
+    control.reset()
+    control.begin("control_test_append.cache.json")
+    simulation = control._current_simulations["default"]
+
+    agent = create_oscar_the_architect()
+    control.checkpoint()
+    size_before = os.path.getsize("control_test_append.cache.json")
+    with open("control_test_append.cache.json", "rb") as f:
+        saved_prefix = f.read()
+
+    agent.define("age", 40)
+    control.checkpoint()
+
+    # the file must have grown by the new trace node only, leaving the previously saved ones untouched
+    with open("control_test_append.cache.json", "rb") as f:
+        content = f.read()
+    assert content.startswith(saved_prefix), "Previously saved trace nodes should not be rewritten."
+    assert len(content.splitlines()) == 1 + len(simulation.cached_trace), "There should be a header followed by one line per trace node."
+    assert os.path.getsize("control_test_append.cache.json") > size_before, "The new trace node should have been appended."
+
+    control.end()
+
+    # the saved trace can be loaded back
+    loaded = Simulation()
+    loaded._load_cache_file("control_test_append.cache.json")
+    assert aux_materialized_trace(loaded) == json.loads(json.dumps(simulation.cached_trace)), "The loaded trace should be the saved one."
+
+    remove_file_if_exists("control_test_append.cache.json")
+
+def test_failed_checkpoint_is_reported_and_recovered(setup):
+    remove_file_if_exists("control_test_failure.cache.json")
+
+    control.reset()
+    control.begin("control_test_failure.cache.json")
+    simulation = control._current_simulations["default"]
+
+    agent = create_oscar_the_architect()
+    control.checkpoint()
+    agent.define("age", 40)
+
+    def aux_failed_write(f, start):
+        f.write(b"half a node")
+        raise OSError("Disk full.")
+
+    with patch.object(simulation, "_write_cache_file_nodes", side_effect=aux_failed_write), \
+         pytest.raises(OSError):
+        control.checkpoint()
+    
+    assert simulation._saved_trace_offsets == [], "The offsets of a failed write should not be kept."
+    assert simulation.has_unsaved_cache_changes, "Nothing should be considered saved after a failed write."
+
+    # the next checkpoint writes the whole file again
+    control.checkpoint()
+    control.end()
+
+    loaded = Simulation()
+    loaded._load_cache_file("control_test_failure.cache.json")
+    assert aux_materialized_trace(loaded) == json.loads(json.dumps(simulation.cached_trace)), "The file should have been recovered."
+
+    remove_file_if_exists("control_test_failure.cache.json")
+
+def test_cache_file_is_synced_through_a_writable_file(setup):
+    remove_file_if_exists("control_test_sync.cache.json")
+    real_fsync = os.fsync
+
+    def aux_fsync(fd):
+        # like on Windows, which refuses to flush files opened only for reading
+        os.write(fd, b"")
+        real_fsync(fd)
+
+    control.reset()
+    control.begin("control_test_sync.cache.json")
+    agent = create_oscar_the_architect()
+    control.checkpoint()
+    agent.define("age", 40)
+    control.checkpoint() # appended, but not synced yet
+
+    with patch("tinytroupe.control.os.fsync", side_effect=aux_fsync) as fsync:
+        control.end()
+    
+    assert fsync.called, "The cache file should have been synced at the end of the simulation."
+
+    remove_file_if_exists("control_test_sync.cache.json")
+
+def test_legacy_cache_file_is_loaded(setup):
+    remove_file_if_exists("control_test_legacy.cache.json")
+
+    agent = create_oscar_the_architect()
+    empty_state = {"agents": [], "environments": [], "factories": []}
+    legacy_trace = [[None, "('define', (TinyPerson(name='Oscar'), 'age', 30), {})", None, empty_state],
+                    ["legacy hash 1", "('_step', (TinyWorld(name='World'), datetime.timedelta(days=1)), {'parallelize': True})", 
+                     {"type": "JSON", "value": 1}, empty_state],
+                    ["legacy hash 2", "('act', (<object at 0x1>,), {})", None, empty_state]]
+    with open("control_test_legacy.cache.json", "w") as f:
+        json.dump(legacy_trace, f, indent=4)
+
+    simulation = Simulation()
+    simulation._load_cache_file("control_test_legacy.cache.json")
+
+    # hashes are migrated, as if the events had been cached in the current format
+    world = TinyWorld("World")
+    expected_event_hashes = [simulation._function_call_hash("define", agent, "age", 30),
+                             simulation._function_call_hash("_step", world, datetime.timedelta(days=1), parallelize=True)]
+    assert [node[1] for node in simulation.cached_trace] == expected_event_hashes, "Event hashes should have been migrated."
+    assert simulation.cached_trace[0][0] is None
+    assert simulation.cached_trace[1][0] == simulation._node_hash(simulation.cached_trace[0]), "Nodes should be chained as in the current format."
+    assert [list(node[2:]) for node in simulation.cached_trace] == [[None, empty_state], [{"type": "JSON", "value": 1}, empty_state]], \
+        "Outputs and states should be kept, up to the first event that cannot be migrated."
+    migrated_trace = [list(node) for node in simulation.cached_trace]
+
+    # the next checkpoint converts the file to the current format
+    simulation._save_cache_file("control_test_legacy.cache.json")
+    with open("control_test_legacy.cache.json", "r") as f:
+        assert json.loads(f.readline()) == Simulation.CACHE_FILE_HEADER, "The file should have been converted to the current format."
+
+    simulation = Simulation()
+    simulation._load_cache_file("control_test_legacy.cache.json")
+    assert aux_materialized_trace(simulation) == migrated_trace, "The converted file should hold the migrated trace."
+
+    remove_file_if_exists("control_test_legacy.cache.json")
+
+def test_cached_states_are_loaded_lazily(setup):
+    remove_file_if_exists("control_test_lazy.cache.json")
+
+    def aux_simulation_to_repeat(ages):
+        control.reset()
+        control.begin("control_test_lazy.cache.json")
+
+        agent = create_oscar_the_architect()
+        for age in ages:
+            agent.define("age", age)
+        
+        return agent, control._current_simulations["default"]
+
+    agent_1, simulation_1 = aux_simulation_to_repeat(range(30, 60))
+    control.end()
+
+    # on begin, only what is needed to follow the trace is read, not the states themselves
+    control.reset()
+    control.begin("control_test_lazy.cache.json")
+    simulation = control._current_simulations["default"]
+    assert all(isinstance(node[3], control._LazyTraceState) for node in simulation.cached_trace), "States should not be loaded on begin."
+    assert simulation._cached_state_at(len(simulation.cached_trace) - 1) == json.loads(json.dumps(simulation_1._current_state)), \
+        "States should be read from the file when needed."
+    control.end()
+
+    # diverging from the cache keeps the earlier states readable, and the file consistent
+    agent_2, simulation_2 = aux_simulation_to_repeat(list(range(30, 50)) + [99])
+    control.end()
+    assert agent_2.get("age") == 99, "The agent should be in the state of the new execution."
+
+    loaded = Simulation()
+    loaded._load_cache_file("control_test_lazy.cache.json")
+    assert aux_materialized_trace(loaded) == json.loads(json.dumps(aux_materialized_trace(simulation_2))), "The file should hold the new trace."
+
+    remove_file_if_exists("control_test_lazy.cache.json")
+
+def test_fast_forward_replay(setup):
+    remove_file_if_exists("control_test_fast_forward.cache.json")
+
+    def aux_simulation_to_repeat(ages, fast_forward):
+        control.reset()
+        control.begin("control_test_fast_forward.cache.json", fast_forward=fast_forward)
+        simulation = control._current_simulations["default"]
+
+        with patch.object(simulation, "_decode_simulation_state", wraps=simulation._decode_simulation_state) as decode_simulation_state:
+            agent = create_oscar_the_architect()
+            for age in ages:
+                agent.define("age", age)
+            
+            control.end()
+        
+        return agent, decode_simulation_state.call_count
+
+    aux_simulation_to_repeat(range(30, 60), fast_forward=False)
+    
+    # replaying the whole cache restores the state only once, at the end
+    agent, decode_count = aux_simulation_to_repeat(range(30, 60), fast_forward=True)
+    assert decode_count == 1, "The cached state should have been restored only once."
+    assert agent.get("age") == 59, "The agent should be in the final cached state."
+
+    # diverging from the cache restores the latest cached state before running the new transaction
+    agent, decode_count = aux_simulation_to_repeat(list(range(30, 50)) + [99], fast_forward=True)
+    assert decode_count == 1, "The cached state should have been restored only once."
+    assert agent.get("age") == 99, "The agent should be in the state of the new execution."
+
+    remove_file_if_exists("control_test_fast_forward.cache.json")
+
+def test_fast_forward_replay_keeps_objects_up_to_date(setup):
+    remove_file_if_exists("control_test_fast_forward_reads.cache.json")
+
+    def aux_simulation_to_repeat(fast_forward):
+        control.reset()
+        control.begin("control_test_fast_forward_reads.cache.json", fast_forward=fast_forward)
+        simulation = control._current_simulations["default"]
+
+        with patch.object(simulation, "_add_to_cache_trace", wraps=simulation._add_to_cache_trace) as add_to_cache_trace:
+            agent = create_oscar_the_architect()
+            world = TinyWorld("Fast Forward World", [agent], initial_datetime=datetime.datetime(2024, 1, 1, 9, 0))
+
+            # objects are read between the steps, and the arguments of the next steps depend on them
+            observed = []
+            for i in range(5):
+                agent.define("age", agent.get("age") + 1)
+                world.skip(1, timedelta_per_step=datetime.timedelta(hours=1))
+                observed.append((agent.get("age"), world.current_datetime))
+
+            control.end()
+
+        return observed, add_to_cache_trace.call_count
+
+    expected, _ = aux_simulation_to_repeat(fast_forward=False)
+    observed, new_transactions = aux_simulation_to_repeat(fast_forward=True)
+
+    assert observed == expected, "Objects read between replayed transactions should be up-to-date."
+    assert new_transactions == 0, "The whole simulation should have been replayed from the cache."
+    assert all(type(entity) in [TinyPerson, TinyWorld] for entity in list(TinyPerson.all_agents.values()) + list(TinyWorld.all_environments.values())), \
+        "No entity should be left marked as stale."
+
+    remove_file_if_exists("control_test_fast_forward_reads.cache.json")
+
+def test_event_hashes_are_chained(setup):
+    simulation = Simulation()
+    agent = create_oscar_the_architect()
+
+    event_hash_1 = simulation._function_call_hash("define", agent, "age", 25)
+    event_hash_2 = simulation._function_call_hash("define", agent, "age", 26)
+    assert event_hash_1 == simulation._function_call_hash("define", agent, "age", 25), "The same event should always get the same hash."
+    assert event_hash_1 != event_hash_2, "Different events should get different hashes."
+    assert len(simulation._function_call_hash("think", agent, "A very long thought. " * 1000)) == 64, "Event hashes should be compact."
+
+    # a cached event only matches if it is preceded by the same chain of events
+    empty_state = {"type": "keyframe", "state": {"agents": [], "environments": [], "factories": []}}
+    first_node = (None, event_hash_1, None, empty_state)
+    simulation.cached_trace = [first_node, (simulation._node_hash(first_node), event_hash_2, None, empty_state)]
+    assert simulation._is_transaction_event_cached(event_hash_1), "The first event should be cached."
+    simulation._skip_execution_with_cache()
+    assert simulation._is_transaction_event_cached(event_hash_2), "The second event should be cached, after the first one."
+
+    simulation.execution_trace = [(None, event_hash_2, None, empty_state)]
+    assert not simulation._is_transaction_event_cached(event_hash_2), "The second event should not match after a different first event."
+
+def test_concurrent_simulations(setup):
+    control.reset()
+
+    def aux_simulation(id, age):
+        remove_file_if_exists(f"control_test_concurrent_{id}.cache.json")
+        control.begin(f"control_test_concurrent_{id}.cache.json", id=id)
+
+        # each simulation has its own agents, so the same names can be used in all of them
+        agent = create_oscar_the_architect()
+        agent.define("age", age)
+        assert TinyPerson.get_agent_by_name(agent.name) is agent, "The agent should be registered in its own simulation."
+
+        simulation = control.current_simulation()
+        control.end(id=id)
+        return simulation, agent
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(aux_simulation, [f"variant_{i}" for i in range(4)], range(30, 34)))
+
+    for i, (simulation, agent) in enumerate(results):
+        assert simulation.id == f"variant_{i}", "Each thread should have run its own simulation."
+        assert agent.get("age") == 30 + i, "Each simulation should have changed its own agent only."
+        assert os.path.exists(f"control_test_concurrent_variant_{i}.cache.json"), "Each simulation should have its own cache file."
+        remove_file_if_exists(f"control_test_concurrent_variant_{i}.cache.json")
+
+    assert control.current_simulation() is None, "Simulations started in other threads should not be current here."
+
+def test_entities_remain_registered_after_end(setup):
+    control.reset()
+    TinyPerson.clear_agents()
+    TinyWorld.clear_environments()
+
+    remove_file_if_exists("control_test_registries.cache.json")
+    control.begin("control_test_registries.cache.json")
+    agent = create_oscar_the_architect()
+    world = TinyWorld("Registries test world", [agent])
+    control.end()
+
+    assert TinyPerson.get_agent_by_name("Oscar") is agent, "The agent should still be registered after the simulation ends."
+    assert TinyPerson.all_agents == {"Oscar": agent}
+    assert TinyWorld.get_environment_by_name("Registries test world") is world, "The environment should still be registered after the simulation ends."
+
+    remove_file_if_exists("control_test_registries.cache.json")
+
+def aux_materialized_trace(simulation):
+    return [list(node[:3]) + [simulation._cached_trace_state(i)] for i, node in enumerate(simulation.cached_trace)]
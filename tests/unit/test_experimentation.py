@@ -1,4 +1,6 @@
 import pytest
+import os
+import shutil
 
 import sys
 sys.path.append('../../tinytroupe/')
@@ -7,7 +9,8 @@ sys.path.append('..')
 
 from testing_utils import *
 
-from tinytroupe.experimentation import ABRandomizer
+from tinytroupe.experimentation import ABRandomizer, SimulationBatchRunner
+from tinytroupe.examples import create_oscar_the_architect
 
 def test_randomize():
     randomizer = ABRandomizer()
@@ -57,3 +60,53 @@ def test_passtrough_name():
 def test_intervention_1():
     pass # TODO
 
+
+
+def aux_scenario(age, crash_marker=None, always_crash=False):
+    agent = create_oscar_the_architect()
+    agent.define("age", age)
+
+    if always_crash:
+        os._exit(1)
+
+    # simulates a crash of the worker process, but only the first time
+    if (crash_marker is not None) and not os.path.exists(crash_marker):
+        open(crash_marker, "w").close()
+        os._exit(1)
+
+    return {"name": agent.name, "age": agent.get("age")}
+
+def test_batch_runner():
+    runner = SimulationBatchRunner(aux_scenario, [{"age": age} for age in range(30, 34)], 
+                                   cache_folder="./test_batch_runner_cache", max_workers=2)
+    results = dict(runner.run())
+
+    assert sorted(results.keys()) == [0, 1, 2, 3], "All variants should have been run."
+    for i, result in results.items():
+        assert result == {"name": "Oscar", "age": 30 + i}, "Each variant should have its own results."
+        assert os.path.exists(runner.cache_paths(i)[0]), "Each variant should have its own simulation cache."
+    
+    shutil.rmtree("./test_batch_runner_cache", ignore_errors=True)
+
+def test_batch_runner_recovers_from_crashes():
+    remove_file_if_exists("test_batch_runner_crash.marker")
+
+    runner = SimulationBatchRunner(aux_scenario, [{"age": 30}, {"age": 31, "crash_marker": "test_batch_runner_crash.marker"}], 
+                                   cache_folder="./test_batch_runner_cache", max_workers=2)
+    results = dict(runner.run())
+
+    assert results[1] == {"name": "Oscar", "age": 31}, "The crashed variant should have been retried."
+    assert len(runner.failures) == 0, "No variant should have failed in the end."
+
+    remove_file_if_exists("test_batch_runner_crash.marker")
+    shutil.rmtree("./test_batch_runner_cache", ignore_errors=True)
+
+def test_batch_runner_charges_crashes_to_the_crashing_variant():
+    parameterizations = [{"age": 30 + i, "always_crash": i == 1} for i in range(5)]
+    runner = SimulationBatchRunner(aux_scenario, parameterizations, cache_folder="./test_batch_runner_cache", max_workers=1)
+    results = dict(runner.run())
+
+    assert sorted(results.keys()) == [0, 2, 3, 4], "The variants that never crash should have been completed."
+    assert list(runner.failures.keys()) == [1], "Only the crashing variant should have failed."
+
+    shutil.rmtree("./test_batch_runner_cache", ignore_errors=True)
@@ -0,0 +1,470 @@
+import pytest
+import os
+import asyncio
+import pickle
+import sqlite3
+import array
+import threading
+import time
+import httpx
+import openai
+from unittest.mock import MagicMock, patch
+
+import sys
+sys.path.append('../../tinytroupe/')
+sys.path.append('../../')
+sys.path.append('..')
+
+from openai.types.chat import ChatCompletionChunk
+
+from tinytroupe.openai_utils import OpenAIClient, ApiCache, RateLimiter, EmbeddingCache, count_message_tokens
+import tinytroupe.openai_utils as openai_utils
+from testing_utils import *
+
+class MockClient(OpenAIClient):
+    """
+    A custom client that never reaches the network, returning a fixed message instead.
+    """
+
+    def __init__(self, cache_api_calls=False, cache_file_name="test_openai_utils_cache.sqlite"):
+        super().__init__(cache_api_calls, cache_file_name)
+        self.raw_calls = MagicMock()
+
+    def _setup_from_config(self):
+        self.client = MagicMock()
+
+    def _raw_model_call(self, model, chat_api_params):
+        self.raw_calls(model, chat_api_params)
+        return {"role": "assistant", "content": f"Answer to: {chat_api_params['messages'][-1]['content']}"}
+
+    def _raw_model_response_extractor(self, response):
+        return response
+
+def test_send_message_async():
+    client = MockClient()
+
+    async def aux_send_all():
+        return await asyncio.gather(*[client.send_message_async(create_test_system_user_message(f"Question {i}"), waiting_time=0)
+                                      for i in range(5)])
+
+    responses = asyncio.run(aux_send_all())
+
+    assert client.raw_calls.call_count == 5, "Each message should have been sent exactly once."
+    for i, response in enumerate(responses):
+        assert response["content"] == f"Answer to: Question {i}", "Responses should be returned in the order of the requests."
+
+def test_async_clients_are_closed():
+    client = OpenAIClient(cache_api_calls=False)
+
+    async def aux_use_and_close():
+        client._ensure_async_client()
+        async_client = client.async_client
+        await openai_utils.aclose_clients()
+        return async_client
+
+    with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}), patch.dict(openai_utils._api_type_to_client, {"test": client}):
+        async_client = asyncio.run(aux_use_and_close())
+    
+    assert async_client.is_closed(), "The connections should have been closed."
+    assert client.async_client is None, "A new client should be set up if needed again."
+
+    # a client left behind by a loop that is still running is closed in that loop
+    async def aux_setup():
+        client._ensure_async_client()
+        return client.async_client
+
+    async def aux_setup_and_close():
+        async_client = await aux_setup()
+        await client.aclose()
+        return async_client
+
+    other_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=other_loop.run_forever)
+    thread.start()
+    try:
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            other_async_client = asyncio.run_coroutine_threadsafe(aux_setup(), other_loop).result()
+            new_async_client = asyncio.run(aux_setup_and_close())
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), other_loop).result()
+    finally:
+        other_loop.call_soon_threadsafe(other_loop.stop)
+        thread.join()
+        other_loop.close()
+
+    assert other_async_client.is_closed(), "The client of the other loop should have been closed there."
+    assert new_async_client is not other_async_client, "A new client should have been set up for the new loop."
+
+def test_send_message_async_uses_cache():
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+    client = MockClient(cache_api_calls=True)
+
+    messages = create_test_system_user_message("Question")
+    sync_response = client.send_message(messages, waiting_time=0)
+    async_response = asyncio.run(client.send_message_async(messages, waiting_time=0))
+
+    assert client.raw_calls.call_count == 1, "The second call should have been served from the cache."
+    assert sync_response == async_response, "Cached and fresh responses should be the same."
+
+    client.api_cache.close()
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+
+class StreamingMockClient(OpenAIClient):
+    """
+    A custom client that never reaches the network, streaming a fixed answer in pieces when asked to.
+    """
+
+    def __init__(self, cache_api_calls=False, cache_file_name="test_openai_utils_cache.sqlite"):
+        super().__init__(cache_api_calls, cache_file_name)
+        self.raw_calls = MagicMock()
+
+    def _setup_from_config(self):
+        self.client = MagicMock()
+
+    def _raw_model_call(self, model, chat_api_params):
+        self.raw_calls(model, chat_api_params)
+        assert chat_api_params["stream"], "The model should be asked to stream its response."
+
+        pieces = [{"role": "assistant", "content": ""}, {"content": "Answer "}, {"content": "to: "}, 
+                  {"content": chat_api_params['messages'][-1]['content']}]
+        return iter([ChatCompletionChunk(id="chunk", created=0, model=model, object="chat.completion.chunk",
+                                         choices=[{"index": 0, "delta": piece, "finish_reason": None}])
+                     for piece in pieces])
+
+def test_send_message_streaming():
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+    client = StreamingMockClient(cache_api_calls=True)
+    stream_handler = MagicMock()
+
+    messages = create_test_system_user_message("Question")
+    response = client.send_message(messages, waiting_time=0, stream_handler=stream_handler)
+
+    assert response == {"role": "assistant", "content": "Answer to: Question"}, "The whole response should be returned at the end."
+    assert [call[0][0] for call in stream_handler.feed.call_args_list] == ["Answer ", "to: ", "Question"], \
+        "The response should be fed as it arrives."
+
+    # cached responses are fed all at once, and are the same as if not streamed
+    stream_handler.reset_mock()
+    cached_response = client.send_message(messages, waiting_time=0, stream_handler=stream_handler)
+    assert client.raw_calls.call_count == 1, "The second call should have been served from the cache."
+    assert cached_response == response
+    stream_handler.reset.assert_called_once()
+    stream_handler.feed.assert_called_once_with("Answer to: Question")
+    assert client.send_message(messages, waiting_time=0) == response, "Streamed and non-streamed calls should share the cache."
+
+    client.api_cache.close()
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+
+def test_send_message_with_response_format():
+    client = MockClient()
+    response_format = {"type": "json_object"}
+
+    client.send_message(create_test_system_user_message("Question"), waiting_time=0)
+    client.send_message(create_test_system_user_message("Question"), waiting_time=0, response_format=response_format)
+
+    first_params, second_params = client.raw_calls.call_args_list[0][0][1], client.raw_calls.call_args_list[1][0][1]
+    assert "response_format" not in first_params, "The response format should only be sent if given."
+    assert second_params["response_format"] == response_format
+
+class FlakyMockClient(MockClient):
+    """
+    A custom client whose first calls fail with the given errors.
+    """
+
+    def __init__(self, errors:list, **kwargs):
+        super().__init__(**kwargs)
+        self.errors = errors
+
+    def _raw_model_call(self, model, chat_api_params):
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return super()._raw_model_call(model, chat_api_params)
+
+def test_send_message_backs_off_only_when_the_provider_pushes_back():
+    request = httpx.Request("POST", "https://example.com")
+    client = FlakyMockClient([openai.RateLimitError("Too many requests.", response=httpx.Response(429, request=request), body=None),
+                              openai.APIConnectionError(request=request), 
+                              openai.InternalServerError("Overloaded.", response=httpx.Response(503, request=request), body=None),
+                              openai.APITimeoutError(request=request)])
+
+    with patch("time.sleep") as sleep:
+        response = client.send_message(create_test_system_user_message("Question"), waiting_time=1, exponential_backoff_factor=2)
+    
+    assert response["content"] == "Answer to: Question", "The call should eventually succeed."
+    assert [call[0][0] for call in sleep.call_args_list] == [1, 2], "Only rate limits and overloads should be followed by an exponential backoff."
+
+def test_send_message_honours_retry_after():
+    request = httpx.Request("POST", "https://example.com")
+    client = FlakyMockClient([openai.APIStatusError("Try again later.", response=httpx.Response(500, request=request, headers={"retry-after": "5"}), body=None)])
+
+    with patch("time.sleep") as sleep:
+        response = client.send_message(create_test_system_user_message("Question"), waiting_time=1, exponential_backoff_factor=2)
+    
+    assert response["content"] == "Answer to: Question"
+    assert [call[0][0] for call in sleep.call_args_list] == [5], "The wait requested by the provider should be respected."
+
+def test_send_message_caps_immediate_retries():
+    errors = [Exception("Something went wrong.") for _ in range(OpenAIClient.MAX_IMMEDIATE_RETRIES + 2)]
+    client = FlakyMockClient(errors)
+
+    with patch("time.sleep") as sleep:
+        response = client.send_message(create_test_system_user_message("Question"), waiting_time=1, max_attempts=10)
+    
+    assert response is None, "A persistent error should be surfaced instead of retried over and over."
+    assert len(client.errors) == 1, "Only a few immediate retries should be made."
+    sleep.assert_not_called()
+
+def test_send_message_async_backs_off_only_when_the_provider_pushes_back():
+    request = httpx.Request("POST", "https://example.com")
+    client = FlakyMockClient([Exception("Something went wrong."), 
+                              openai.RateLimitError("Too many requests.", response=httpx.Response(429, request=request), body=None),
+                              openai.RateLimitError("Too many requests.", response=httpx.Response(429, request=request), body=None)])
+
+    with patch("asyncio.sleep") as sleep:
+        response = asyncio.run(client.send_message_async(create_test_system_user_message("Question"), waiting_time=1, exponential_backoff_factor=2))
+    
+    assert response["content"] == "Answer to: Question", "The call should eventually succeed."
+    assert [call[0][0] for call in sleep.call_args_list] == [1, 2], "Only rate limits should be followed by an exponential backoff."
+
+def test_count_message_tokens_of_replies():
+    # a tokenizer that, like the real one, only accepts strings
+    def aux_encode(text):
+        if not isinstance(text, str):
+            raise TypeError(f"Not a string: {text}")
+        return text.split(" ")
+
+    encoding = MagicMock()
+    encoding.encode.side_effect = aux_encode
+
+    reply = {"role": "assistant", "content": "Hello there, how are you doing today?", "refusal": None}
+    with patch("tiktoken.encoding_for_model", return_value=encoding), \
+         patch.dict(OpenAIClient._token_counting_schemes, clear=True), \
+         patch("tinytroupe.openai_utils.logger") as logger:
+        tokens = count_message_tokens(reply, model="gpt-4o")
+
+    assert tokens == 3 + 1 + 7, "Only the role and the content should be counted, with the tokenizer."
+    logger.error.assert_not_called()
+
+def test_count_message_tokens_falls_back_quietly():
+    # when the tokenizer is not available, tokens are estimated, and the problem is reported just once
+    message = {"role": "user", "content": "Hello there, how are you doing today?"}
+    with patch("tiktoken.encoding_for_model", side_effect=ConnectionError("Cannot download the tokenizer.")) as encoding_for_model, \
+         patch.dict(OpenAIClient._token_counting_schemes, clear=True), \
+         patch("tinytroupe.openai_utils.logger") as logger:
+        first_tokens = count_message_tokens(message, model="gpt-4o")
+        second_tokens = count_message_tokens(message, model="gpt-4o")
+    
+    assert first_tokens == second_tokens == len(message["content"]) // 4 + 4, "The tokens should be estimated."
+    assert encoding_for_model.call_count == 1, "The tokenizer should be looked for only once."
+    assert logger.warning.call_count == 1, "The fallback should be reported once."
+    logger.error.assert_not_called()
+
+def test_client_is_reused():
+    client = MockClient()
+
+    client.send_message(create_test_system_user_message("Question 1"), waiting_time=0)
+    sdk_client = client.client
+    client.send_message(create_test_system_user_message("Question 2"), waiting_time=0)
+
+    assert client.client is sdk_client, "The underlying SDK client should be created only once."
+
+def test_api_cache_persistence():
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+
+    cache = ApiCache("test_openai_utils_cache.sqlite")
+    cache["key_1"] = {"content": "value 1"}
+    cache["key_2"] = {"content": "value 2"}
+    cache.close()
+
+    # reopening the cache must give back the same entries, which are only read when requested
+    cache = ApiCache("test_openai_utils_cache.sqlite")
+    assert len(cache) == 2, "The cache should have two entries."
+    assert "key_1" in cache, "The first entry should be in the cache."
+    assert cache["key_2"] == {"content": "value 2"}, "The cached value should be preserved."
+    assert cache.get("key_3") is None, "Missing entries should not be found."
+    with pytest.raises(KeyError):
+        cache["key_3"]
+    cache.close()
+
+    remove_file_if_exists("test_openai_utils_cache.sqlite")
+
+def test_api_cache_imports_legacy_pickle():
+    remove_file_if_exists("test_openai_utils_legacy_cache.pickle")
+    remove_file_if_exists("test_openai_utils_legacy_cache.sqlite")
+
+    with open("test_openai_utils_legacy_cache.pickle", "wb") as f:
+        pickle.dump({"legacy_key": {"content": "legacy value"}}, f)
+
+    client = MockClient(cache_api_calls=True, cache_file_name="test_openai_utils_legacy_cache.pickle")
+
+    assert os.path.exists("test_openai_utils_legacy_cache.sqlite"), "The legacy cache should have been imported into a SQLite file."
+    assert client.api_cache["legacy_key"] == {"content": "legacy value"}, "Legacy entries should be available."
+
+    client.api_cache.close()
+    remove_file_if_exists("test_openai_utils_legacy_cache.pickle")
+    remove_file_if_exists("test_openai_utils_legacy_cache.sqlite")
+
+def test_api_cache_imports_legacy_pickle_of_the_old_default(tmp_path, monkeypatch):
+    # caches saved under the old default name must survive the change of the default
+    monkeypatch.chdir(tmp_path)
+    with open("openai_api_cache.pickle", "wb") as f:
+        pickle.dump({"legacy_key": {"content": "legacy value"}}, f)
+
+    client = MockClient(cache_api_calls=True, cache_file_name="openai_api_cache.sqlite")
+    assert client.api_cache["legacy_key"] == {"content": "legacy value"}, "Legacy entries should be available under the new default."
+    client.api_cache.close()
+
+    # the import is done only once
+    with patch.object(ApiCache, "import_pickle") as import_pickle:
+        MockClient(cache_api_calls=True, cache_file_name="openai_api_cache.sqlite").api_cache.close()
+    assert import_pickle.call_count == 0, "The legacy cache should not be imported again."
+
+def test_set_api_cache_closes_the_previous_cache(tmp_path, monkeypatch):
+    # clients are reused (e.g., by worker processes running several experiments), so replaced caches must be closed
+    monkeypatch.chdir(tmp_path)
+    client = MockClient(cache_api_calls=True, cache_file_name="first.sqlite")
+    first_cache = client.api_cache
+
+    with patch.object(ApiCache, "close", wraps=first_cache.close) as close:
+        client.set_api_cache(True, "second.sqlite")
+        assert close.call_count == 1, "The previous cache should have been closed."
+    assert client.api_cache is not first_cache and client.api_cache.file_name == "second.sqlite"
+
+    second_cache = client.api_cache
+    client.set_api_cache(False)
+    assert client.api_cache is None, "Disabling the cache should close it too."
+    with pytest.raises(sqlite3.ProgrammingError):
+        second_cache.get("some key")
+
+def test_cache_keys_are_compact_and_canonical():
+    client = MockClient()
+
+    messages = create_test_system_user_message("A very long question. " * 1000)
+    params_1 = client._compose_chat_api_params(messages, 0.3, 100, 0, 0.0, 0.0, [], 30, 1)
+    params_2 = dict(reversed(list(params_1.items()))) # same parameters, different order
+
+    key_1 = client._cache_key("gpt-4o", params_1)
+    key_2 = client._cache_key("gpt-4o", params_2)
+
+    assert key_1 == key_2, "Keys should not depend on the order of the parameters."
+    assert len(key_1) == 64, "Keys should be sha256 digests, regardless of the prompt size."
+    assert key_1 != client._cache_key("gpt-4o-mini", params_1), "Different models should lead to different keys."
+
+def test_legacy_cache_keys_are_migrated():
+    remove_file_if_exists("test_openai_utils_legacy_cache.pickle")
+    remove_file_if_exists("test_openai_utils_legacy_cache.sqlite")
+
+    client = MockClient()
+    messages = create_test_system_user_message("Question")
+    params = client._compose_chat_api_params(messages, 0.3, 100, 0, 0.0, 0.0, [], 30, 1)
+
+    # this is how keys used to be computed
+    legacy_key = str(("gpt-4o", params))
+    with open("test_openai_utils_legacy_cache.pickle", "wb") as f:
+        pickle.dump({legacy_key: {"content": "legacy value"}}, f)
+
+    client = MockClient(cache_api_calls=True, cache_file_name="test_openai_utils_legacy_cache.pickle")
+
+    assert legacy_key not in client.api_cache, "Legacy keys should have been replaced."
+    assert client.api_cache[client._cache_key("gpt-4o", params)] == {"content": "legacy value"}, "Legacy entries should be found under the new key."
+
+    client.api_cache.close()
+    remove_file_if_exists("test_openai_utils_legacy_cache.pickle")
+    remove_file_if_exists("test_openai_utils_legacy_cache.sqlite")
+
+def test_rate_limiter_bounds_concurrency():
+    limiter = RateLimiter(max_concurrent_requests=2)
+
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def aux_request():
+        nonlocal in_flight, max_in_flight
+        with limiter.limit():
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight -= 1
+    
+    threads = [threading.Thread(target=aux_request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max_in_flight == 2, "No more than two requests should have been in flight at the same time."
+
+def test_rate_limiter_throttles_only_when_needed():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=6000) # i.e., 10 requests and 100 tokens per second
+
+    # the buckets start full, so requests within the quota go through immediately
+    start = time.monotonic()
+    for _ in range(5):
+        with limiter.limit(tokens=10):
+            pass
+    assert time.monotonic() - start < 0.1, "Requests within the quota should not wait."
+
+    # the token bucket is now almost empty (6000 - 50 tokens), so a large request must wait for it to refill
+    start = time.monotonic()
+    with limiter.limit(tokens=6000):
+        pass
+    assert time.monotonic() - start >= 0.4, "A request exceeding the available tokens should wait for the bucket to refill."
+
+def test_rate_limiter_disabled_by_default():
+    limiter = RateLimiter()
+    assert not limiter.is_enabled(), "Without limits, the limiter should be disabled."
+
+    start = time.monotonic()
+    for _ in range(100):
+        with limiter.limit(tokens=100000):
+            pass
+    assert time.monotonic() - start < 0.1, "A disabled limiter should never wait."
+
+def test_embedding_cache_is_disabled_by_default():
+    # like the other caches, embeddings are only cached if asked to, so importing agents leaves no file behind
+    from llama_index.core import Settings
+    from tinytroupe import agent
+
+    assert agent.default["cache_embeddings"] is False
+    assert getattr(Settings.embed_model, "embeddings_cache", None) is None
+    assert not os.path.exists(agent.default["embeddings_cache_file_name"])
+
+def test_embedding_cache():
+    from llama_index.core.embeddings import MockEmbedding
+    remove_file_if_exists("test_openai_utils_embeddings.sqlite")
+
+    cache = EmbeddingCache("test_openai_utils_embeddings.sqlite", model="some-model")
+    assert not os.path.exists("test_openai_utils_embeddings.sqlite"), "The cache file should only be created when first used."
+    assert cache.get_embedding("some text") is None, "Nothing should be cached yet."
+    cache.put_embedding("some text", [0.25, 0.5])
+    assert cache.get_embedding("some text") == [0.25, 0.5], "The cached embedding should be returned."
+    other_cache = EmbeddingCache("test_openai_utils_embeddings.sqlite", model="other-model")
+    assert other_cache.get_embedding("some text") is None, "Embeddings of different models should not be mixed up."
+    other_cache.close()
+
+    # plugged into a llama-index model, texts that were already embedded should not be embedded again
+    embed_model = MockEmbedding(embed_dim=2, embeddings_cache=cache)
+    with patch.object(MockEmbedding, "_get_text_embeddings", side_effect=lambda texts: [[0.5, 0.5]] * len(texts)) as get_text_embeddings:
+        embeddings = embed_model.get_text_embedding_batch(["some text", "other text"])
+        assert embeddings == [[0.25, 0.5], [0.5, 0.5]], "Cached embeddings should be used along with the new ones."
+        assert get_text_embeddings.call_args[0][0] == ["other text"], "Only the new text should be embedded."
+
+        embed_model.get_text_embedding_batch(["some text", "other text"])
+        assert get_text_embeddings.call_count == 1, "Nothing should be embedded the second time."
+
+    # embeddings are kept exactly, and can be listed by text
+    cache.put_embedding("precise text", [0.1, 1/3])
+    assert cache.get_embedding("precise text") == [0.1, 1/3], "Embeddings should not lose precision."
+    assert cache.get_all() == {text: {cache._key(text): embedding} for text, embedding in 
+                               [("some text", [0.25, 0.5]), ("other text", [0.5, 0.5]), ("precise text", [0.1, 1/3])]}, \
+        "All the embeddings of the model should be listed, by text."
+    
+    # embeddings cached by older versions, as float32 bytes without their texts, can still be used
+    cache._ensure_cache().put(cache._key("legacy text"), array.array("f", [0.25, 0.75]).tobytes())
+    assert cache.get_embedding("legacy text") == [0.25, 0.75], "Legacy embeddings should still be read."
+    assert "legacy text" not in cache.get_all(), "Legacy embeddings cannot be listed."
+
+    cache.close()
+    remove_file_if_exists("test_openai_utils_embeddings.sqlite")
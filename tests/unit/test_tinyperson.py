@@ -1,5 +1,9 @@
 import pytest
 import logging
+import json
+import time
+import numpy as np
+from unittest.mock import patch
 logger = logging.getLogger("tinytroupe")
 
 import sys
@@ -55,6 +59,20 @@ def test_define(setup):
         # check that the prompt contains the new value
         assert '25' in agent.current_messages[0]['content'], f"{agent.name} should have the age in the prompt."
 
+def test_prompt_is_rendered_only_when_needed(setup):
+    # test that the system prompt is rendered again only if something it depends on has changed
+    agent = create_oscar_the_architect()
+    original_prompt = agent._init_system_message
+
+    # nothing changed, so the very same rendered prompt should be kept
+    agent.reset_prompt()
+    assert agent._init_system_message is original_prompt, f"{agent.name} should not render the same prompt twice."
+
+    # the configuration changed, so the prompt must be rendered again
+    agent.define('age', 25)
+    assert agent._init_system_message != original_prompt, f"{agent.name} should render the prompt again after a change."
+    assert agent.current_messages[0]['content'] == agent.generate_agent_prompt(), f"{agent.name} should be using an up-to-date prompt."
+
 def test_define_several(setup):
     # Test that defining several values to a group works as expected
     for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
@@ -63,6 +81,21 @@ def test_define_several(setup):
         assert "Machine learning" in agent._configuration["skills"], f"{agent.name} should have Machine learning as a skill."
         assert "GPT-3" in agent._configuration["skills"], f"{agent.name} should have GPT-3 as a skill."
 
+
+def test_define_many(setup):
+    # Test that defining a whole configuration at once works as expected, with a single prompt reset
+    for agent in [create_oscar_the_architect(), create_lisa_the_data_scientist()]:
+        original_skills = list(agent._configuration["skills"])
+
+        with patch.object(agent, "generate_agent_prompt", wraps=agent.generate_agent_prompt) as generate_agent_prompt:
+            agent.define_many({"age": 25, "skills": [{"skill": "Cooking"}, {"skill": "Juggling"}], "hobbies": ["Chess"]})
+
+        assert generate_agent_prompt.call_count == 1, f"{agent.name} should have rendered the prompt only once."
+        assert agent._configuration["age"] == 25, f"{agent.name} should have the age set to 25."
+        assert agent._configuration["skills"] == original_skills + [{"skill": "Cooking"}, {"skill": "Juggling"}], f"{agent.name} should have the new skills added to the existing ones."
+        assert agent._configuration["hobbies"] == ["Chess"], f"{agent.name} should have a new group of hobbies."
+        assert "Juggling" in agent.current_messages[0]['content'], f"{agent.name} should have the new skills in the prompt."
+
 def test_socialize(setup):
     # Test that socializing with another agent works as expected
     an_oscar = create_oscar_the_architect()
@@ -140,3 +173,440 @@ def test_save_spec(setup):
               
     
     
+
+def test_summarizing_episodic_memory(setup):
+    # Test that the retrieved episodes stay under the token budget, with older ones replaced by a summary
+    from tinytroupe.agent import SummarizingEpisodicMemory, EpisodicMemory
+
+    memory = SummarizingEpisodicMemory(fixed_prefix_length=2, lookback_length=100, token_budget=100)
+
+    def aux_slow_summarize(previous_summary, episodes):
+        time.sleep(0.05)
+        return "I talked a lot."
+
+    with patch.object(SummarizingEpisodicMemory, "_count_tokens", return_value=10), \
+         patch.object(SummarizingEpisodicMemory, "_summarize", side_effect=aux_slow_summarize) as summarize:
+        for i in range(30):
+            memory.store({'role': 'user', 'content': f"Message {i}", 'simulation_timestamp': None})
+
+            # however long it takes, a summarization is taken into account right at the next retrieval
+            if memory._pending_summarization is not None:
+                pending_end = memory._pending_summarization[1]
+                assert memory.retrieve_recent()[2]['content'].endswith("I talked a lot."), "The summary should be retrieved."
+                assert memory.summarized_until == pending_end, "The summarized episodes should be left out."
+
+        recent = memory.retrieve_recent()
+
+    assert summarize.call_count >= 1, "Older episodes should have been summarized."
+    assert len(recent) * 10 <= 100, "The retrieved episodes should fit the token budget."
+    assert recent[:2] == memory.memory[:2], "The fixed prefix should always be retrieved."
+    assert recent[2]['content'].endswith("I talked a lot."), "The summary should come right after the fixed prefix."
+    assert recent[-1]['content'] == "Message 29", "The most recent episode should be retrieved."
+    assert memory.count() == 30, "All episodes should still be kept."
+
+    # the summary survives serialization, but the transient state does not
+    loaded = EpisodicMemory.from_json(memory.to_json())
+    assert isinstance(loaded, SummarizingEpisodicMemory), "The memory should be loaded as a summarizing memory."
+    assert loaded.summary == memory.summary and loaded.summarized_until == memory.summarized_until, "The summary should be preserved."
+    assert loaded._pending_summarization is None, "Pending summarizations should not be serialized."
+
+    # agents only use it if so configured
+    from tinytroupe.agent import TinyPerson
+    assert type(TinyPerson("Summarizing Default").episodic_memory) is EpisodicMemory, "Summarizing should be opt-in."
+    with patch.dict("tinytroupe.agent.default", {"summarize_episodic_memory": True}):
+        assert isinstance(TinyPerson("Summarizing Agent").episodic_memory, SummarizingEpisodicMemory), "Summarizing should be configurable."
+
+def test_episodic_memory_token_budget(setup):
+    # Test that the oldest recent episodes are left out to fit a token budget, with each episode counted only once
+    from tinytroupe.agent import EpisodicMemory
+
+    memory = EpisodicMemory(fixed_prefix_length=2, lookback_length=10)
+    for i in range(20):
+        memory.store({'role': 'user', 'content': f"Message {i}", 'simulation_timestamp': None})
+
+    with patch.object(EpisodicMemory, "_count_tokens", return_value=10) as count_tokens:
+        assert len(memory.retrieve_recent()) == 2 + 1 + 10, "Without a budget, the usual episodes should be retrieved."
+
+        recent = memory.retrieve_recent(token_budget=60)
+        assert recent[:2] == memory.memory[:2], "The fixed prefix should be kept while possible."
+        assert recent[2:] == [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] + memory.memory[-3:], "Only the most recent episodes that fit should be kept."
+
+        recent = memory.retrieve_recent(token_budget=20)
+        assert recent == memory.memory[1:2] + [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO], "The fixed prefix should be shortened if needed."
+
+        memory.retrieve_recent(token_budget=60)
+        assert count_tokens.call_count == 2 + 1 + 10, "Each episode should have been counted only once."
+
+def test_produce_message_fits_token_budget(setup):
+    # Test that the messages sent to the model fit the token budget, and that the tokens used are recorded
+    agent = create_oscar_the_architect()
+    for i in range(30):
+        agent.episodic_memory.store({'role': 'user', 'content': f"Message {i}", 'simulation_timestamp': None})
+
+    reply = {"role": "assistant", "content": '{"action": {"type": "DONE", "content": "", "target": ""}, "cognitive_state": {}}'}
+    
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", return_value=reply) as send_message, \
+         patch.dict("tinytroupe.agent.default", {"max_context_tokens": 4000 + 103}), \
+         patch.dict("tinytroupe.openai_utils.default", {"max_tokens": 4000}):
+        
+        agent._produce_message()
+
+    sent_messages = send_message.call_args[0][0]
+    assert len(sent_messages) == 10, "The system message, the cognitive state and only 8 other messages should fit the budget of 100 tokens (plus 3 for the reply)."
+    sent_contents = [message["content"] for message in sent_messages]
+    assert '"Message 29"' in sent_contents, "The most recent message should be sent."
+    assert '"Message 22"' not in sent_contents, "Older messages should be left out."
+    assert agent.last_token_usage == {"prompt_tokens": 103, "stable_prefix_tokens": 0, "completion_tokens": 10}, "The tokens used should be recorded."
+    assert agent.total_token_usage == agent.last_token_usage, "The total tokens used should be accumulated."
+
+def test_prompt_prefix_is_stable(setup):
+    # Test that the cognitive state is sent after the memories, so that changing it leaves the start of the prompt as it was
+    agent = create_oscar_the_architect()
+    agent.episodic_memory.store({'role': 'user', 'content': "Hi!", 'simulation_timestamp': None})
+    agent.reset_prompt()
+
+    reply = {"role": "assistant", "content": '{"action": {"type": "DONE", "content": "", "target": ""}, "cognitive_state": {}}'}
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", return_value=reply) as send_message:
+        
+        agent._produce_message()
+        first_messages = send_message.call_args[0][0]
+
+        agent._update_cognitive_state(attention="The office is on fire.")
+        agent._produce_message()
+        second_messages = send_message.call_args[0][0]
+
+    assert first_messages[0]["content"] == second_messages[0]["content"], "The system message should not change along the cognitive state."
+    assert "The office is on fire." not in second_messages[0]["content"], "The cognitive state should not be in the system message."
+    assert "The office is on fire." in second_messages[-1]["content"], "The cognitive state should be the last message."
+    assert first_messages[1] is second_messages[1], "The very same encoded episodes should be sent again."
+    assert len(second_messages) == 4, "The system message, the episode, the omission info and the cognitive state should be sent."
+    assert agent.last_token_usage["stable_prefix_tokens"] == 30, "All messages but the cognitive state should be counted as a stable prefix."
+    assert agent.total_token_usage["stable_prefix_tokens"] == 30, "The stable prefix tokens should be accumulated."
+
+def test_episodes_are_encoded_once(setup):
+    # Test that episodes are JSON-encoded when stored, and that the very same encodings are sent to the model
+    from tinytroupe.agent import EpisodicMemory
+
+    agent = create_oscar_the_architect()
+    agent.episodic_memory.store({'role': 'user', 'content': {"stimuli": [{"type": "CONVERSATION", "content": "Hi!"}]}, 'simulation_timestamp': None})
+    episode = agent.episodic_memory.memory[-1]
+
+    prompt_message = agent.episodic_memory.prompt_message(episode)
+    assert prompt_message == {"role": "user", "content": '{"stimuli": [{"type": "CONVERSATION", "content": "Hi!"}]}'}, "The content should be JSON-encoded."
+    assert agent.episodic_memory.prompt_message(episode) is prompt_message, "The encoding should be computed only once."
+
+    reply = {"role": "assistant", "content": '{"action": {"type": "DONE", "content": "", "target": ""}, "cognitive_state": {}}'}
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", return_value=reply) as send_message:
+        agent._produce_message()
+        agent._produce_message()
+
+    first_call_messages, second_call_messages = send_message.call_args_list[0][0][0], send_message.call_args_list[1][0][0]
+    assert any(message is prompt_message for message in first_call_messages), "The stored encoding should be sent."
+    assert all(m1 is m2 for m1, m2 in zip(first_call_messages, second_call_messages)), "Nothing should be encoded again for the next call."
+
+    # the encodings are not serialized, but are recomputed when needed after deserialization
+    loaded = EpisodicMemory.from_json(agent.episodic_memory.to_json())
+    assert "_prompt_messages" not in agent.episodic_memory.to_json(), "The encodings should not be serialized."
+    assert loaded.prompt_message(loaded.memory[-1]) == prompt_message, "The encoding should be the same after deserialization."
+
+    # encodings are only ever given for the very episodes they were computed for, even if the stored ones are replaced
+    memory = EpisodicMemory()
+    memory.store({'role': 'user', 'content': "Old", 'simulation_timestamp': None})
+    old_episode = memory.memory[-1]
+    memory.prompt_message(old_episode)
+    new_episode = {'role': 'user', 'content': "New", 'simulation_timestamp': None}
+    memory.memory = [new_episode]
+    assert memory.prompt_message(new_episode)["content"] == '"New"'
+    assert memory.prompt_message(new_episode) is memory.prompt_message(new_episode), "Replaced episodes should be encoded once too."
+    assert memory.prompt_message(old_episode)["content"] == '"Old"', "Episodes no longer stored should still be encoded correctly."
+    assert memory.prompt_message(dict(new_episode)) is not memory.prompt_message(new_episode), "Only stored episodes should use the stored encodings."
+
+def test_documents_are_shared_across_agents(setup, tmp_path):
+    # Test that agents reading the same documents share a single corpus, which is dropped once no agent uses it
+    import gc
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import MockEmbedding
+    from tinytroupe.agent import SemanticMemory, DocumentCorpus, SimpleDirectoryReader
+
+    (tmp_path / "report.txt").write_text("The quarterly report shows growth in all regions.")
+    (tmp_path / "memo.txt").write_text("Please remember to submit your timesheets.")
+
+    original_embed_model = Settings.embed_model
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+    try:
+        with patch("tinytroupe.agent.SimpleDirectoryReader", wraps=SimpleDirectoryReader) as reader:
+            oscar, lisa = create_oscar_the_architect(), create_lisa_the_data_scientist()
+            oscar.read_documents_from_folder(str(tmp_path))
+            lisa.read_documents_from_folder(str(tmp_path))
+
+            assert reader.call_count == 1, "The documents should have been read only once."
+            assert oscar.semantic_memory._corpora == lisa.semantic_memory._corpora, "Both agents should share the same corpus."
+            assert sorted(lisa.semantic_memory.list_documents_names()) == ["memo.txt", "report.txt"], "All documents should be available."
+            assert "timesheets" in lisa.semantic_memory.retrieve_document_content_by_name("memo.txt"), "Documents should be retrievable by name."
+            assert lisa.semantic_memory.retrieve_document_content_by_name("missing.txt") is None, "Missing documents should not be found."
+            assert len(lisa.semantic_memory.retrieve_relevant("growth", top_k=1)) == 1, "The most relevant content should be retrieved."
+
+            # only the sources are serialized, and deserialized memories go back to the shared corpus
+            loaded = SemanticMemory.from_json(lisa.semantic_memory.to_json())
+            assert loaded._corpora == lisa.semantic_memory._corpora, "The deserialized memory should use the shared corpus."
+            assert reader.call_count == 1, "The documents should not have been read again."
+
+            # the corpus is dropped once nobody uses it anymore
+            for memory in [oscar.semantic_memory, lisa.semantic_memory, loaded]:
+                memory._corpora.clear()
+            gc.collect()
+            assert len(DocumentCorpus._corpora) == 0, "Unused corpora should be dropped."
+    finally:
+        Settings.embed_model = original_embed_model
+
+def test_vector_stores(setup, tmp_path):
+    # Test that the vector store backends find the most relevant chunks, with the numpy one answering many targets at once
+    from llama_index.core import Settings, Document
+    from llama_index.core.embeddings import MockEmbedding
+    from tinytroupe.agent import NumpyVectorStore, LlamaIndexVectorStore, DocumentCorpus
+    from tinytroupe.openai_utils import EmbeddingCache
+
+    class KeywordEmbedding(MockEmbedding):
+        # a made-up embedding, in which texts are similar if they mention the same keywords
+        def _get_text_embedding(self, text):
+            return [float("growth" in text), float("timesheets" in text), 0.1]
+        
+        def _get_query_embedding(self, query):
+            return self._get_text_embedding(query)
+
+    documents = [Document(text="The quarterly report shows growth in all regions.", metadata={"file_name": "report.txt"}),
+                 Document(text="Please remember to submit your timesheets.", metadata={"file_name": "memo.txt"})]
+
+    original_embed_model = Settings.embed_model
+    Settings.embed_model = KeywordEmbedding(embed_dim=3)
+    try:
+        for vector_store in [NumpyVectorStore(documents), LlamaIndexVectorStore(documents)]:
+            results = vector_store.retrieve(["growth", "timesheets"], top_k=1)
+            assert [nodes[0].node.metadata["file_name"] for nodes in results] == ["report.txt", "memo.txt"], \
+                f"{type(vector_store).__name__} should find the most relevant chunk for each target."
+        
+        # all the targets missing from the embeddings cache are embedded together
+        cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), model="keywords")
+        Settings.embed_model.embeddings_cache = cache
+        numpy_store = NumpyVectorStore(documents)
+        with patch.object(KeywordEmbedding, "_get_text_embeddings", wraps=Settings.embed_model._get_text_embeddings) as embed:
+            numpy_store.retrieve(["growth", "timesheets", "growth"], top_k=1)
+            numpy_store.retrieve(["timesheets", "growth and timesheets"], top_k=1)
+        assert [call[0][0] for call in embed.call_args_list] == [["growth", "timesheets"], ["growth and timesheets"]], \
+            "Only the targets not embedded before should be embedded, in a single call."
+        Settings.embed_model.embeddings_cache = None
+        cache.close()
+
+        numpy_results = NumpyVectorStore(documents).retrieve(["growth"], top_k=5)[0]
+        assert len(numpy_results) == 2, "No more chunks than available should be retrieved."
+        assert numpy_results[0].score > numpy_results[1].score, "Chunks should be sorted by relevance."
+
+        # a memory-mapped matrix is computed only once, and then shared
+        mmap_folder = str(tmp_path / "embeddings")
+        with patch.object(KeywordEmbedding, "get_text_embedding_batch", wraps=Settings.embed_model.get_text_embedding_batch) as embed:
+            first = NumpyVectorStore(documents, mmap_folder=mmap_folder)
+            second = NumpyVectorStore(documents, mmap_folder=mmap_folder)
+        assert embed.call_count == 1, "The chunks should have been embedded only once."
+        assert isinstance(second.embeddings, np.memmap), "The embeddings should be memory-mapped."
+        assert np.array_equal(first.embeddings, second.embeddings), "The same embeddings should be used."
+
+        # the backend is selected by configuration, with llama-index by default
+        assert isinstance(DocumentCorpus(documents, lambda doc: doc.metadata["file_name"]).vector_store, LlamaIndexVectorStore), \
+            "The llama-index backend should be the default one."
+        with patch.dict("tinytroupe.agent.default", {"semantic_memory_vector_store": "numpy"}):
+            assert isinstance(DocumentCorpus(documents, lambda doc: doc.metadata["file_name"]).vector_store, NumpyVectorStore), \
+                "The numpy backend should be selectable."
+    finally:
+        Settings.embed_model = original_embed_model
+
+def aux_action_content(action_type, content=""):
+    return {"action": {"type": action_type, "content": content, "target": ""},
+            "cognitive_state": {"goals": "Chat.", "attention": "The conversation.", "emotions": "Calm."}}
+
+def test_act_with_multi_action_turns(setup):
+    # Test that all actions up to DONE can be obtained from a single model call, with another one only if some action gives new information
+    from tinytroupe.agent import RecallFaculty
+
+    agent = create_oscar_the_architect()
+    agent.add_mental_faculty(RecallFaculty())
+
+    replies = [{"role": "assistant", "content": json.dumps({"actions": [aux_action_content("THINK", "Hmm."), aux_action_content("TALK", "Hello!"), 
+                                                                          aux_action_content("DONE")]})},
+               {"role": "assistant", "content": json.dumps({"actions": [aux_action_content("RECALL", "Lisa"), aux_action_content("TALK", "Who?"),
+                                                                          aux_action_content("DONE")]})},
+               {"role": "assistant", "content": json.dumps({"actions": [aux_action_content("TALK", "Hi, Lisa!"), aux_action_content("DONE")]})}]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message:
+        
+        actions = agent.act(return_actions=True, multi_action=True)
+        assert send_message.call_count == 1, "All actions should have been obtained from a single call."
+        assert [content["action"]["type"] for content in actions] == ["THINK", "TALK", "DONE"], "All actions should have been performed, in order."
+        assert "From now on, instead of a single action" in send_message.call_args[0][0][-1]["content"], "The model should be asked for all actions."
+
+        actions = agent.act(return_actions=True, multi_action=True)
+        assert send_message.call_count == 3, "The actions after RECALL should have been asked again."
+        assert [content["action"]["type"] for content in actions] == ["RECALL", "TALK", "DONE"], "The actions planned before recalling should be dropped."
+        assert actions[1]["action"]["content"] == "Hi, Lisa!", "The actions after RECALL should come from the second call."
+
+    stored_actions = [episode["content"]["action"]["type"] for episode in agent.episodic_memory.retrieve_all() if "action" in episode["content"]]
+    assert stored_actions == ["THINK", "TALK", "DONE", "RECALL", "TALK", "DONE"], "Each action should have been stored on its own."
+    assert all("From now on" not in json.dumps(episode["content"]) for episode in agent.episodic_memory.retrieve_all()), \
+        "The request for all actions should not be stored."
+
+def test_act_thought_is_not_stored(setup):
+    # Test that the thought sent before each action is not stored in memory
+    agent = create_oscar_the_architect()
+
+    replies = [{"role": "assistant", "content": json.dumps(aux_action_content("TALK", "Hello!"))},
+               {"role": "assistant", "content": json.dumps(aux_action_content("DONE"))}]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message:
+        agent.act()
+
+    assert send_message.call_count == 2, "There should have been one call per action."
+    for call in send_message.call_args_list:
+        assert "I will now act a bit" in call[0][0][-1]["content"], "The thought should be sent before each action."
+    
+    assert len(agent.episodic_memory.retrieve_all()) == 2, "Only the actions should have been stored."
+    assert all("I will now act a bit" not in json.dumps(episode["content"]) for episode in agent.episodic_memory.retrieve_all()), \
+        "The thought should not be stored."
+
+def test_act_with_streaming(setup):
+    # Test that, when streaming, each action is displayed as soon as it is complete, and only once
+    agent = create_oscar_the_architect()
+
+    replies = [json.dumps(aux_action_content("TALK", "Hello!")), json.dumps(aux_action_content("DONE"))]
+    displayed_before_cognitive_state = []
+
+    def aux_send_message(messages, stream_handler=None, **kwargs):
+        reply = replies.pop(0)
+        cognitive_state_start = reply.index('"cognitive_state"')
+
+        # the reply arrives in pieces
+        stream_handler.reset()
+        stream_handler.feed(reply[:cognitive_state_start])
+        displayed_before_cognitive_state.append(display.call_count)
+        stream_handler.feed(reply[cognitive_state_start:])
+
+        return {"role": "assistant", "content": reply}
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=aux_send_message), \
+         patch.object(agent, "_display_communication", wraps=agent._display_communication) as display:
+        actions = agent.act(return_actions=True, stream=True)
+
+    assert [action["action"]["type"] for action in actions] == ["TALK", "DONE"], "The actions should be performed as usual."
+    assert displayed_before_cognitive_state == [1, 2], "Each action should be displayed before the cognitive state arrives."
+    assert display.call_count == 2, "Each action should be displayed only once."
+    assert agent._streamed_actions == [], "All streamed actions should have been acknowledged."
+
+def test_act_with_streaming_retries(setup):
+    # Test that streamed actions are truncated, and that retrying a turn does not display its actions again
+    agent = create_oscar_the_architect()
+
+    talk = aux_action_content("TALK", "Hello! " * 50)
+    replies = [json.dumps({"actions": [talk, "not an action"]}), # streams the TALK, but cannot be parsed
+               json.dumps({"actions": [talk, aux_action_content("DONE")]})]
+
+    def aux_send_message(messages, stream_handler=None, **kwargs):
+        reply = replies.pop(0)
+        stream_handler.reset()
+        stream_handler.feed(reply)
+
+        return {"role": "assistant", "content": reply}
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=aux_send_message), \
+         patch.object(agent, "_display_communication", wraps=agent._display_communication) as display:
+        actions = agent.act(return_actions=True, multi_action=True, stream=True, max_content_length=20)
+
+    assert [action["action"]["type"] for action in actions] == ["TALK", "DONE"], "The turn should have been retried."
+    assert [call.kwargs["content"]["action"]["type"] for call in display.call_args_list] == ["TALK", "DONE"], \
+        "Each action should be displayed only once, even if its turn was retried."
+    assert all(call.kwargs["max_content_length"] == 20 for call in display.call_args_list), \
+        "Streamed actions should be truncated like the others."
+    assert agent._streamed_actions == [], "All streamed actions should have been acknowledged."
+
+def test_act_repairs_malformed_replies(setup):
+    # Test that malformed replies are repaired locally, instead of asking the model again
+    agent = create_oscar_the_architect()
+    agent._update_cognitive_state(goals="Greet everyone.", attention="The door.", emotions="Happy.")
+
+    truncated_reply = json.dumps(aux_action_content("TALK", "Hello!"))[:-3]
+    bare_action_reply = json.dumps({"type": "THINK", "content": "Nice.", "target": ""})
+    replies = [{"role": "assistant", "content": reply} for reply in [truncated_reply, bare_action_reply, json.dumps(aux_action_content("DONE"))]]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message:
+        actions = agent.act(return_actions=True)
+
+    assert send_message.call_count == 3, "The model should not have been asked again."
+    assert [action["action"]["type"] for action in actions] == ["TALK", "THINK", "DONE"]
+    assert actions[0]["cognitive_state"]["emotions"] == "Calm.", "The truncated cognitive state should have been recovered."
+    assert actions[1]["cognitive_state"]["goals"] == "Chat.", "The missing cognitive state should have been left as it was."
+    assert agent.avoided_retries == 2, "The avoided retries should be counted."
+
+def test_act_with_unrepairable_reply(setup):
+    # Test that the model is asked again if the reply cannot be repaired
+    agent = create_oscar_the_architect()
+
+    replies = [{"role": "assistant", "content": "I'd rather not act."},
+               {"role": "assistant", "content": json.dumps(aux_action_content("DONE"))}]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message:
+        agent.act()
+
+    assert send_message.call_count == 2, "The model should have been asked again."
+    assert agent.avoided_retries == 0
+
+def test_act_with_structured_actions(setup):
+    # Test that the model's replies can be constrained to the schema of actions
+    agent = create_oscar_the_architect()
+
+    replies = [{"role": "assistant", "content": json.dumps({"actions": [aux_action_content("DONE")]})}]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message, \
+         patch.dict("tinytroupe.agent.default", {"structured_actions": True}):
+        agent.act(multi_action=True)
+
+    response_format = send_message.call_args[1]["response_format"]
+    assert response_format["type"] == "json_schema" and response_format["json_schema"]["strict"]
+    schema = response_format["json_schema"]["schema"]
+    assert schema["required"] == ["actions"]
+    assert schema["properties"]["actions"]["items"]["required"] == ["action", "cognitive_state"]
+
+    # the cognitive state can be given as lists too, as in the agent's configuration (e.g., its goals)
+    goals_schema = schema["properties"]["actions"]["items"]["properties"]["cognitive_state"]["properties"]["goals"]
+    assert {"type": "array", "items": {"type": "string"}} in goals_schema["anyOf"]
+
+def test_act_with_multi_action_turns_without_actions(setup):
+    # Test that replies without proper actions are asked again, rather than being taken as (no) actions
+    agent = create_oscar_the_architect()
+
+    replies = [{"role": "assistant", "content": json.dumps({"actions": []})},
+               {"role": "assistant", "content": json.dumps({"actions": ["DONE"]})},
+               {"role": "assistant", "content": json.dumps({"actions": [aux_action_content("DONE")]})}]
+
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", side_effect=replies) as send_message:
+        actions = agent.act(return_actions=True, multi_action=True)
+
+    assert send_message.call_count == 3, "The model should have been asked again for each malformed reply."
+    assert [action["action"]["type"] for action in actions] == ["DONE"]
+
+    # even if the model always gives no actions, the agent eventually gives up
+    with patch("tinytroupe.openai_utils.count_message_tokens", return_value=10), \
+         patch("tinytroupe.openai_utils.OpenAIClient.send_message", return_value=replies[0]), \
+         pytest.raises(KeyError):
+        agent.act(multi_action=True)
+
+    # the schema only relies on what strict structured outputs support, so empty lists of actions are left to parsing
+    assert "minItems" not in TinyPerson._action_response_format(multi_action=True)["json_schema"]["schema"]["properties"]["actions"]
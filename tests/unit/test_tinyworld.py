@@ -31,6 +31,24 @@ def test_run(setup, focus_group_world):
             # TODO stimulus integrity check?
         
 
+def test_run_in_parallel(setup, focus_group_world):
+
+    world = focus_group_world
+    world.broadcast("Discuss ideas for a new AI product you'd love to have.")
+    actions_over_time = world.run(2, parallelize=True, return_actions=True)
+
+    assert len(actions_over_time) == 2, "There should be one entry per step."
+    for agents_actions in actions_over_time:
+        # results must follow the order of the agents in the world, regardless of which finished first
+        assert list(agents_actions.keys()) == [agent.name for agent in world.agents], "The actions should be ordered as the agents in the world."
+
+        for agent_name, actions in agents_actions.items():
+            assert terminates_with_action_type(actions, "DONE"), f"{agent_name} should always terminate with a DONE action."
+    
+    # all actions must have been consumed by the world
+    for agent in world.agents:
+        assert len(agent._actions_buffer) == 0, f"{agent.name} should have no pending actions."
+
 def test_broadcast(setup, focus_group_world):
 
     world = focus_group_world
@@ -7,7 +7,7 @@ sys.path.append('../../')
 sys.path.append('..')
 
 
-from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error
+from tinytroupe.utils import name_or_empty, extract_json, repeat_on_error, canonical_hash, JsonStreamParser, repair_json
 from testing_utils import *
 
 def test_extract_json():
@@ -37,6 +37,52 @@ def test_extract_json():
     assert result == {}
 
 
+def test_repair_json():
+    # well-formed JSON is left as it is
+    assert repair_json('```json\n{"a": 1, "b": "x, }"}\n```') == {"a": 1, "b": "x, }"}
+
+    # trailing commas
+    assert repair_json('{"a": [1, 2,], "b": {"c": 3,},}') == {"a": [1, 2], "b": {"c": 3}}
+
+    # output cut short
+    assert repair_json('{"action": {"type": "TALK", "content": "Hel') == {"action": {"type": "TALK", "content": "Hel"}}
+    assert repair_json('{"a": 1, "b":') == {"a": 1, "b": None}
+
+    # invalid escape sequences
+    assert repair_json('{"a": "I\\\'m here"}') == {"a": "I'm here"}
+
+    # hopeless cases
+    assert repair_json("No JSON here.") == {}
+    assert repair_json('{"a": 1, "b"') == {}
+
+def test_json_stream_parser():
+    text = 'Here it is: ```json\n{"action": {"type": "TALK", "content": "Hi, \\"Ana\\" {}", "target": "Ana"}, ' + \
+           '"cognitive_state": {"goals": ["Chat", 1, 2.5, true, null]}}\n```'
+
+    values = {}
+    values_before_cognitive_state = {}
+    parser = JsonStreamParser(on_value=lambda path, value: values.update({path: value}))
+
+    # the text arrives one character at a time
+    for i, char in enumerate(text):
+        if text[i:].startswith('"cognitive_state"'):
+            values_before_cognitive_state = dict(values)
+        parser.feed(char)
+
+    expected = {"action": {"type": "TALK", "content": 'Hi, "Ana" {}', "target": "Ana"},
+                "cognitive_state": {"goals": ["Chat", 1, 2.5, True, None]}}
+    assert parser.done
+    assert parser.result == expected
+    assert values[()] == expected
+    assert values[("cognitive_state", "goals", 4)] is None
+    assert values[("cognitive_state", "goals", 2)] == 2.5
+    assert values_before_cognitive_state[("action",)] == expected["action"], "The action should be complete before the cognitive state arrives."
+
+    # after a reset, everything starts over
+    parser.reset()
+    parser.feed('{"a": 1')
+    assert not parser.done and parser.result is None
+
 def test_name_or_empty():
     class MockEntity:
         def __init__(self, name):
@@ -85,6 +131,16 @@ def test_repeat_on_error():
         decorated_function()
     assert dummy_function.call_count == 1
 
+def test_canonical_hash():
+    # Test that dictionary key order does not matter
+    assert canonical_hash({"a": 1, "b": [1, 2]}) == canonical_hash({"b": [1, 2], "a": 1})
+
+    # Test that different values lead to different hashes
+    assert canonical_hash({"a": 1}) != canonical_hash({"a": 2})
+
+    # Test that non-JSON values are still hashed deterministically
+    assert canonical_hash({"a": object}) == canonical_hash({"a": object})
+
 # TODO
 #def test_json_serializer():
     
\ No newline at end of file
@@ -20,6 +20,11 @@ import ast
 import textwrap  # to dedent strings
 import datetime  # to get current datetime
 import chevron  # to parse Mustache templates
+import threading
+import weakref
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger("tinytroupe")
 import tinytroupe.utils as utils
@@ -43,7 +48,17 @@ config = utils.read_config_file()
 
 default = {}
 default["embedding_model"] = config["OpenAI"].get("EMBEDDING_MODEL", "text-embedding-3-small")
+default["cache_embeddings"] = config["OpenAI"].getboolean("CACHE_EMBEDDINGS", False)
+default["embeddings_cache_file_name"] = config["OpenAI"].get("EMBEDDINGS_CACHE_FILE_NAME", "embeddings_cache.sqlite")
 default["max_content_display_length"] = config["OpenAI"].getint("MAX_CONTENT_DISPLAY_LENGTH", 1024)
+default["max_context_tokens"] = config["OpenAI"].getint("MAX_CONTEXT_TOKENS", 128000)
+default["episodic_memory_token_budget"] = config["Simulation"].getint("EPISODIC_MEMORY_TOKEN_BUDGET", 8192)
+default["summarize_episodic_memory"] = config["Simulation"].getboolean("SUMMARIZE_EPISODIC_MEMORY", False)
+default["multi_action_turns"] = config["Simulation"].getboolean("MULTI_ACTION_TURNS", False)
+default["stream_actions"] = config["Simulation"].getboolean("STREAM_ACTIONS", False)
+default["structured_actions"] = config["Simulation"].getboolean("STRUCTURED_ACTIONS", False)
+default["semantic_memory_vector_store"] = config["Simulation"].get("SEMANTIC_MEMORY_VECTOR_STORE", "llama-index")
+default["semantic_memory_mmap_folder"] = config["Simulation"].get("SEMANTIC_MEMORY_MMAP_FOLDER", None) or None
 
 
 ## LLaMa-Index configs ########################################################
@@ -51,7 +66,8 @@ default["max_content_display_length"] = config["OpenAI"].getint("MAX_CONTENT_DIS
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader
 from llama_index.readers.web import SimpleWebPageReader
-
+from llama_index.core.schema import NodeWithScore, MetadataMode
+from tinytroupe.openai_utils import EmbeddingCache
 
 # this will be cached locally by llama-index, in a OS-dependend location
 
@@ -59,7 +75,11 @@ from llama_index.readers.web import SimpleWebPageReader
 ##    model_name="BAAI/bge-small-en-v1.5"
 ##)
 
+# if enabled, embeddings are cached on disk, so that unchanged documents are never embedded again. The cache file
+# is only created when the first embedding is computed, not on import.
 llmaindex_openai_embed_model = OpenAIEmbedding(model=default["embedding_model"], embed_batch_size=10)
+if default["cache_embeddings"]:
+    llmaindex_openai_embed_model.embeddings_cache = EmbeddingCache(default["embeddings_cache_file_name"], model=default["embedding_model"])
 Settings.embed_model = llmaindex_openai_embed_model
 ###############################################################################
 
@@ -81,6 +101,11 @@ class TinyPerson(JsonSerializableRegistry):
 
     PP_TEXT_WIDTH = 100
 
+    # The configuration keys that make up the agent's current cognitive state. They change often, so they are
+    # rendered after the agent's memories in prompts, leaving the system message untouched.
+    COGNITIVE_STATE_KEYS = ["current_datetime", "current_location", "current_context", "currently_accessible_agents",
+                            "current_attention", "current_goals", "current_emotions"]
+
     serializable_attributes = ["name", "episodic_memory", "semantic_memory", "_mental_faculties", "_configuration"]
 
     # A dict of all agents instantiated so far.
@@ -103,7 +128,8 @@ class TinyPerson(JsonSerializableRegistry):
 
         Args:
             name (str): The name of the TinyPerson. Either this or spec_path must be specified.
-            episodic_memory (EpisodicMemory, optional): The memory implementation to use. Defaults to EpisodicMemory().
+            episodic_memory (EpisodicMemory, optional): The memory implementation to use. Defaults to EpisodicMemory(), or to 
+              SummarizingEpisodicMemory() if so configured (SUMMARIZE_EPISODIC_MEMORY).
             semantic_memory (SemanticMemory, optional): The memory implementation to use. Defaults to SemanticMemory().
             mental_faculties (list, optional): A list of mental faculties to add to the agent. Defaults to None.
         """
@@ -154,9 +180,16 @@ class TinyPerson(JsonSerializableRegistry):
         # saving these communications to another output form later (e.g., caching)
         self._displayed_communications_buffer = []
 
+        # the tokens used by the last call to the model, and by all calls so far, for monitoring purposes
+        self.last_token_usage = None
+        self.total_token_usage = {"prompt_tokens": 0, "stable_prefix_tokens": 0, "completion_tokens": 0}
+
+        # how many malformed replies from the model were repaired, instead of asking it again
+        self.avoided_retries = 0
+
         if not hasattr(self, 'episodic_memory'):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
-            self.episodic_memory = EpisodicMemory()
+            self.episodic_memory = SummarizingEpisodicMemory() if default["summarize_episodic_memory"] else EpisodicMemory()
         
         if not hasattr(self, 'semantic_memory'):
             # This default value MUST NOT be in the method signature, otherwise it will be shared across all instances.
@@ -194,7 +227,17 @@ class TinyPerson(JsonSerializableRegistry):
         self._prompt_template_path = os.path.join(
             os.path.dirname(__file__), "prompts/tinyperson.mustache"
         )
+        self._cognitive_state_template_path = os.path.join(
+            os.path.dirname(__file__), "prompts/tinyperson.cognitive_state.mustache"
+        )
         self._init_system_message = None  # initialized later
+        self._prompt_signature = None # what the system message was last rendered from
+        self._init_system_prompt_message = None # the system message to send to the model, computed only when needed
+        self._init_system_message_tokens = None # computed only when needed
+        self._cognitive_state_prompt_cache = None # the last cognitive state rendered, its encoding and token count
+        self._last_prompt_messages = [] # what was sent to the model last time, to tell how much of it was sent again
+        self._streamed_actions = [] # actions already displayed while their reply was being streamed
+        self._turn_streamed_actions = [] # actions displayed while streaming the current turn, over all its attempts
 
 
         ############################################################
@@ -239,18 +282,19 @@ class TinyPerson(JsonSerializableRegistry):
 
 
     def generate_agent_prompt(self):
-        with open(self._prompt_template_path, "r") as f:
-            agent_prompt_template = f.read()
+        """
+        Renders the system message, with everything about the agent but its current cognitive state (see 
+        generate_cognitive_state_prompt). It seldom changes, so it remains a stable prefix of the prompts sent 
+        to the model, which providers can cache.
+        """
+        # the template is parsed only once, and then reused
+        agent_prompt_template = utils.parse_prompt_template(self._prompt_template_path)
 
         # let's operate on top of a copy of the configuration, because we'll need to add more variables, etc.
-        template_variables = self._configuration.copy()    
+        template_variables = self._static_configuration()
 
         # Prepare additional action definitions and constraints
-        actions_definitions_prompt = ""
-        actions_constraints_prompt = ""
-        for faculty in self._mental_faculties:
-            actions_definitions_prompt += f"{faculty.actions_definitions_prompt()}\n"
-            actions_constraints_prompt += f"{faculty.actions_constraints_prompt()}\n"
+        actions_definitions_prompt, actions_constraints_prompt = self._faculties_prompts()
         
         # make the additional prompt pieces available to the template
         template_variables['actions_definitions_prompt'] = textwrap.indent(actions_definitions_prompt, "")
@@ -261,10 +305,48 @@ class TinyPerson(JsonSerializableRegistry):
 
         return chevron.render(agent_prompt_template, template_variables)
 
-    def reset_prompt(self):
+    def generate_cognitive_state_prompt(self):
+        """
+        Renders the description of the agent's current cognitive state (time, location, context, accessible agents, 
+        attention, goals and emotions), which changes with nearly every action, and thus comes last in prompts.
+        """
+        cognitive_state_template = utils.parse_prompt_template(self._cognitive_state_template_path)
+
+        return chevron.render(cognitive_state_template, 
+                              {key: self._configuration.get(key) for key in TinyPerson.COGNITIVE_STATE_KEYS})
+
+    def _static_configuration(self) -> dict:
+        return {key: value for key, value in self._configuration.items() if key not in TinyPerson.COGNITIVE_STATE_KEYS}
+
+    def _faculties_prompts(self):
+        """
+        Returns the additional action definitions and constraints prompts contributed by the mental faculties.
+        """
+        actions_definitions_prompt = ""
+        actions_constraints_prompt = ""
+        for faculty in self._mental_faculties:
+            actions_definitions_prompt += f"{faculty.actions_definitions_prompt()}\n"
+            actions_constraints_prompt += f"{faculty.actions_constraints_prompt()}\n"
+        
+        return actions_definitions_prompt, actions_constraints_prompt
+
+    def _current_prompt_signature(self):
+        """
+        Returns a summary of everything the system message is rendered from, so that we can tell 
+        whether it must be rendered again. This is much cheaper than rendering.
+        """
+        return (utils.canonical_json(self._static_configuration()), self._faculties_prompts())
+
+    def reset_prompt(self, token_budget:int=None):
 
-        # render the template with the current configuration
-        self._init_system_message = self.generate_agent_prompt()
+        # render the template with the current configuration, unless neither the configuration
+        # nor the mental faculties have changed since the last rendering
+        signature = self._current_prompt_signature()
+        if self._init_system_message is None or signature != self._prompt_signature:
+            self._init_system_message = self.generate_agent_prompt()
+            self._init_system_prompt_message = None
+            self._init_system_message_tokens = None
+            self._prompt_signature = signature
 
         # TODO actually, figure out another way to update agent state without "changing history"
 
@@ -273,8 +355,60 @@ class TinyPerson(JsonSerializableRegistry):
             {"role": "system", "content": self._init_system_message}
         ]
 
-        # sets up the actual interaction messages to use for prompting
-        self.current_messages += self.episodic_memory.retrieve_recent()
+        # the current cognitive state comes last, so that everything before it can be the same as in the previous prompt
+        cognitive_state_message = {"role": "system", "content": self.generate_cognitive_state_prompt()}
+
+        # sets up the actual interaction messages to use for prompting, leaving out older ones if they do not fit the budget
+        if token_budget is None:
+            self.current_messages += self.episodic_memory.retrieve_recent()
+        else:
+            _, cognitive_state_tokens = self._cognitive_state_prompt_message(cognitive_state_message)
+            self.current_messages += self.episodic_memory.retrieve_recent(token_budget=token_budget - self._system_message_tokens() - cognitive_state_tokens)
+        
+        self.current_messages.append(cognitive_state_message)
+    
+    def _cognitive_state_prompt_message(self, cognitive_state_message:dict) -> tuple:
+        """
+        Returns the JSON-encoded cognitive state message to send to the model and its token count, which are reused 
+        for as long as the cognitive state remains the same.
+        """
+        cache = self._cognitive_state_prompt_cache
+        if cache is None or cache[0] != cognitive_state_message["content"]:
+            prompt_message = EpisodicMemory._to_prompt_message(cognitive_state_message)
+            cache = self._cognitive_state_prompt_cache = \
+                (cognitive_state_message["content"], prompt_message, openai_utils.count_message_tokens(prompt_message))
+        
+        return cache[1], cache[2]
+
+    def _system_prompt_message(self) -> dict:
+        if self._init_system_prompt_message is None:
+            self._init_system_prompt_message = EpisodicMemory._to_prompt_message({"role": "system", "content": self._init_system_message})
+        
+        return self._init_system_prompt_message
+
+    def _system_message_tokens(self) -> int:
+        if self._init_system_message_tokens is None:
+            self._init_system_message_tokens = openai_utils.count_message_tokens(self._system_prompt_message())
+        
+        return self._init_system_message_tokens
+    
+    def _act_prompt_message(self) -> dict:
+        # A quick thought before each action. This seems to help with better model responses, perhaps because
+        # it interleaves user with assistant messages. It is the same every time, so it is only sent, never stored.
+        return {"role": "user", 
+                "content": json.dumps({"stimuli": [{"type": "THOUGHT", "content": "I will now act a bit, and then issue DONE.", "source": name_or_empty(self)}]})}
+
+    @staticmethod
+    def _multi_action_prompt_message() -> dict:
+        # asks for all actions up to DONE at once
+        return {"role": "system", 
+                "content": utils.read_prompt_file(os.path.join(os.path.dirname(__file__), "prompts/tinyperson.multi_action.mustache"))}
+
+    def _prompt_token_budget(self) -> int:
+        """
+        Returns how many tokens the prompt can take, so that it fits the model's context along with the reply.
+        """
+        return default["max_context_tokens"] - openai_utils.default["max_tokens"]
 
     def get(self, key):
         """
@@ -289,7 +423,43 @@ class TinyPerson(JsonSerializableRegistry):
         If group is None, the value is added to the top level of the configuration.
         Otherwise, the value is added to the specified group.
         """
+        self._define_without_prompt_reset(key, value, group)
 
+        # must reset prompt after adding to configuration
+        self.reset_prompt()
+
+    @transactional
+    def define_several(self, group, records):
+        """
+        Define several values to the TinyPerson's configuration, all belonging to the same group.
+        """
+        for record in records:
+            self._define_without_prompt_reset(key=None, value=record, group=group)
+        
+        # the prompt only needs to be reset once, after all records are added
+        self.reset_prompt()
+    
+    @transactional
+    def define_many(self, configuration:dict):
+        """
+        Define many values to the TinyPerson's configuration at once, as a single transaction and with a single 
+        prompt reset. This is much cheaper than calling `define` for each value. List values are added to the group 
+        of the same name (as in `define_several`), while all other values are defined at the top level (as in `define`).
+
+        Args:
+            configuration (dict): The values to define, mapping configuration keys to values.
+        """
+        for key, value in configuration.items():
+            if isinstance(value, list):
+                for record in value:
+                    self._define_without_prompt_reset(key=None, value=record, group=key)
+            else:
+                self._define_without_prompt_reset(key=key, value=value)
+        
+        # must reset prompt after adding to configuration
+        self.reset_prompt()
+
+    def _define_without_prompt_reset(self, key, value, group=None):
         # dedent value if it is a string
         if isinstance(value, str):
             value = textwrap.dedent(value)
@@ -298,22 +468,16 @@ class TinyPerson(JsonSerializableRegistry):
             # logger.debug(f"[{self.name}] Defining {key}={value} in the person.")
             self._configuration[key] = value
         else:
+            # groups not present in the default configuration are created as needed
+            if group not in self._configuration:
+                self._configuration[group] = []
+
             if key is not None:
                 # logger.debug(f"[{self.name}] Adding definition to {group} += [ {key}={value} ] in the person.")
                 self._configuration[group].append({key: value})
             else:
                 # logger.debug(f"[{self.name}] Adding definition to {group} += [ {value} ] in the person.")
                 self._configuration[group].append(value)
-
-        # must reset prompt after adding to configuration
-        self.reset_prompt()
-
-    def define_several(self, group, records):
-        """
-        Define several values to the TinyPerson's configuration, all belonging to the same group.
-        """
-        for record in records:
-            self.define(key=None, value=record, group=group)
     
     @transactional
     def define_relationships(self, relationships, replace=True):
@@ -401,6 +565,8 @@ class TinyPerson(JsonSerializableRegistry):
         n=None,
         return_actions=False,
         max_content_length=default["max_content_display_length"],
+        multi_action=default["multi_action_turns"],
+        stream=default["stream_actions"],
     ):
         """
         Acts in the environment and updates its internal cognitive state.
@@ -411,6 +577,12 @@ class TinyPerson(JsonSerializableRegistry):
             until_done (bool): Whether to keep acting until the agent is done and needs additional stimuli.
             n (int): The number of actions to perform. Defaults to None.
             return_actions (bool): Whether to return the actions or not. Defaults to False.
+            multi_action (bool): Whether to obtain all the actions up to DONE from a single model call, instead of one
+              call per action. Another call is only made if some action gives the agent new information (e.g., RECALL).
+              Only applies when acting until done. Defaults to the MULTI_ACTION_TURNS configuration.
+            stream (bool): Whether to stream the model's replies, so that each action is displayed as soon as it is complete,
+              instead of when the whole reply (including the cognitive state) is. Only applies when communications are 
+              displayed. Defaults to the STREAM_ACTIONS configuration.
         """
 
         # either act until done or act a fixed number of times, but not both
@@ -420,17 +592,40 @@ class TinyPerson(JsonSerializableRegistry):
 
         contents = []
 
+        # streaming only makes a difference if there is something to display early
+        stream = stream and TinyPerson.communication_display
+
         # Aux function to perform exactly one action.
-        # Occasionally, the model will return JSON missing important keys, so we just ask it to try again
+        # Occasionally, the model will return JSON missing important keys that cannot be repaired, so we just ask it to try again
         @repeat_on_error(retries=5, exceptions=[KeyError])
         def aux_act_once():
-            # A quick thought before the action. This seems to help with better model responses, perhaps because
-            # it interleaves user with assistant messages.
-            self.think("I will now act a bit, and then issue DONE.")
+            role, content = self._produce_message(ephemeral_messages=[self._act_prompt_message()], stream=stream,
+                                                  max_content_length=max_content_length)
+
+            aux_process_action(role, content)
+
+        # Aux function to perform all the actions up to DONE that the model gives at once.
+        @repeat_on_error(retries=5, exceptions=[KeyError])
+        def aux_act_many():
+            # all actions are checked before any is performed, so that nothing is done if the model must be asked again
+            role, content = self._produce_message(ephemeral_messages=[self._act_prompt_message(), 
+                                                                      TinyPerson._multi_action_prompt_message()],
+                                                  stream=stream, multi_action=True, max_content_length=max_content_length)
+
+            # the model might still give a single action
+            actions_contents = content["actions"] if "actions" in content else [content]
 
-          
-            role, content = self._produce_message()
+            for action_content in actions_contents:
+                gave_new_information = aux_process_action(role, action_content)
 
+                # the next actions were chosen without the new information, so we must ask again
+                if gave_new_information or action_content["action"]["type"] == "DONE" or \
+                   len(contents) > TinyPerson.MAX_ACTIONS_BEFORE_DONE:
+                    break
+
+        # Aux function to store, display and process one action. Returns whether some mental faculty processed it, 
+        # which might give the agent new information.
+        def aux_process_action(role, content):
             self.episodic_memory.store({'role': role, 'content': content, 'simulation_timestamp': self.iso_datetime()})
 
             cognitive_state = content["cognitive_state"]
@@ -444,14 +639,17 @@ class TinyPerson(JsonSerializableRegistry):
                                         emotions=cognitive_state['emotions'])
             
             contents.append(content)          
-            if TinyPerson.communication_display:
+            if TinyPerson.communication_display and not self._was_streamed(action):
                 self._display_communication(role=role, content=content, kind='action', simplified=True, max_content_length=max_content_length)
             
             #
             # Some actions induce an immediate stimulus or other side-effects. We need to process them here, by means of the mental faculties.
             #
+            processed = False
             for faculty in self._mental_faculties:
-                faculty.process_action(self, action)             
+                processed = faculty.process_action(self, action) or processed
+            
+            return processed
             
 
         #
@@ -461,17 +659,20 @@ class TinyPerson(JsonSerializableRegistry):
         ##### Option 1: run N actions ######
         if n is not None:
             for i in range(n):
+                self._turn_streamed_actions = []
                 aux_act_once()
 
         ##### Option 2: run until DONE ######
         elif until_done:
+            # model calls are also counted, in case some of them give no actions at all
+            turns = 0
             while (len(contents) == 0) or (
                 not contents[-1]["action"]["type"] == "DONE"
             ):
 
 
                 # check if the agent is acting without ever stopping
-                if len(contents) > TinyPerson.MAX_ACTIONS_BEFORE_DONE:
+                if max(len(contents), turns) > TinyPerson.MAX_ACTIONS_BEFORE_DONE:
                     logger.warning(f"[{self.name}] Agent {self.name} is acting without ever stopping. This may be a bug. Let's stop it here anyway.")
                     break
                 if len(contents) > 4: # just some minimum number of actions to check for repetition, could be anything >= 3
@@ -480,7 +681,12 @@ class TinyPerson(JsonSerializableRegistry):
                         logger.warning(f"[{self.name}] Agent {self.name} is acting in a loop. This may be a bug. Let's stop it here anyway.")
                         break
 
-                aux_act_once()
+                turns += 1
+                self._turn_streamed_actions = []
+                if multi_action:
+                    aux_act_many()
+                else:
+                    aux_act_once()
 
         if return_actions:
             return contents
@@ -729,25 +935,203 @@ class TinyPerson(JsonSerializableRegistry):
         self._configuration["currently_accessible_agents"] = []
 
     @transactional
-    def _produce_message(self):
-        # logger.debug(f"Current messages: {self.current_messages}")
-
-        # ensure we have the latest prompt (initial system message + selected messages from memory)
-        self.reset_prompt()
+    def _produce_message(self, ephemeral_messages:list=None, stream:bool=False, multi_action:bool=False,
+                         max_content_length=default["max_content_display_length"]):
+        """
+        Calls the model with the current prompt, followed by the given ephemeral messages (if any), which are 
+        sent as they are, and never stored. If streaming, the (first) action in the reply is displayed as soon 
+        as it is complete, while the rest of the reply is still being generated.
 
-        messages = [
-            {"role": msg["role"], "content": json.dumps(msg["content"])}
-            for msg in self.current_messages
-        ]
+        The reply is expected to be an action (or, for multi-action turns, a list of actions), and is repaired if needed
+        (see _parse_action_reply). If so configured, the model is constrained to the JSON schema of such replies.
+        """
+        # logger.debug(f"Current messages: {self.current_messages}")
+        ephemeral_messages = ephemeral_messages if ephemeral_messages is not None else []
+        ephemeral_messages_tokens = [openai_utils.count_message_tokens(message) for message in ephemeral_messages]
+        ephemeral_tokens = sum(ephemeral_messages_tokens)
+
+        # ensure we have the latest prompt (initial system message + selected messages from memory), within the token budget
+        token_budget = self._prompt_token_budget()
+        self.reset_prompt(token_budget=token_budget - ephemeral_tokens)
+
+        # episodes are JSON-encoded only once, when stored, and so are the system message and the cognitive state, 
+        # when rendered. The latter changes most often, so it comes after the episodes, which then remain a stable prefix.
+        episodes = self.current_messages[1:-1]
+        cognitive_state_message, cognitive_state_tokens = self._cognitive_state_prompt_message(self.current_messages[-1])
+        messages = [self._system_prompt_message()] + \
+                   [self.episodic_memory.prompt_message(msg) for msg in episodes] + \
+                   [cognitive_state_message] + \
+                   ephemeral_messages
+
+        # all other counts are cached, so this is cheap
+        messages_tokens = [self._system_message_tokens()] + \
+                          [self.episodic_memory.count_tokens(msg) for msg in episodes] + \
+                          [cognitive_state_tokens] + \
+                          ephemeral_messages_tokens
+        
+        # the 3 extra tokens are for the priming of the reply
+        prompt_tokens = sum(messages_tokens) + 3
+        stable_prefix_tokens = self._stable_prefix_tokens(messages, messages_tokens)
 
-        logger.debug(f"[{self.name}] Sending messages to OpenAI API")
+        logger.debug(f"[{self.name}] Sending messages to OpenAI API ({prompt_tokens} tokens, {stable_prefix_tokens} of which as before, budget of {token_budget} tokens)")
         logger.debug(f"[{self.name}] Last interaction: {messages[-1]}")
 
-        next_message = openai_utils.client().send_message(messages)
+        self._streamed_actions = []
+        stream_handler = utils.JsonStreamParser(on_value=lambda path, value: self._display_streamed_action(path, value, max_content_length),
+                                                on_reset=self._forget_streamed_actions) if stream else None
+        response_format = TinyPerson._action_response_format(multi_action) if default["structured_actions"] else None
+        next_message = openai_utils.client().send_message(messages, stream_handler=stream_handler, response_format=response_format)
 
         logger.debug(f"[{self.name}] Received message: {next_message}")
 
-        return next_message["role"], utils.extract_json(next_message["content"])
+        self._update_token_usage(prompt_tokens, stable_prefix_tokens, next_message)
+
+        try:
+            content = self._parse_action_reply(next_message["content"], multi_action)
+        except KeyError:
+            # the model will be asked again, so what was streamed this time will never be acknowledged
+            self._forget_streamed_actions()
+            raise
+
+        return next_message["role"], content
+
+    def _parse_action_reply(self, text:str, multi_action:bool=False) -> dict:
+        """
+        Parses the given reply from the model, which must contain an action (or, for multi-action turns, possibly 
+        a list of them) along the resulting cognitive state. Common defects are repaired here, rather than by asking 
+        the model again: malformed JSON (see utils.repair_json), bare actions, and missing parts of the cognitive 
+        state, which is then left as it was. 
+
+        Raises:
+            KeyError: If the reply cannot be repaired, e.g., because no action type was given.
+        """
+        content = utils.extract_json(text)
+        repaired = False
+        if not content:
+            content = utils.repair_json(text)
+            repaired = bool(content)
+        
+        # the model might give a single action even if asked for many
+        actions_contents = content["actions"] if multi_action and "actions" in content else [content]
+        if not isinstance(actions_contents, list) or len(actions_contents) == 0:
+            raise KeyError("The reply has no actions.")
+        
+        for action_content in actions_contents:
+            repaired = self._repair_action_content(action_content) or repaired
+        
+        if repaired:
+            self.avoided_retries += 1
+            logger.info(f"[{self.name}] Repaired malformed reply from the model, instead of asking again: {text}")
+
+        return content
+
+    def _repair_action_content(self, content:dict) -> bool:
+        """
+        Checks the given action and cognitive state, filling in what is missing where possible. Returns whether 
+        anything had to be repaired, and raises KeyError if that was not possible.
+        """
+        if not isinstance(content, dict):
+            raise KeyError(f"The reply has a malformed action: {content}")
+
+        repaired = False
+
+        # the action itself might have been given, without the envelope
+        if "action" not in content and "type" in content:
+            action = {key: content.pop(key) for key in list(content.keys()) if key != "cognitive_state"}
+            content["action"] = action
+            repaired = True
+        
+        if not isinstance(content["action"], dict) or "type" not in content["action"]:
+            raise KeyError(f"The reply has a malformed action: {content['action']}")
+
+        if not isinstance(content.get("cognitive_state"), dict):
+            content["cognitive_state"] = {}
+            repaired = True
+        
+        cognitive_state = content["cognitive_state"]
+        for key, configuration_key in [("goals", "current_goals"), ("attention", "current_attention"), ("emotions", "current_emotions")]:
+            if key not in cognitive_state:
+                cognitive_state[key] = self._configuration.get(configuration_key)
+                repaired = True
+        
+        return repaired
+
+    @staticmethod
+    def _action_response_format(multi_action:bool=False) -> dict:
+        """
+        The JSON schema that replies with actions must follow, for models that support structured outputs. It only 
+        uses the subset of JSON schema that strict structured outputs support, so some checks are left to the parsing
+        of replies (e.g., that there is at least one action). The cognitive state can be given as text or as lists 
+        (e.g., of goals), as in the agent's configuration. Action contents and targets are text, so structured 
+        contents (e.g., of tools) must be JSON-encoded, as the tools already accept.
+        """
+        def aux_object(properties:dict) -> dict:
+            return {"type": "object", "properties": properties, "required": list(properties.keys()), "additionalProperties": False}
+        
+        text_or_list = {"anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "string"}}]}
+
+        action_content = aux_object({
+            "action": aux_object({"type": {"type": "string"}, "content": {"type": "string"}, "target": {"type": "string"}}),
+            "cognitive_state": aux_object({"goals": text_or_list, "attention": text_or_list, "emotions": text_or_list})
+        })
+
+        if multi_action:
+            schema, name = aux_object({"actions": {"type": "array", "items": action_content}}), "actions"
+        else:
+            schema, name = action_content, "action"
+        
+        return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+    def _display_streamed_action(self, path:tuple, value, max_content_length=default["max_content_display_length"]):
+        # only the first action can be displayed early, since further ones might never be performed (see act)
+        if path in [("action",), ("actions", 0, "action")] and isinstance(value, dict) and "type" in value:
+            self._streamed_actions.append(value)
+
+            # a failed attempt of the same turn might have displayed it already
+            if value not in self._turn_streamed_actions:
+                self._turn_streamed_actions.append(value)
+                self._display_communication(role="assistant", content={"action": value}, kind='action', simplified=True,
+                                            max_content_length=max_content_length)
+
+    def _forget_streamed_actions(self):
+        """
+        Forgets the actions streamed by an abandoned attempt to obtain a reply, which are never going to be performed.
+        """
+        self._streamed_actions = []
+
+    def _was_streamed(self, action:dict) -> bool:
+        """
+        Whether the given action was already displayed while its reply was being streamed. Each streamed action
+        is only acknowledged once.
+        """
+        if action in self._streamed_actions:
+            self._streamed_actions.remove(action)
+            return True
+        
+        return False
+
+    def _stable_prefix_tokens(self, messages:list, messages_tokens:list) -> int:
+        """
+        Counts the tokens of the messages at the start of the prompt that are the same as in the previous prompt, i.e., 
+        those that providers could serve from their prompt caches. Then, remembers the prompt for next time.
+        """
+        stable_prefix_tokens = 0
+        for message, previous_message, tokens in zip(messages, self._last_prompt_messages, messages_tokens):
+            if message is previous_message or message == previous_message:
+                stable_prefix_tokens += tokens
+            else:
+                break
+        
+        self._last_prompt_messages = messages
+
+        return stable_prefix_tokens
+
+    def _update_token_usage(self, prompt_tokens:int, stable_prefix_tokens:int, next_message:dict):
+        completion_tokens = openai_utils.count_message_tokens(next_message) if next_message is not None else 0
+
+        self.last_token_usage = {"prompt_tokens": prompt_tokens, "stable_prefix_tokens": stable_prefix_tokens, 
+                                 "completion_tokens": completion_tokens}
+        self.total_token_usage = {key: self.total_token_usage.get(key, 0) + value for key, value in self.last_token_usage.items()}
 
     ###########################################################
     # Internal cognitive state changes
@@ -1139,6 +1523,15 @@ class TinyPerson(JsonSerializableRegistry):
         del to_copy["environment"]
         del to_copy["_mental_faculties"]
 
+        # the prompt signature, encodings and token counts are just optimizations, no need to keep them
+        to_copy.pop("_prompt_signature", None)
+        to_copy.pop("_init_system_prompt_message", None)
+        to_copy.pop("_init_system_message_tokens", None)
+        to_copy.pop("_cognitive_state_prompt_cache", None)
+        to_copy.pop("_last_prompt_messages", None)
+        to_copy.pop("_streamed_actions", None)
+        to_copy.pop("_turn_streamed_actions", None)
+
         to_copy["_accessible_agents"] = [agent.name for agent in self._accessible_agents]
         to_copy['episodic_memory'] = self.episodic_memory.to_json()
         to_copy['semantic_memory'] = self.semantic_memory.to_json()
@@ -1171,6 +1564,14 @@ class TinyPerson(JsonSerializableRegistry):
         # restore other fields
         self.__dict__.update(state)
 
+        # the system message must be checked against the restored configuration next time
+        self._prompt_signature = None
+        self._init_system_prompt_message = None
+        self._init_system_message_tokens = None
+        self._cognitive_state_prompt_cache = None
+        self._last_prompt_messages = []
+        self._streamed_actions = []
+        self._turn_streamed_actions = []
 
         return self
     
@@ -1182,13 +1583,16 @@ class TinyPerson(JsonSerializableRegistry):
             new_name (str): The name of the new agent. Agent names must be unique in the simulation, 
               this is why we need to provide a new name.
         """
-        new_agent = TinyPerson(name=new_name, spec_path=None)
+        new_agent = TinyPerson(name=new_name)
         
         new_config = copy.deepcopy(self._configuration)
         new_config['name'] = new_name
 
         new_agent._configuration = new_config
 
+        # the configuration was replaced wholesale, so the prompt must be reset (once) accordingly
+        new_agent.reset_prompt()
+
         return new_agent
         
 
@@ -1198,17 +1602,18 @@ class TinyPerson(JsonSerializableRegistry):
         Adds an agent to the global list of agents. Agent names must be unique,
         so this method will raise an exception if the name is already in use.
         """
-        if agent.name in TinyPerson.all_agents:
+        all_agents = TinyPerson._agents_registry()
+        if agent.name in all_agents:
             raise ValueError(f"Agent name {agent.name} is already in use.")
         else:
-            TinyPerson.all_agents[agent.name] = agent
+            all_agents[agent.name] = agent
 
     @staticmethod
     def has_agent(agent_name: str):
         """
         Checks if an agent is already registered.
         """
-        return agent_name in TinyPerson.all_agents
+        return agent_name in TinyPerson._agents_registry()
 
     @staticmethod
     def set_simulation_for_free_agents(simulation):
@@ -1216,7 +1621,7 @@ class TinyPerson(JsonSerializableRegistry):
         Sets the simulation if it is None. This allows free agents to be captured by specific simulation scopes
         if desired.
         """
-        for agent in TinyPerson.all_agents.values():
+        for agent in TinyPerson._agents_registry().values():
             if agent.simulation_id is None:
                 simulation.add_agent(agent)
 
@@ -1225,8 +1630,9 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Gets an agent by name.
         """
-        if name in TinyPerson.all_agents:
-            return TinyPerson.all_agents[name]
+        all_agents = TinyPerson._agents_registry()
+        if name in all_agents:
+            return all_agents[name]
         else:
             return None
 
@@ -1235,7 +1641,18 @@ class TinyPerson(JsonSerializableRegistry):
         """
         Clears the global list of agents.
         """
-        TinyPerson.all_agents = {}        
+        TinyPerson._agents_registry().clear()
+
+    @staticmethod
+    def _agents_registry() -> dict:
+        """
+        Returns the agents registry in scope: the one of the current simulation, if any, or the global one otherwise.
+        """
+        simulation = current_simulation()
+        if simulation is not None:
+            return simulation.all_agents
+        else:
+            return TinyPerson.all_agents
 
 
 
@@ -1548,6 +1965,8 @@ class EpisodicMemory(TinyMemory):
 
     MEMORY_BLOCK_OMISSION_INFO = {'role': 'assistant', 'content': "Info: there were other messages here, but they were omitted for brevity.", 'simulation_timestamp': None}
 
+    suppress_attributes_from_serialization = ["_prompt_messages", "_prompt_messages_memory"]
+
     def __init__(
         self, fixed_prefix_length: int = 100, lookback_length: int = 100
     ) -> None:
@@ -1563,11 +1982,76 @@ class EpisodicMemory(TinyMemory):
 
         self.memory = []
 
+        self._post_init()
+    
+    def _post_init(self, **kwargs):
+        """
+        Initializes what is not serialized, both after __init__ and after deserialization.
+        """
+        self._reset_prompt_messages()
+
+    def _reset_prompt_messages(self):
+        """
+        Forgets the prompt message (i.e., with JSON-encoded content) and token count of each stored episode, and 
+        prepares to compute them again, only once, when first needed. Entries are kept by identity, along with the 
+        episode itself, so that the identity of a stored episode can never be reused by another object.
+        """
+        self._prompt_messages = {id(episode): [episode, None, None] for episode in self.memory}
+        self._prompt_messages[id(EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO)] = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO, None, None]
+        self._prompt_messages_memory = self.memory
+
+    def _prompt_messages_entry(self, episode: dict) -> list:
+        # if the stored episodes were replaced altogether, the entries refer to episodes no longer stored
+        if self._prompt_messages_memory is not self.memory:
+            self._reset_prompt_messages()
+
+        entry = self._prompt_messages.get(id(episode))
+        if entry is None or entry[0] is not episode:
+            return None
+        
+        return entry
+
     def store(self, value: Any) -> None:
         """
         Stores a value in memory.
         """
         self.memory.append(value)
+        if self._prompt_messages_entry(value) is None:
+            self._prompt_messages[id(value)] = [value, EpisodicMemory._to_prompt_message(value), None]
+
+    def prompt_message(self, episode: dict) -> dict:
+        """
+        Returns the given episode as a message to send to the model, with JSON-encoded content. For stored episodes, 
+        this is computed only once, so the returned message must not be modified.
+        """
+        entry = self._prompt_messages_entry(episode)
+        if entry is None:
+            return EpisodicMemory._to_prompt_message(episode)
+        
+        if entry[1] is None:
+            entry[1] = EpisodicMemory._to_prompt_message(episode)
+        
+        return entry[1]
+
+    def count_tokens(self, episode: dict) -> int:
+        """
+        Counts the tokens that the given episode takes in a prompt. For stored episodes, this is computed only once.
+        """
+        entry = self._prompt_messages_entry(episode)
+        if entry is None:
+            return self._count_tokens(episode)
+        
+        if entry[2] is None:
+            entry[2] = self._count_tokens(episode)
+        
+        return entry[2]
+
+    def _count_tokens(self, episode: dict) -> int:
+        return openai_utils.count_message_tokens(self.prompt_message(episode))
+
+    @staticmethod
+    def _to_prompt_message(episode: dict) -> dict:
+        return {"role": episode["role"], "content": json.dumps(episode["content"])}
 
     def count(self) -> int:
         """
@@ -1601,20 +2085,38 @@ class EpisodicMemory(TinyMemory):
         else:
             return self.retrieve_all()
 
-    def retrieve_recent(self, include_omission_info:bool=True) -> list:
+    def retrieve_recent(self, include_omission_info:bool=True, token_budget:int=None) -> list:
         """
-        Retrieves the n most recent values from memory.
+        Retrieves the n most recent values from memory. If a token budget is given, the oldest of these values
+        are left out as needed to fit it and, if that is not enough, so are the first values of the fixed prefix, 
+        so that the most recent values are always kept.
         """
         omisssion_info = [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO] if include_omission_info else []
 
-        # compute fixed prefix
-        fixed_prefix = self.memory[: self.fixed_prefix_length] + omisssion_info
+        prefix_start = 0
+        prefix_length = min(self.fixed_prefix_length, len(self.memory))
 
         # how many lookback values remain?
         remaining_lookback = min(
-            len(self.memory) - len(fixed_prefix), self.lookback_length
+            len(self.memory) - prefix_length - len(omisssion_info), self.lookback_length
         )
 
+        if token_budget is not None:
+            remaining_lookback = max(remaining_lookback, 0)
+            tokens = sum(self.count_tokens(episode) for episode in 
+                         self.memory[:prefix_length] + omisssion_info + self.memory[len(self.memory) - remaining_lookback:])
+            
+            while remaining_lookback > 0 and tokens > token_budget:
+                tokens -= self.count_tokens(self.memory[-remaining_lookback])
+                remaining_lookback -= 1
+            
+            while prefix_start < prefix_length and tokens > token_budget:
+                tokens -= self.count_tokens(self.memory[prefix_start])
+                prefix_start += 1
+
+        # compute fixed prefix
+        fixed_prefix = self.memory[prefix_start:prefix_length] + omisssion_info
+
         # compute the remaining lookback values and return the concatenation
         if remaining_lookback <= 0:
             return fixed_prefix
@@ -1651,23 +2153,348 @@ class EpisodicMemory(TinyMemory):
         return omisssion_info + self.memory[-n:]
 
 
+class SummarizingEpisodicMemory(EpisodicMemory):
+    """
+    An episodic memory that keeps what it brings to the agent's context under a token budget, no matter how long the 
+    simulation runs. Besides the first few episodes, which are always kept, only the most recent episodes that fit 
+    the budget are retrieved, preceded by a rolling summary of the ones in between. Consolidating older episodes into 
+    the summary requires a model call, which runs in the background while the agent goes on. To keep simulations
+    reproducible, the summary is nevertheless only taken into account at fixed points: the next time episodes are 
+    stored, retrieved or serialized, waiting for it if needed.
+
+    All episodes are nevertheless kept, so `retrieve_all` and the like still give the complete history.
+    """
+
+    serializable_attributes = ["memory", "fixed_prefix_length", "lookback_length", "token_budget", "summary", "summarized_until"]
+
+    MEMORY_SUMMARY_INFO_PREFIX = "Info: this is a summary of earlier messages, which were omitted for brevity: "
+
+    # the maximum number of words of the summary
+    SUMMARY_LENGTH = 300
+
+    # all memories share the same background workers for summarization
+    _summarization_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="episodic memory summarization")
+
+    def __init__(self, fixed_prefix_length: int = 20, lookback_length: int = 100, token_budget: int = None) -> None:
+        """
+        Initializes the memory.
+
+        Args:
+            fixed_prefix_length (int): The number of first episodes that are always retrieved. Defaults to 20.
+            lookback_length (int): The maximum number of recent episodes retrieved. Defaults to 100.
+            token_budget (int): The maximum number of tokens of the retrieved episodes and summary. Defaults to the 
+              EPISODIC_MEMORY_TOKEN_BUDGET configuration.
+        """
+        super().__init__(fixed_prefix_length=fixed_prefix_length, lookback_length=lookback_length)
+
+        self.token_budget = token_budget if token_budget is not None else default["episodic_memory_token_budget"]
+
+        # the summary of the episodes from the end of the fixed prefix up to summarized_until (exclusive)
+        self.summary = None
+        self.summarized_until = fixed_prefix_length
+    
+    def _post_init(self, **kwargs):
+        """
+        Initializes what is not serialized, both after __init__ and after deserialization.
+        """
+        super()._post_init(**kwargs)
+
+        self._pending_summarization = None # the summarization running in the background, if any
+        self._lock = threading.Lock()
+
+    def store(self, value: Any) -> None:
+        """
+        Stores a value in memory, and starts consolidating older episodes if they no longer fit the token budget.
+        """
+        super().store(value)
+
+        with self._lock:
+            self._apply_pending_summarization()
+
+            # when the episodes no longer fit, summarize enough of them to leave room for new ones for a while, so that
+            # summarizations are not too frequent
+            if (self._pending_summarization is None) and (self._first_recent_episode(self.token_budget) > self.summarized_until):
+                end = self._first_recent_episode(self.token_budget // 2)
+                self._pending_summarization = (self.summarized_until, end, 
+                                               SummarizingEpisodicMemory._summarization_executor.submit(
+                                                   self._summarize, self.summary, self.memory[self.summarized_until:end]))
+
+    def retrieve_recent(self, include_omission_info:bool=True, token_budget:int=None) -> list:
+        """
+        Retrieves the fixed prefix, the summary of the episodes after it (if any) and the most recent episodes that 
+        fit the token budget (or the given one, if smaller).
+        """
+        with self._lock:
+            self._apply_pending_summarization()
+
+            first_recent = self._first_recent_episode(self.token_budget if token_budget is None else min(self.token_budget, token_budget))
+
+            episodes = self.memory[: self.fixed_prefix_length]
+            
+            if self.summary is not None:
+                episodes = episodes + [self._summary_message()]
+            
+            # there might be episodes that are neither summarized nor recent enough to be retrieved
+            if include_omission_info and (first_recent > self.summarized_until):
+                episodes = episodes + [EpisodicMemory.MEMORY_BLOCK_OMISSION_INFO]
+            
+            return episodes + self.memory[first_recent:]
+
+    def to_json(self, *args, **kwargs) -> dict:
+        # the serialized state must not depend on how long the pending summarization takes
+        with self._lock:
+            self._apply_pending_summarization()
+        
+        return super().to_json(*args, **kwargs)
+
+    def _first_recent_episode(self, token_budget: int) -> int:
+        """
+        Returns the index of the oldest episode that can be retrieved along with the more recent ones, the fixed prefix 
+        and the summary, without exceeding the given token budget.
+        """
+        available_tokens = token_budget - sum(self.count_tokens(episode) for episode in self.memory[:self.fixed_prefix_length])
+        if self.summary is not None:
+            available_tokens -= self.count_tokens(self._summary_message())
+        
+        first_recent = len(self.memory)
+        lowest_possible = max(self.summarized_until, len(self.memory) - self.lookback_length)
+        while (first_recent > lowest_possible) and (self.count_tokens(self.memory[first_recent - 1]) <= available_tokens):
+            available_tokens -= self.count_tokens(self.memory[first_recent - 1])
+            first_recent -= 1
+        
+        return first_recent
+
+    def _summary_message(self) -> dict:
+        return {'role': 'assistant', 'content': SummarizingEpisodicMemory.MEMORY_SUMMARY_INFO_PREFIX + self.summary, 'simulation_timestamp': None}
+
+    def _summarize(self, previous_summary: str, episodes: list) -> str:
+        """
+        Summarizes the given episodes, along with the previous summary, if any. Runs in the background.
+        """
+        rendering_configs = {"previous_summary": previous_summary,
+                             "episodes": [json.dumps({"role": episode["role"], "content": episode["content"], 
+                                                      "simulation_timestamp": episode.get("simulation_timestamp")}) for episode in episodes],
+                             "number_of_words": SummarizingEpisodicMemory.SUMMARY_LENGTH}
+
+        messages = utils.compose_initial_LLM_messages_with_templates("episodic_memory.summarizer.system.mustache", 
+                                                                     "episodic_memory.summarizer.user.mustache", rendering_configs)
+        next_message = openai_utils.client().send_message(messages, temperature=0.2)
+
+        if next_message is not None:
+            return next_message["content"]
+        else:
+            return None
+
+    def _apply_pending_summarization(self):
+        """
+        Updates the summary with the background summarization, if any, waiting for it to finish. Must be called with the lock held.
+        """
+        if self._pending_summarization is not None:
+            start, end, future = self._pending_summarization
+            self._pending_summarization = None
+
+            try:
+                summary = future.result()
+            except Exception as e:
+                logger.error(f"Could not summarize episodes {start} to {end}, will try again later: {e}")
+                return
+            
+            if summary is not None:
+                self.summary = summary
+                self.summarized_until = end
+
+
+class VectorStore:
+    """
+    Base class for the backends that find the chunks of some documents that are most relevant to given targets.
+    """
+
+    def __init__(self, documents:list) -> None:
+        self.documents = documents
+
+    def retrieve(self, relevance_targets:list, top_k:int) -> list:
+        """
+        Retrieves, for each of the given targets, the top_k most relevant nodes (i.e., document chunks), along with their similarity scores.
+
+        Returns:
+            list: A list of NodeWithScore lists, one per target, in the same order as the targets.
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+
+class LlamaIndexVectorStore(VectorStore):
+    """
+    Relies on a regular llama-index VectorStoreIndex, which answers each target on its own.
+    """
+
+    def __init__(self, documents:list) -> None:
+        super().__init__(documents)
+        self.index = VectorStoreIndex.from_documents(documents)
+
+    def retrieve(self, relevance_targets:list, top_k:int) -> list:
+        retriever = self.index.as_retriever(similarity_top_k=top_k)
+        return [retriever.retrieve(relevance_target) for relevance_target in relevance_targets]
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Keeps the (normalized) embeddings of all document chunks in a single float32 matrix, so that the most relevant 
+    chunks for any number of targets are found with one matrix multiplication. If a folder is given, the matrix is 
+    saved there and memory-mapped, so that processes working on the same documents share it, and do not 
+    need to compute it again. Single precision halves the memory needed, at the cost of similarity scores that 
+    differ from double precision ones around the seventh decimal, which can only reorder chunks that are virtually tied.
+    """
+
+    def __init__(self, documents:list, mmap_folder:str=None) -> None:
+        super().__init__(documents)
+
+        # chunks documents just like llama-index would do before indexing them
+        self.nodes = Settings.node_parser.get_nodes_from_documents(documents)
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in self.nodes]
+
+        if mmap_folder is not None:
+            file_path = os.path.join(mmap_folder, f"{utils.canonical_hash([Settings.embed_model.model_name, texts])}.npy")
+            if not os.path.exists(file_path):
+                os.makedirs(mmap_folder, exist_ok=True)
+                
+                # others might be writing the same file, so we only replace it once it is complete
+                with tempfile.NamedTemporaryFile(dir=mmap_folder, suffix=".npy", delete=False) as f:
+                    np.save(f, self._embed(texts))
+                os.replace(f.name, file_path)
+            
+            self.embeddings = np.load(file_path, mmap_mode="r")
+        
+        else:
+            self.embeddings = self._embed(texts)
+
+    def retrieve(self, relevance_targets:list, top_k:int) -> list:
+        if len(relevance_targets) == 0 or len(self.nodes) == 0:
+            return [[] for _ in relevance_targets]
+        
+        queries = self._normalized(np.array(self._embed_queries(relevance_targets), dtype=np.float32))
+        
+        # cosine similarities of all targets to all chunks at once
+        scores = queries @ self.embeddings.T
+
+        # the top_k chunks of each target, without sorting all of them
+        k = min(top_k, len(self.nodes))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+        return [[NodeWithScore(node=self.nodes[i], score=float(score)) for i, score in zip(row, row_scores)] 
+                for row, row_scores in zip(top, top_scores)]
+
+    def _embed(self, texts:list) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        
+        return self._normalized(np.array(Settings.embed_model.get_text_embedding_batch(texts), dtype=np.float32))
+
+    @staticmethod
+    def _embed_queries(relevance_targets:list) -> list:
+        # the targets are embedded together, just like document chunks (OpenAI models embed queries and documents alike), 
+        # so that the embedding model embeds all those missing from its cache (if any) in a single call
+        unique_targets = list(dict.fromkeys(relevance_targets))
+        embeddings = dict(zip(unique_targets, Settings.embed_model.get_text_embedding_batch(unique_targets)))
+        return [embeddings[target] for target in relevance_targets]
+
+    @staticmethod
+    def _normalized(vectors:np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class DocumentCorpus:
+    """
+    The documents from a single source (a folder or a web page), along with their index for semantic retrieval. 
+    Reading, chunking and embedding documents is expensive, so each corpus is shared by all the semantic memories 
+    with access to its source, and kept only while some of them still refers to it.
+    """
+
+    # the corpora in use, by source. They are dropped once no memory refers to them anymore.
+    _corpora = weakref.WeakValueDictionary()
+    _corpora_lock = threading.Lock()
+
+    # the available vector store backends, selected through the SEMANTIC_MEMORY_VECTOR_STORE configuration
+    vector_store_factories = {
+        "numpy": lambda documents: NumpyVectorStore(documents, mmap_folder=default["semantic_memory_mmap_folder"]),
+        "llama-index": LlamaIndexVectorStore
+    }
+
+    def __init__(self, documents:list, doc_to_name_func) -> None:
+        self.documents = documents
+        self.filename_to_document = {}
+
+        for document in documents:
+            # out of an abundance of caution, we sanitize the text
+            document.set_content(utils.sanitize_raw_string(document.text))
+
+            name = doc_to_name_func(document)
+            self.filename_to_document[name] = document
+
+        # index documents for semantic retrieval
+        if len(documents) > 0:
+            self.vector_store = DocumentCorpus.vector_store_factories[default["semantic_memory_vector_store"]](documents)
+        else:
+            self.vector_store = None
+    
+    @staticmethod
+    def from_documents_path(documents_path:str) -> "DocumentCorpus":
+        """
+        Returns the corpus of the documents in the given folder, which are only read if no other memory is using them already.
+        """
+        return DocumentCorpus._shared(("path", os.path.abspath(documents_path)),
+                                      lambda: DocumentCorpus(SimpleDirectoryReader(documents_path).load_data(), 
+                                                             lambda doc: doc.metadata["file_name"]))
+
+    @staticmethod
+    def from_web_url(web_url:str) -> "DocumentCorpus":
+        """
+        Returns the corpus of the document at the given URL, which is only retrieved if no other memory is using it already.
+        """
+        return DocumentCorpus._shared(("url", web_url),
+                                      lambda: DocumentCorpus(SimpleWebPageReader(html_to_text=True).load_data([web_url]), 
+                                                             lambda doc: doc.id_))
+
+    @staticmethod
+    def _shared(source:tuple, load_func) -> "DocumentCorpus":
+        with DocumentCorpus._corpora_lock:
+            corpus = DocumentCorpus._corpora.get(source)
+            if corpus is None:
+                corpus = load_func()
+                DocumentCorpus._corpora[source] = corpus
+            
+            return corpus
+
+    def retrieve_relevant(self, relevance_targets:list, top_k:int) -> list:
+        """
+        Retrieves the nodes of the documents that are most relevant to each of the given targets, all at once.
+        """
+        if self.vector_store is not None:
+            return self.vector_store.retrieve(relevance_targets, top_k)
+        else:
+            return [[] for _ in relevance_targets]
+
+
 class SemanticMemory(TinyMemory):
     """
     Semantic memory is the memory of meanings, understandings, and other concept-based knowledge unrelated to specific experiences.
     It is not ordered temporally, and it is not about remembering specific events or episodes. This class provides a simple implementation
     of semantic memory, where the agent can store and retrieve semantic information.
+
+    The documents themselves are kept in corpora shared by all agents (see DocumentCorpus), so each memory just keeps 
+    track of the sources it has access to.
     """
 
-    suppress_attributes_from_serialization = ["index"]
+    serializable_attributes = ["documents_paths", "documents_web_urls"]
 
     def __init__(self, documents_paths: list=None, web_urls: list=None) -> None:
-        self.index = None
-        
         self.documents_paths = []
         self.documents_web_urls = []
 
-        self.documents = []
-        self.filename_to_document = {}
+        self._post_init()
 
         # load document paths and web urls
         self.add_documents_paths(documents_paths)
@@ -1675,48 +2502,68 @@ class SemanticMemory(TinyMemory):
         if web_urls is not None:
             self.add_web_urls(web_urls)
     
+    def _post_init(self, **kwargs):
+        """
+        Initializes what is not serialized, both after __init__ and after deserialization.
+        """
+        # the corpora this memory has access to, by source
+        self._corpora = {}
+    
     def retrieve_relevant(self, relevance_target:str, top_k=5) -> list:
         """
         Retrieves all values from memory that are relevant to a given target.
         """
-        if self.index is not None:
-            retriever = self.index.as_retriever(similarity_top_k=top_k)
-            nodes = retriever.retrieve("Microsoft's recent major investments")
-        else:
-            nodes = []
+        return self.retrieve_relevant_batch([relevance_target], top_k=top_k)[0]
 
-        retrieved = []
-        for node in nodes:
-            content = "SOURCE: " + node.metadata['file_name']
-            content += "\n" + "SIMILARITY SCORE:" + str(node.score)
-            content += "\n" + "RELEVANT CONTENT:" + node.text
-            retrieved.append(content)
+    def retrieve_relevant_batch(self, relevance_targets:list, top_k=5) -> list:
+        """
+        Retrieves all values from memory that are relevant to each of the given targets. Each corpus answers 
+        all targets at once, which is much faster than retrieving values for one target at a time. RECALL actions
+        are still answered one at a time, since each agent needs the result before acting again, so this is meant
+        for callers that already have several targets at hand.
+
+        Returns:
+            list: A list of retrieved values for each target, in the same order as the targets.
+        """
+        nodes_per_target = [[] for _ in relevance_targets]
+        for corpus in self._corpora.values():
+            for nodes, corpus_nodes in zip(nodes_per_target, corpus.retrieve_relevant(relevance_targets, top_k=top_k)):
+                nodes += corpus_nodes
+        
+        retrieved_per_target = []
+        for nodes in nodes_per_target:
+            # the most relevant nodes from all corpora
+            nodes = sorted(nodes, key=lambda node: node.score if node.score is not None else 0.0, reverse=True)[:top_k]
+
+            retrieved = []
+            for node in nodes:
+                content = "SOURCE: " + node.metadata['file_name']
+                content += "\n" + "SIMILARITY SCORE:" + str(node.score)
+                content += "\n" + "RELEVANT CONTENT:" + node.text
+                retrieved.append(content)
+            
+            retrieved_per_target.append(retrieved)
         
-        return retrieved
+        return retrieved_per_target
     
     def retrieve_document_content_by_name(self, document_name:str) -> str:
         """
         Retrieves a document by its name.
         """
-        if self.filename_to_document is not None:
-            doc = self.filename_to_document[document_name]
+        for corpus in self._corpora.values():
+            doc = corpus.filename_to_document.get(document_name)
             if doc is not None:
                 content = "SOURCE: " + document_name
                 content += "\n" + "CONTENT: " + doc.text[:10000] # TODO a more intelligent way to limit the content
                 return content
-            else:
-                return None
-        else:
-            return None
+        
+        return None
     
     def list_documents_names(self) -> list:
         """
         Lists the names of the documents in memory.
         """
-        if self.filename_to_document is not None:
-            return list(self.filename_to_document.keys())
-        else:
-            return []
+        return [name for corpus in self._corpora.values() for name in corpus.filename_to_document.keys()]
     
     def add_documents_paths(self, documents_paths:list) -> None:
         """
@@ -1734,8 +2581,7 @@ class SemanticMemory(TinyMemory):
 
         if documents_path not in self.documents_paths:
             self.documents_paths.append(documents_path)
-            new_documents = SimpleDirectoryReader(documents_path).load_data()
-            self._add_documents(new_documents, lambda doc: doc.metadata["file_name"])
+            self._corpora[("path", documents_path)] = DocumentCorpus.from_documents_path(documents_path)
     
     def add_web_urls(self, web_urls:list) -> None:
         """ 
@@ -1744,43 +2590,15 @@ class SemanticMemory(TinyMemory):
         filtered_web_urls = [url for url in web_urls if url not in self.documents_web_urls]
         self.documents_web_urls += filtered_web_urls
 
-        if len(filtered_web_urls) > 0:
-            new_documents = SimpleWebPageReader(html_to_text=True).load_data(filtered_web_urls)
-            self._add_documents(new_documents, lambda doc: doc.id_)
+        for web_url in filtered_web_urls:
+            self._corpora[("url", web_url)] = DocumentCorpus.from_web_url(web_url)
     
     def add_web_url(self, web_url:str) -> None:
         """
         Adds the data retrieved from the specified URL to documents used for semantic memory.
         """
-        # we do it like this because the add_web_urls could run scrapes in parallel, so it is better
-        # to implement this one in terms of the other
         self.add_web_urls([web_url])
 
-    def _add_documents(self, new_documents, doc_to_name_func) -> list:
-        """
-        Adds documents to the semantic memory.
-        """
-        # index documents by name
-        if len(new_documents) > 0:
-            # add the new documents to the list of documents
-            self.documents += new_documents
-
-            # process documents individually too
-            for document in new_documents:
-                
-                # out of an abundance of caution, we sanitize the text
-                document.text = utils.sanitize_raw_string(document.text)
-
-                name = doc_to_name_func(document)
-                self.filename_to_document[name] = document
-
-            # index documents for semantic retrieval
-            if self.index is None:
-                self.index = VectorStoreIndex.from_documents(self.documents)
-            else:
-                self.index.refresh(self.documents)
-
-
 
     ###########################################################
     # IO
@@ -1789,5 +2607,9 @@ class SemanticMemory(TinyMemory):
     def _post_deserialization_init(self):
         super()._post_deserialization_init()
     
-        self.add_documents_paths(self.documents_paths)
-        self.add_web_urls(self.documents_web_urls)
+        # only the sources are serialized, so their (shared) corpora must be found again
+        for documents_path in self.documents_paths:
+            self._corpora[("path", documents_path)] = DocumentCorpus.from_documents_path(documents_path)
+        
+        for web_url in self.documents_web_urls:
+            self._corpora[("url", web_url)] = DocumentCorpus.from_web_url(web_url)
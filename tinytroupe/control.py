@@ -2,8 +2,14 @@
 Simulation controlling mechanisms.
 """
 import json
+import ast
+import datetime
 import os
 import tempfile
+import copy
+import time
+import threading
+import contextvars
 
 import tinytroupe
 import tinytroupe.utils as utils
@@ -11,11 +17,24 @@ import tinytroupe.utils as utils
 import logging
 logger = logging.getLogger("tinytroupe")
 
+config = utils.read_config_file()
+
+default = {}
+default["checkpoint_sync_interval"] = config["Simulation"].getfloat("CHECKPOINT_SYNC_INTERVAL", 10.0)
+
 class Simulation:
 
     STATUS_STOPPED = "stopped"
     STATUS_STARTED = "started"
 
+    # Every KEYFRAME_INTERVAL-th state in the traces is stored in full (a keyframe), while the others only
+    # store what changed since the previous state (a delta). This keeps the traces small, since most transactions 
+    # change only a tiny part of the simulation state.
+    KEYFRAME_INTERVAL = 20
+
+    # The first line of cache files, which identifies their format. Each of the following lines holds one trace node.
+    CACHE_FILE_HEADER = {"format": "tinytroupe-trace", "version": 2}
+
     def __init__(self, id="default", cached_trace:list=None):
         self.id = id
 
@@ -30,14 +49,36 @@ class Simulation:
         self.name_to_environment = {} # {environment_name: environment, ...}
         self.status = Simulation.STATUS_STOPPED
 
+        # Registries of all the agents, environments and factories created while this simulation is the current one. 
+        # They take the place of the global registries (e.g., TinyPerson.all_agents), so that simulations running 
+        # concurrently (e.g., in different threads) do not interfere with each other.
+        self.all_agents = {} # {agent_name: agent, ...}
+        self.all_environments = {} # {environment_name: environment, ...}
+        self.all_factories = {} # {factory_name: factory, ...}
+
+        # the counter used to generate fresh ids while this simulation is the current one
+        self._fresh_id_counter = 0
+
         self.cache_path = f"./tinytroupe-cache-{id}.json" # default cache path
         
         # should we always automatically checkpoint at the every transaction?
         self.auto_checkpoint = False
 
+        # should cached transactions be replayed without restoring each intermediate state?
+        self.fast_forward = False
+
         # whether there are changes not yet saved to the cache file
         self.has_unsaved_cache_changes = False
 
+        # The cache file is append-only, so we keep track of what was already saved to it: the file path, and the
+        # offsets of the lines of the trace nodes in it, followed by the end offset of the last one.
+        self._saved_cache_path = None
+        self._saved_trace_offsets = []
+
+        # whether there are writes to the cache file not yet synced to disk, and when that was last done
+        self._has_unsynced_cache_changes = False
+        self._last_cache_sync_time = time.monotonic()
+
         # whether the agent is under a transaction or not, used for managing
         # simulation caching later
         self._under_transaction = False
@@ -47,7 +88,8 @@ class Simulation:
         # stores a list of simulation states.
         # Each state is a tuple (prev_node_hash, event_hash, event_output, state), where prev_node_hash is a hash of the previous node in this chain,
         # if any, event_hash is a hash of the event that triggered the transition to this state, if any, event_output is the output of the event,
-        # if any, and state is the actual complete state that resulted.
+        # if any, and state is the resulting state, either complete (a keyframe) or as a delta w.r.t. the previous one 
+        # (see _encode_trace_state).
         if cached_trace is None:
             self.cached_trace = []
         else:
@@ -57,10 +99,17 @@ class Simulation:
         #
         # The actual, current, execution trace. Each state is a tuple (prev_node_hash, event_hash, state), where prev_node_hash is a hash 
         # of the previous node in this chain, if any, event_hash is a hash of the event that triggered the transition to this state, if any, 
-        # event_output is the output of the event, if any, and state is the actual complete state that resulted.
+        # event_output is the output of the event, if any, and state is the resulting state, encoded as in the cached trace.
         self.execution_trace = []
 
-    def begin(self, cache_path:str=None, auto_checkpoint:bool=False):
+        # The complete state at some execution trace position (normally, the current one), from which the next delta is computed.
+        self._current_state = None
+        self._current_state_position = -1
+
+        # whether the cached state at the current execution trace position still has to be restored (when fast-forwarding)
+        self._has_pending_cached_state = False
+
+    def begin(self, cache_path:str=None, auto_checkpoint:bool=False, fast_forward:bool=False):
         """
         Marks the start of the simulation being controlled.
 
@@ -68,12 +117,11 @@ class Simulation:
             cache_path (str): The path to the cache file. If not specified, 
                     defaults to the default cache path defined in the class.
             auto_checkpoint (bool, optional): Whether to automatically checkpoint at the end of each transaction. Defaults to False.
+            fast_forward (bool, optional): Whether to replay cached transactions without restoring the intermediate states. The 
+                    cached state is then restored only when actually needed, e.g., at the first transaction not in the cache, or as
+                    soon as an agent, environment or factory is read, which is much faster. However, the communications of the
+                    replayed transactions are not displayed. Defaults to False.
         """
-        # local import to avoid circular dependencies
-        from tinytroupe.agent import TinyPerson
-        from tinytroupe.environment import TinyWorld
-        from tinytroupe.factory import TinyFactory
-
         if self.status == Simulation.STATUS_STOPPED:
             self.status = Simulation.STATUS_STARTED
         else:
@@ -85,13 +133,16 @@ class Simulation:
         # should we automatically checkpoint?
         self.auto_checkpoint = auto_checkpoint
 
+        # should we fast-forward through the cached transactions?
+        self.fast_forward = fast_forward
+
         # clear the agents, environments and other simulated entities, we'll track them from now on
-        TinyPerson.clear_agents()
-        TinyWorld.clear_environments()
-        TinyFactory.clear_factories()
+        self.all_agents = {}
+        self.all_environments = {}
+        self.all_factories = {}
 
         # All automated fresh ids will start from 0 again for this simulation
-        utils._fresh_id_counter = 0
+        self._fresh_id_counter = 0
 
         # load the cache file, if any
         if self.cache_path is not None:
@@ -103,10 +154,28 @@ class Simulation:
         """
         if self.status == Simulation.STATUS_STARTED:
             self.status = Simulation.STATUS_STOPPED
+            self._restore_pending_cached_state()
             self.checkpoint()
+            self._sync_cache_file(force=True)
+            self._publish_registries()
         else:
             raise ValueError("Simulation is already stopped.")
 
+    def _publish_registries(self):
+        """
+        Adds the agents, environments and factories created under this simulation to the global registries, so that 
+        they can still be looked up (e.g., by TinyPerson.get_agent_by_name) once the simulation ends. If simulations 
+        running concurrently used the same names, the ones of the simulation ending last prevail.
+        """
+        # local import to avoid circular dependencies
+        from tinytroupe.agent import TinyPerson
+        from tinytroupe.environment import TinyWorld
+        from tinytroupe.factory import TinyFactory
+
+        TinyPerson.all_agents.update(self.all_agents)
+        TinyWorld.all_environments.update(self.all_environments)
+        TinyFactory.all_factories.update(self.all_factories)
+
     def checkpoint(self):
         """
         Saves current simulation trace to a file.
@@ -148,6 +217,13 @@ class Simulation:
         self.factories.append(factory)
         self.name_to_factory[factory.name] = factory
 
+    def fresh_id(self) -> int:
+        """
+        Returns a fresh id, unique within this simulation.
+        """
+        self._fresh_id_counter += 1
+        return self._fresh_id_counter
+
     ###################################################################################################
     # Cache and execution chain mechanisms
     ###################################################################################################
@@ -157,20 +233,57 @@ class Simulation:
         """
         return len(self.execution_trace) - 1
     
-    def _function_call_hash(self, function_name, *args, **kwargs) -> int:
+    def _function_call_hash(self, function_name, *args, **kwargs) -> str:
         """
-        Computes the hash of the given function call.
+        Computes the hash of the given function call, a compact and stable fingerprint of the event. Simulated 
+        entities (agents, environments and factories) among the arguments are represented by their names only,
+        so the cost does not depend on their state.
         """
-        event = str((function_name, args, kwargs))
-        return event
+        return utils.canonical_hash([function_name, args, kwargs])
+
+    def _node_hash(self, node) -> str:
+        """
+        Computes the hash of the given trace node, which identifies the whole chain of events leading to it. 
+        Since it only depends on the previous node hash and the event hash, it is cheap to compute.
+        """
+        prev_node_hash, event_hash = node[0], node[1]
+        return utils.canonical_hash([prev_node_hash, event_hash])
 
     def _skip_execution_with_cache(self):
         """
-        Skips the current execution, assuming there's a cached state at the same position.
+        Skips the current execution, assuming there's a cached state at the same position. Unless fast-forwarding,
+        the cached state is immediately restored. Otherwise, the simulated entities are marked as stale, so that 
+        the cached state is restored as soon as any of them is actually looked at (see _StaleEntity).
         """
         assert len(self.cached_trace) > self._execution_trace_position() + 1, "There's no cached state at the current execution position."
         
         self.execution_trace.append(self.cached_trace[self._execution_trace_position() + 1])
+        self._has_pending_cached_state = True
+
+        if not self.fast_forward:
+            self._restore_pending_cached_state()
+        else:
+            for entity in self.agents + self.environments + self.factories:
+                _StaleEntity.mark(entity)
+
+    def _restore_pending_cached_state(self):
+        """
+        Restores the cached state at the current execution trace position, if it was not restored yet.
+        """
+        if self._has_pending_cached_state:
+            # the entities must be usable again before their state is decoded
+            for entity in self.agents + self.environments + self.factories:
+                _StaleEntity.unmark(entity)
+
+            position = self._execution_trace_position()
+            self._set_current_state(self._cached_state_at(position), position)
+            self._decode_simulation_state(self._current_state)
+
+            self._has_pending_cached_state = False
+    
+    def _set_current_state(self, state: dict, position: int):
+        self._current_state = state
+        self._current_state_position = position
     
     def _is_transaction_event_cached(self, event_hash) -> bool:
         """
@@ -189,8 +302,9 @@ class Simulation:
                 #   Must satisfy: 
                 #     - event_hash == c_event_hash_1
                 #     - hash(e0) == c_prev_node_hash_1
-                event_hash_match = event_hash == self.cached_trace[self._execution_trace_position() + 1][1]
-                prev_node_match = True 
+                cached_node = self.cached_trace[self._execution_trace_position() + 1]
+                event_hash_match = event_hash == cached_node[1]
+                prev_node_match = cached_node[0] == self._last_execution_node_hash()
 
                 return event_hash_match and prev_node_match
             
@@ -206,8 +320,22 @@ class Simulation:
         refreshes the cache to the current execution state and starts building a new cache from there.
         """
         self.cached_trace = self.cached_trace[:self._execution_trace_position()+1]
+
+        # the dropped nodes must not be kept in the cache file either
+        if len(self._saved_trace_offsets) > len(self.cached_trace) + 1:
+            del self._saved_trace_offsets[len(self.cached_trace) + 1:]
+            self.has_unsaved_cache_changes = True
         
-    def _add_to_execution_trace(self, state: dict, event_hash: int, event_output):
+    def _last_execution_node_hash(self) -> str:
+        """
+        Returns the hash of the last node in the execution trace, or None if the execution trace is empty.
+        """
+        if self.execution_trace:
+            return self._node_hash(self.execution_trace[-1])
+        else:
+            return None
+
+    def _add_to_execution_trace(self, state: dict, event_hash: str, event_output):
         """
         Adds a state to the execution_trace list and computes the appropriate hash.
         The computed hash is compared to the hash of the cached trace at the same position,
@@ -216,52 +344,239 @@ class Simulation:
         is aborted.
         """
         
-        # Compute the hash of the previous execution pair, if any
-        previous_hash = None
+        # Compute the hash of the previous execution node, if any
+        previous_hash = self._last_execution_node_hash()
 
         # Create a tuple of (hash, state) and append it to the execution_trace list
         self.execution_trace.append((previous_hash, event_hash, event_output, state))
 
-    def _add_to_cache_trace(self, state: dict, event_hash: int, event_output):
+    def _add_to_cache_trace(self, state: dict, event_hash: str, event_output):
         """
         Adds a state to the cached_trace list and computes the appropriate hash.
         """
-        # Compute the hash of the previous cached pair, if any
+        # Compute the hash of the previous cached node, if any
         previous_hash = None
         if self.cached_trace:
-            previous_hash = utils.custom_hash(self.cached_trace[-1])
+            previous_hash = self._node_hash(self.cached_trace[-1])
         
         # Create a tuple of (hash, state) and append it to the cached_trace list
         self.cached_trace.append((previous_hash, event_hash, event_output, state))
 
         self.has_unsaved_cache_changes = True
     
+    def _encode_trace_state(self, state: dict) -> dict:
+        """
+        Encodes the given complete state for the next position of the traces, either as a keyframe or as a delta
+        w.r.t. the current state.
+        """
+        if (len(self.cached_trace) % Simulation.KEYFRAME_INTERVAL == 0) or (self._current_state is None) or \
+           (self._current_state_position != self._execution_trace_position()):
+            return {"type": "keyframe", "state": state}
+        else:
+            return {"type": "delta", "delta": _state_delta(self._current_state, state)}
+
+    def _cached_state_at(self, position: int) -> dict:
+        """
+        Reconstructs the complete state at the given position of the cached trace, starting from the nearest
+        preceding keyframe. 
+        """
+        if _is_keyframe(self.cached_trace[position][3]):
+            return copy.deepcopy(_keyframe_state(self._cached_trace_state(position)))
+        
+        # when replaying the cache, states are reconstructed in sequence, so usually we only need to apply a single delta
+        elif (self._current_state is not None) and (self._current_state_position == position - 1):
+            return _apply_state_delta(copy.deepcopy(self._current_state), self._cached_trace_state(position)["delta"])
+        
+        else:
+            keyframe_position = position
+            while not _is_keyframe(self.cached_trace[keyframe_position][3]):
+                keyframe_position -= 1
+            
+            state = copy.deepcopy(_keyframe_state(self._cached_trace_state(keyframe_position)))
+            for i in range(keyframe_position + 1, position + 1):
+                state = _apply_state_delta(state, self._cached_trace_state(i)["delta"])
+            
+            return state
+    
+    def _cached_trace_state(self, position: int) -> dict:
+        """
+        Returns the (keyframe or delta) state stored at the given position of the cached trace, reading it 
+        from the cache file if it was not loaded yet.
+        """
+        trace_state = self.cached_trace[position][3]
+        if isinstance(trace_state, _LazyTraceState):
+            return trace_state.load()
+        else:
+            return trace_state
+
     def _load_cache_file(self, cache_path:str):
         """
-        Loads the cache file from the given path.
+        Loads the cache file from the given path. Files in the older format, with the whole trace in a single 
+        JSON document, are also supported (see _migrate_legacy_trace), and are rewritten in the current format 
+        at the next checkpoint.
         """
+        self.cached_trace = []
+        self._saved_cache_path = None
+        self._saved_trace_offsets = []
+
         try:
-            self.cached_trace = json.load(open(cache_path, "r"))
+            with open(cache_path, "rb") as f:
+                header = f.readline()
+                if self._is_cache_file_header(header):
+                    offsets = [len(header)]
+                    for line in f:
+                        # a node that was being written when the process was interrupted is incomplete, so we ignore it
+                        if not line.endswith(b"\n"):
+                            logger.warning(f"Ignoring incomplete trace node at the end of the cache file {cache_path}.")
+                            break
+
+                        # only the small part of the node needed to follow the trace is read now, the state is read when needed 
+                        head, _, state = line.rstrip(b"\n").partition(b"\t")
+                        prev_node_hash, event_hash, event_output, state_type = json.loads(head)
+                        lazy_state = _LazyTraceState(cache_path, offsets[-1] + len(head) + 1, len(state), state_type == "keyframe")
+                        
+                        self.cached_trace.append((prev_node_hash, event_hash, event_output, lazy_state))
+                        offsets.append(offsets[-1] + len(line))
+                    
+                    self._saved_cache_path = cache_path
+                    self._saved_trace_offsets = offsets
+                
+                else:
+                    f.seek(0)
+                    self.cached_trace = self._migrate_legacy_trace(json.load(f))
+                    self.has_unsaved_cache_changes = True
+
         except FileNotFoundError:
             logger.info(f"Cache file not found on path: {cache_path}.")
             self.cached_trace = []
         
     def _save_cache_file(self, cache_path:str):
         """
-        Saves the cache file to the given path. Always overwrites.
+        Saves the cache file to the given path. Only the trace nodes not saved yet are appended to the file, 
+        unless it must be written from scratch (e.g., because it is new or in an older format). If saving fails, 
+        the error is raised, and the next attempt will write the file from scratch.
         """
+        temp_name = None
         try:
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile('w', delete=False) as temp:
-                json.dump(self.cached_trace, temp, indent=4)
+            if (self._saved_cache_path == cache_path) and os.path.exists(cache_path):
+                with open(cache_path, "r+b") as f:
+                    # drop whatever follows the nodes that are still valid, and append the new ones
+                    f.truncate(self._saved_trace_offsets[-1])
+                    f.seek(self._saved_trace_offsets[-1])
+                    self._write_cache_file_nodes(f, start=len(self._saved_trace_offsets) - 1)
+                    
+                    f.flush()
+                    self._has_unsynced_cache_changes = True
+                    self._sync_cache_file(f)
+            
+            else:
+                # Create a temporary file, in the same directory so that it can replace the original one
+                with tempfile.NamedTemporaryFile('wb', delete=False, dir=os.path.dirname(os.path.abspath(cache_path))) as temp:
+                    temp_name = temp.name
+                    header = (json.dumps(Simulation.CACHE_FILE_HEADER) + "\n").encode("utf-8")
+                    temp.write(header)
+                    self._saved_trace_offsets = [len(header)]
+                    lazy_states = self._write_cache_file_nodes(temp, start=0)
+
+                    temp.flush()
+                    os.fsync(temp.fileno())
+
+                # Replace the original file with the temporary file
+                os.replace(temp.name, cache_path)
+                temp_name = None
+                self._saved_cache_path = cache_path
+
+                # states not loaded yet must now be read from their new locations
+                for i, lazy_state in lazy_states.items():
+                    self.cached_trace[i] = (*self.cached_trace[i][:3], lazy_state.relocated(cache_path))
 
-            # Replace the original file with the temporary file
-            os.replace(temp.name, cache_path)
         except Exception as e:
-            print(f"An error occurred: {e}")
+            logger.error(f"Could not save the cache file {cache_path}: {e}")
+
+            # we can no longer be sure of what is in the file, so the next checkpoint must rewrite it
+            self._saved_cache_path = None
+            self._saved_trace_offsets = []
+            if temp_name is not None and os.path.exists(temp_name):
+                os.remove(temp_name)
+
+            raise
 
         self.has_unsaved_cache_changes = False
 
+    def _write_cache_file_nodes(self, f, start:int) -> dict:
+        """
+        Writes the cached trace nodes from the given position onwards to the given binary file, one per line.
+        Each line holds the node's hashes, output and state type, followed by a tab and the state itself, so that 
+        the trace can be followed without reading the states.
+
+        Returns:
+            dict: The positions of the nodes whose states were not loaded, mapped to where these states were written.
+        """
+        lazy_states = {}
+        for i in range(start, len(self.cached_trace)):
+            prev_node_hash, event_hash, event_output, trace_state = self.cached_trace[i]
+
+            if isinstance(trace_state, _LazyTraceState):
+                # no need to parse the state, we just copy it
+                state = trace_state.read()
+            else:
+                state = json.dumps(trace_state).encode("utf-8")
+            
+            state_type = "keyframe" if _is_keyframe(trace_state) else "delta"
+            head = json.dumps([prev_node_hash, event_hash, event_output, state_type]).encode("utf-8")
+
+            f.write(head + b"\t" + state + b"\n")
+
+            if isinstance(trace_state, _LazyTraceState):
+                lazy_states[i] = _LazyTraceState(None, self._saved_trace_offsets[-1] + len(head) + 1, len(state), trace_state.is_keyframe)
+            self._saved_trace_offsets.append(self._saved_trace_offsets[-1] + len(head) + len(state) + 2)
+        
+        return lazy_states
+    
+    def _sync_cache_file(self, f=None, force:bool=False):
+        """
+        Makes sure the writes to the cache file reach the disk, which is done at most once every 
+        `CHECKPOINT_SYNC_INTERVAL` seconds, unless forced.
+        """
+        if not self._has_unsynced_cache_changes:
+            return
+        
+        if force or (time.monotonic() - self._last_cache_sync_time >= default["checkpoint_sync_interval"]):
+            if f is not None:
+                os.fsync(f.fileno())
+            else:
+                # Windows can only flush files opened for writing, and appending nothing leaves the file as it is
+                with open(self._saved_cache_path, "ab") as f:
+                    os.fsync(f.fileno())
+
+            self._has_unsynced_cache_changes = False
+            self._last_cache_sync_time = time.monotonic()
+
+    def _migrate_legacy_trace(self, trace:list) -> list:
+        """
+        Recomputes the hashes of a trace from a cache file in the older format, where events were identified by 
+        their whole string representation, and nodes were chained by hashing the whole previous node. Since cached 
+        nodes can only be used in order, the trace is cut at the first event that cannot be migrated, and the rest
+        will be executed again.
+        """
+        migrated_trace = []
+        for node in trace:
+            event_hash = _legacy_event_hash(node[1])
+            if event_hash is None:
+                logger.warning(f"Cannot migrate the event {node[1]} of the cached trace to the current format, so it will be executed again, along with the {len(trace) - len(migrated_trace) - 1} events after it.")
+                break
+
+            prev_node_hash = self._node_hash(migrated_trace[-1]) if migrated_trace else None
+            migrated_trace.append((prev_node_hash, event_hash, node[2], node[3]))
+        
+        return migrated_trace
+
+    def _is_cache_file_header(self, line:bytes) -> bool:
+        try:
+            return json.loads(line) == Simulation.CACHE_FILE_HEADER
+        except ValueError:
+            return False
+
     
 
     ###################################################################################################
@@ -436,8 +751,6 @@ class Transaction:
                 logger.info(f"Skipping execution of {self.function_name} with args {self.args} and kwargs {self.kwargs} because it is already cached.")
 
                 self.simulation._skip_execution_with_cache()
-                state = self.simulation.cached_trace[self.simulation._execution_trace_position()][3] # state
-                self.simulation._decode_simulation_state(state)
                 
                 # Output encoding/decoding is used to preserve references to TinyPerson and TinyWorld instances
                 # mainly. Scalar values (int, float, str, bool) and composite values (list, dict) are 
@@ -445,11 +758,18 @@ class Transaction:
                 encoded_output = self.simulation.cached_trace[self.simulation._execution_trace_position()][2] # output
                 output = self._decode_function_output(encoded_output)
 
+                # when fast-forwarding, objects given to the caller must nevertheless be up-to-date
+                if (encoded_output is not None) and (encoded_output["type"] != "JSON"):
+                    self.simulation._restore_pending_cached_state()
+
             else: # not cached
                 
                 # reentrant transactions are not cached, since what matters is the final result of
                 # the top-level transaction
                 if not self.simulation.is_under_transaction():
+                    # if we were fast-forwarding through the cache, the function must run on top of the latest cached state
+                    self.simulation._restore_pending_cached_state()
+
                     self.simulation.begin_transaction()
 
                     # immediately drop the cached trace suffix, since we are starting a new execution from this point on
@@ -460,9 +780,11 @@ class Transaction:
 
                     encoded_output = self._encode_function_output(output)
                     state = self.simulation._encode_simulation_state()
+                    trace_state = self.simulation._encode_trace_state(state)
                                   
-                    self.simulation._add_to_cache_trace(state, event_hash, encoded_output)
-                    self.simulation._add_to_execution_trace(state, event_hash, encoded_output)
+                    self.simulation._add_to_cache_trace(trace_state, event_hash, encoded_output)
+                    self.simulation._add_to_execution_trace(trace_state, event_hash, encoded_output)
+                    self.simulation._set_current_state(state, self.simulation._execution_trace_position())
 
                     self.simulation.end_transaction()
                 
@@ -542,8 +864,81 @@ def transactional(func):
         result = transaction.execute()
         return result
     
+    # calling a transactional method does not require the object to be up-to-date, in case the call is cached
+    wrapper._transactional = True
     return wrapper
 
+class _StaleEntity:
+    """
+    While fast-forwarding through the cache, the simulated entities (agents, environments and factories) are not
+    updated at each replayed transaction. Instead, their class is temporarily replaced by a subclass with this mixin, 
+    so that the pending cached state is restored as soon as they are used in any other way than to identify them or 
+    to call their transactional methods. Callers thus always see them up-to-date, and the arguments they build from 
+    them (thus the event hashes) are always right.
+    """
+
+    # the attributes that do not depend on the simulation state, so they can be used without restoring it
+    _safe_attributes = {"name", "simulation_id", "__class__"}
+
+    # the stale counterpart of each class
+    _stale_classes = {}
+    _stale_classes_lock = threading.Lock()
+
+    def __getattribute__(self, name):
+        if name not in _StaleEntity._safe_attributes and not getattr(getattr(type(self), name, None), "_transactional", False):
+            _StaleEntity._restore(self)
+
+        return object.__getattribute__(self, name)
+    
+    def __setattr__(self, name, value):
+        _StaleEntity._restore(self)
+        object.__setattr__(self, name, value)
+    
+    def __delattr__(self, name):
+        _StaleEntity._restore(self)
+        object.__delattr__(self, name)
+
+    @staticmethod
+    def mark(entity):
+        """
+        Marks the given entity as stale, i.e., as needing the pending cached state before being used.
+        """
+        cls = type(entity)
+        if issubclass(cls, _StaleEntity):
+            return
+        
+        with _StaleEntity._stale_classes_lock:
+            stale_cls = _StaleEntity._stale_classes.get(cls)
+            if stale_cls is None:
+                # subclasses of serializable classes register themselves, but the stale ones must never be deserialized
+                registered = utils.JsonSerializableRegistry.class_mapping.get(cls.__name__)
+                stale_cls = type(cls.__name__, (_StaleEntity, cls), {"__module__": cls.__module__, "__qualname__": cls.__qualname__})
+                if registered is not None:
+                    utils.JsonSerializableRegistry.class_mapping[cls.__name__] = registered
+                
+                _StaleEntity._stale_classes[cls] = stale_cls
+        
+        object.__setattr__(entity, "__class__", stale_cls)
+
+    @staticmethod
+    def unmark(entity):
+        """
+        Gives the given entity its original class back, if it was marked as stale.
+        """
+        cls = type(entity)
+        if issubclass(cls, _StaleEntity):
+            object.__setattr__(entity, "__class__", cls.__mro__[2])
+    
+    @staticmethod
+    def _restore(entity):
+        simulation = _current_simulations.get(object.__getattribute__(entity, "simulation_id"))
+        if simulation is not None:
+            simulation._restore_pending_cached_state()
+        
+        # just in case the entity is no longer part of its simulation
+        _StaleEntity.unmark(entity)
+
+
 class SkipTransaction(Exception):
     pass
 
@@ -560,6 +955,147 @@ class ExecutionCached(Exception):
     pass
 
 
+###################################################################################################
+# Trace states
+###################################################################################################
+
+class _LazyTraceState:
+    """
+    A trace state that was not loaded from the cache file yet. States are by far the largest part of the traces
+    and are only needed when the simulation state must be actually restored, so they are read on demand.
+    """
+
+    def __init__(self, path:str, offset:int, length:int, is_keyframe:bool):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.is_keyframe = is_keyframe
+    
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+    
+    def load(self) -> dict:
+        return json.loads(self.read())
+    
+    def relocated(self, path:str):
+        return _LazyTraceState(path, self.offset, self.length, self.is_keyframe)
+
+    def __repr__(self):
+        return f"_LazyTraceState(offset={self.offset}, length={self.length}, is_keyframe={self.is_keyframe})"
+
+def _is_keyframe(trace_state) -> bool:
+    if isinstance(trace_state, _LazyTraceState):
+        return trace_state.is_keyframe
+
+    # older cache files store the complete state directly, which amounts to a keyframe
+    return trace_state.get("type") != "delta"
+
+def _keyframe_state(trace_state: dict) -> dict:
+    if trace_state.get("type") == "keyframe":
+        return trace_state["state"]
+    else:
+        return trace_state
+
+def _state_delta(old, new):
+    """
+    Computes the delta that transforms the JSON-like value `old` into `new`, or None if they are the same. 
+    Dicts and lists are compared recursively, so that only the parts that actually changed are kept.
+    """
+    if (type(old) is type(new)) and (old == new):
+        return None
+    
+    elif isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key, value in new.items():
+            if key in old:
+                delta = _state_delta(old[key], value)
+                if delta is not None:
+                    changes[key] = delta
+            else:
+                changes[key] = {"set": value}
+
+        return {"dict": changes, "removed": [key for key in old if key not in new]}
+    
+    elif isinstance(old, list) and isinstance(new, list):
+        common_length = min(len(old), len(new))
+        changes = {}
+        for i in range(common_length):
+            delta = _state_delta(old[i], new[i])
+            if delta is not None:
+                changes[str(i)] = delta # JSON only allows string keys
+
+        return {"list": changes, "length": len(new), "extend": new[common_length:]}
+    
+    else:
+        return {"set": new}
+
+def _apply_state_delta(value, delta):
+    """
+    Applies a delta computed by `_state_delta` to the given value, which is modified in place when possible. 
+    Returns the resulting value.
+    """
+    if delta is None:
+        return value
+    
+    elif "set" in delta:
+        return copy.deepcopy(delta["set"])
+    
+    elif "dict" in delta:
+        for key, key_delta in delta["dict"].items():
+            value[key] = _apply_state_delta(value.get(key), key_delta)
+        for key in delta["removed"]:
+            del value[key]
+        
+        return value
+    
+    elif "list" in delta:
+        for i, item_delta in delta["list"].items():
+            value[int(i)] = _apply_state_delta(value[int(i)], item_delta)
+        del value[delta["length"] - len(delta["extend"]):]
+        value.extend(copy.deepcopy(delta["extend"]))
+
+        return value
+    
+    else:
+        raise ValueError(f"Invalid state delta: {delta}")
+
+
+def _legacy_event_hash(legacy_event:str) -> str:
+    """
+    Computes the current hash (see Simulation._function_call_hash) of an event in the older format, i.e., the string
+    representation of the (function name, arguments, keyword arguments) tuple. Returns None if the event cannot be 
+    parsed, e.g., because some argument was not a simulated entity, a literal value, or a date or time.
+    """
+    def aux_value(node):
+        if isinstance(node, ast.Call):
+            func = ast.unparse(node.func)
+            kwargs = {keyword.arg: aux_value(keyword.value) for keyword in node.keywords}
+
+            # simulated entities are represented as their names in both formats
+            if func in ["TinyPerson", "TinyWorld", "TinyFactory"] and list(kwargs.keys()) == ["name"]:
+                return f"{func}(name='{kwargs['name']}')"
+            elif func in ["datetime.datetime", "datetime.date", "datetime.timedelta"]:
+                constructor = getattr(datetime, func.split(".")[1])
+                return str(constructor(*[aux_value(arg) for arg in node.args], **kwargs))
+            else:
+                raise ValueError(f"Unsupported argument: {ast.unparse(node)}")
+        
+        elif isinstance(node, (ast.Tuple, ast.List)):
+            return [aux_value(element) for element in node.elts]
+        elif isinstance(node, ast.Dict):
+            return {aux_value(key): aux_value(value) for key, value in zip(node.keys, node.values)}
+        else:
+            return ast.literal_eval(node)
+    
+    try:
+        function_name, args, kwargs = aux_value(ast.parse(legacy_event, mode="eval").body)
+        return utils.canonical_hash([function_name, args, kwargs])
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+
 ###################################################################################################
 # Convenience functions
 ###################################################################################################
@@ -568,39 +1104,39 @@ def reset():
     """	
     Resets the entire simulation control state.
     """
-    global _current_simulations, _current_simulation_id
-    _current_simulations = {"default": None}
+    global _current_simulations
+    with _simulations_lock:
+        _current_simulations = {"default": None}
 
-    # TODO Currently, only one simulation can be started at a time. In future versions, this should be
-    #      changed to allow multiple simulations to be started at the same time, e.g., for fast
-    #      analyses through parallelization.
-    _current_simulation_id = None
+    _current_simulation_id.set(None)
 
 def _simulation(id="default"):
     global _current_simulations
-    if _current_simulations[id] is None:
-        _current_simulations[id] = Simulation()
+    with _simulations_lock:
+        if _current_simulations.get(id) is None:
+            _current_simulations[id] = Simulation(id=id)
     
-    return _current_simulations[id]
+        return _current_simulations[id]
 
-def begin(cache_path=None, id="default", auto_checkpoint=False):
+def begin(cache_path=None, id="default", auto_checkpoint=False, fast_forward=False):
     """
-    Marks the start of the simulation being controlled.
+    Marks the start of the simulation being controlled. The simulation becomes the current one in the 
+    calling context only (i.e., the current thread or asyncio task), so several simulations, with different 
+    ids, can run concurrently.
     """
-    global _current_simulation_id
-    if _current_simulation_id is None:
-        _simulation(id).begin(cache_path, auto_checkpoint)
-        _current_simulation_id = id
+    if _current_simulation_id.get() is None:
+        _simulation(id).begin(cache_path, auto_checkpoint, fast_forward)
+        _current_simulation_id.set(id)
     else:
-        raise ValueError(f"Simulation is already started under id {_current_simulation_id}. Currently only one simulation can be started at a time.")   
+        raise ValueError(f"Simulation is already started under id {_current_simulation_id.get()}. Only one simulation can be started at a time in each thread or asyncio task.")   
     
 def end(id="default"):
     """
     Marks the end of the simulation being controlled.
     """
-    global _current_simulation_id
     _simulation(id).end()
-    _current_simulation_id = None
+    if _current_simulation_id.get() == id:
+        _current_simulation_id.set(None)
 
 def checkpoint(id="default"):
     """
@@ -610,12 +1146,17 @@ def checkpoint(id="default"):
 
 def current_simulation():
     """
-    Returns the current simulation.
+    Returns the current simulation, in the calling context.
     """
-    global _current_simulation_id
-    if _current_simulation_id is not None:
-        return _simulation(_current_simulation_id)
+    id = _current_simulation_id.get()
+    if id is not None:
+        return _simulation(id)
     else:
         return None
+
+# The id of the current simulation is context-local: each thread and asyncio task has its own. Note that new 
+# threads start without any current simulation, while asyncio tasks inherit the one of their creator.
+_current_simulation_id = contextvars.ContextVar("tinytroupe_current_simulation_id", default=None)
+_simulations_lock = threading.Lock()
     
 reset() # initialize the control state
\ No newline at end of file
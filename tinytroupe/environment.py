@@ -6,7 +6,9 @@ agents interact with each other as well as external entities (e.g., search engin
 import logging
 logger = logging.getLogger("tinytroupe")
 import copy
+import contextvars
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from tinytroupe.agent import *
 from tinytroupe.utils import name_or_empty, pretty_datetime
@@ -67,18 +69,28 @@ class TinyWorld:
     # Simulation control methods
     #######################################################################
     @transactional
-    def _step(self, timedelta_per_step=None):
+    def _step(self, timedelta_per_step=None, parallelize=False, max_workers=None):
         """
         Performs a single step in the environment. This default implementation
         simply calls makes all agents in the environment act and properly
         handle the resulting actions. Subclasses might override this method to implement 
         different policies.
+
+        Args:
+            timedelta_per_step (timedelta, optional): The time interval to advance before the agents act. Defaults to None.
+            parallelize (bool, optional): If True, all agents act concurrently, and their actions are handled afterwards,
+              in the order in which the agents were added to the environment. Defaults to False.
+            max_workers (int, optional): The maximum number of agents acting at the same time when parallelizing. 
+              Defaults to None, which means that all agents act at once.
         """
         # increase current datetime if timedelta is given. This must happen before
         # any other simulation updates, to make sure that the agents are acting
         # in the correct time, particularly if only one step is being run.
         self._advance_datetime(timedelta_per_step)
 
+        if parallelize:
+            return self._step_in_parallel(max_workers=max_workers)
+
         # agents can act
         agents_actions = {}
         for agent in self.agents:
@@ -90,6 +102,45 @@ class TinyWorld:
         
         return agents_actions
 
+    def _step_in_parallel(self, max_workers=None):
+        """
+        Makes all agents act concurrently and only then handles the resulting actions. Since the actions are handled
+        sequentially and always in the same order (i.e., the order of the agents in the environment), the effects 
+        on the environment are deterministic, even if the agents finish acting in arbitrary order. Note that, as a consequence,
+        agents do not perceive the actions of others until the next step.
+
+        Args:
+            max_workers (int, optional): The maximum number of agents acting at the same time. Defaults to None, 
+              which means that all agents act at once.
+        
+        Returns:
+            dict: The actions taken by each agent, keyed by agent name.
+        """
+        if len(self.agents) == 0:
+            return {}
+
+        if max_workers is None:
+            max_workers = len(self.agents)
+
+        # agents can act, all at the same time
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{self.name} step") as executor:
+            futures = []
+            for agent in self.agents:
+                logger.debug(f"[{self.name}] Agent {name_or_empty(agent)} is acting (in parallel).")
+                # each agent acts within the context of the caller (e.g., under the same current simulation)
+                futures.append(executor.submit(contextvars.copy_context().run, agent.act, return_actions=True))
+            
+            # results are collected in the order of the agents, not of completion
+            agents_actions = {}
+            for agent, future in zip(self.agents, futures):
+                agents_actions[agent.name] = future.result()
+
+        # actions are handled in a fixed order
+        for agent in self.agents:
+            self._handle_actions(agent, agent.pop_latest_actions())
+        
+        return agents_actions
+
     def _advance_datetime(self, timedelta):
         """
         Advances the current datetime of the environment by the specified timedelta.
@@ -103,7 +154,7 @@ class TinyWorld:
             logger.info(f"[{self.name}] No timedelta provided, so the datetime was not advanced.")
 
     @transactional
-    def run(self, steps: int, timedelta_per_step=None, return_actions=False):
+    def run(self, steps: int, timedelta_per_step=None, return_actions=False, parallelize=False, max_workers=None):
         """
         Runs the environment for a given number of steps.
 
@@ -111,6 +162,8 @@ class TinyWorld:
             steps (int): The number of steps to run the environment for.
             timedelta_per_step (timedelta, optional): The time interval between steps. Defaults to None.
             return_actions (bool, optional): If True, returns the actions taken by the agents. Defaults to False.
+            parallelize (bool, optional): If True, agents act concurrently within each step. Defaults to False.
+            max_workers (int, optional): The maximum number of agents acting at the same time when parallelizing. Defaults to None.
         
         Returns:
             list: A list of actions taken by the agents over time, if return_actions is True. The list has this format:
@@ -123,7 +176,7 @@ class TinyWorld:
             if TinyWorld.communication_display:
                 self._display_communication(cur_step=i+1, total_steps=steps, kind='step', timedelta_per_step=timedelta_per_step)
 
-            agents_actions = self._step(timedelta_per_step=timedelta_per_step)
+            agents_actions = self._step(timedelta_per_step=timedelta_per_step, parallelize=parallelize, max_workers=max_workers)
             agents_actions_over_time.append(agents_actions)
         
         if return_actions:
@@ -632,10 +685,11 @@ class TinyWorld:
         Adds an environment to the list of all environments. Environment names must be unique,
         so if an environment with the same name already exists, an error is raised.
         """
-        if environment.name in TinyWorld.all_environments:
+        all_environments = TinyWorld._environments_registry()
+        if environment.name in all_environments:
             raise ValueError(f"Environment names must be unique, but '{environment.name}' is already defined.")
         else:
-            TinyWorld.all_environments[environment.name] = environment
+            all_environments[environment.name] = environment
         
 
     @staticmethod
@@ -644,7 +698,7 @@ class TinyWorld:
         Sets the simulation if it is None. This allows free environments to be captured by specific simulation scopes
         if desired.
         """
-        for environment in TinyWorld.all_environments.values():
+        for environment in TinyWorld._environments_registry().values():
             if environment.simulation_id is None:
                 simulation.add_environment(environment)
     
@@ -660,8 +714,9 @@ class TinyWorld:
         Returns:
             TinyWorld: The environment with the specified name.
         """
-        if name in TinyWorld.all_environments:
-            return TinyWorld.all_environments[name]
+        all_environments = TinyWorld._environments_registry()
+        if name in all_environments:
+            return all_environments[name]
         else:
             return None
     
@@ -670,7 +725,18 @@ class TinyWorld:
         """
         Clears the list of all environments.
         """
-        TinyWorld.all_environments = {}
+        TinyWorld._environments_registry().clear()
+
+    @staticmethod
+    def _environments_registry() -> dict:
+        """
+        Returns the environments registry in scope: the one of the current simulation, if any, or the global one otherwise.
+        """
+        simulation = control.current_simulation()
+        if simulation is not None:
+            return simulation.all_environments
+        else:
+            return TinyWorld.all_environments
 
 class TinySocialNetwork(TinyWorld):
 
@@ -732,11 +798,11 @@ class TinySocialNetwork(TinyWorld):
                 agent_2.make_agent_accessible(agent_1)
 
     @transactional
-    def _step(self):
+    def _step(self, timedelta_per_step=None, parallelize=False, max_workers=None):
         self._update_agents_contexts()
 
         #call super
-        super()._step()
+        return super()._step(timedelta_per_step=timedelta_per_step, parallelize=parallelize, max_workers=max_workers)
     
     @transactional
     def _handle_reach_out(self, source_agent: TinyPerson, content: str, target: str):
@@ -1,6 +1,14 @@
+import os
 import random
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import logging
+logger = logging.getLogger("tinytroupe")
+
 from tinytroupe.agent import TinyPerson
+from tinytroupe import control
+from tinytroupe import openai_utils
 
 class ABRandomizer():
 
@@ -184,3 +192,115 @@ class Intervention:
             effect (str): the effect function of the intervention
         """
         self.effect_func = effect_func
+
+
+class SimulationBatchRunner:
+
+    def __init__(self, scenario:callable, parameterizations:list, cache_folder:str="./tinytroupe-batch", 
+                 max_workers:int=None, max_retries:int=2):
+        """
+        Runs many variants of the same scenario (e.g., with different ads, prompts or agent mixes), in parallel, 
+        each in its own process. Each variant has its own simulation cache file and API cache, so if a variant 
+        fails (e.g., because its process crashed), it is resumed from where it was, instead of starting over.
+
+        Args:
+            scenario (callable): a function that sets up and runs the scenario for the given parameters, passed
+              as keyword arguments, and returns its results (e.g., the outputs of a ResultsExtractor). Since it 
+              runs in another process, it must be picklable (e.g., a module-level function), and so must its results.
+            parameterizations (list): a list of dicts, each with the parameters of one variant.
+            cache_folder (str): the folder where the cache files of the variants are kept.
+            max_workers (int): the maximum number of variants running at the same time. Defaults to the number of CPUs.
+            max_retries (int): how many times a failed variant is retried.
+        """
+        self.scenario = scenario
+        self.parameterizations = parameterizations
+        self.cache_folder = cache_folder
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+        # the errors of the variants that could not be completed, by variant index
+        self.failures = {}
+    
+    def run(self):
+        """
+        Runs all variants, yielding their results as they finish, not necessarily in order.
+
+        Yields:
+            tuple: the index of the variant (in the list of parameterizations) and its results.
+        """
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.failures = {}
+
+        attempts = {i: 0 for i in range(len(self.parameterizations))}
+        pending = list(attempts.keys())
+
+        # when a worker process crashes, all variants still running in the pool fail along with it, so we can't tell
+        # which one crashed. These variants are then run one at a time, which is only charged to the one that crashes.
+        suspects = []
+
+        def aux_charge_failure(i, e):
+            attempts[i] += 1
+            if isinstance(e, BrokenProcessPool):
+                logger.warning(f"Variant {i} crashed its worker process (attempt {attempts[i]}).")
+            else:
+                logger.warning(f"Variant {i} failed (attempt {attempts[i]}): {e}")
+
+            if attempts[i] <= self.max_retries:
+                pending.append(i)
+            else:
+                logger.error(f"Variant {i} failed after {attempts[i]} attempts, giving up.")
+                self.failures[i] = e
+
+        while len(pending) > 0 or len(suspects) > 0:
+            if len(suspects) > 0:
+                batch = [suspects.pop(0)]
+            else:
+                batch, pending = pending, []
+
+            # if a worker process crashes, the whole pool becomes unusable, so we need a new one for the retries
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(_run_scenario_variant, self.scenario, self.parameterizations[i], 
+                                           *self.cache_paths(i)): i for i in batch}
+
+                crashed = {}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        crashed[i] = e
+                    except Exception as e:
+                        aux_charge_failure(i, e)
+                    else:
+                        yield i, result
+            
+            # the variant that crashed is necessarily among those interrupted, so if there's only one, it is the culprit
+            if len(crashed) == 1:
+                i, e = crashed.popitem()
+                aux_charge_failure(i, e)
+            elif len(crashed) > 1:
+                logger.warning(f"Variants {sorted(crashed.keys())} were interrupted by a crashed worker process, running them one at a time to find out which one crashed.")
+                suspects.extend(sorted(crashed.keys()))
+    
+    def cache_paths(self, i:int) -> tuple:
+        """
+        Returns the paths of the simulation cache file and of the API cache file of the i-th variant.
+        """
+        return (os.path.join(self.cache_folder, f"tinytroupe-cache-variant_{i}.json"), 
+                os.path.join(self.cache_folder, f"openai_api_cache-variant_{i}.sqlite"))
+
+def _run_scenario_variant(scenario:callable, parameters:dict, cache_path:str, api_cache_path:str):
+    """
+    Runs one variant of a scenario in the current (worker) process, under its own simulation, which is checkpointed 
+    at every transaction, so that it can be resumed later. Resumed simulations are not fast-forwarded, because 
+    scenarios usually inspect the simulated entities directly to produce their results.
+    """
+    openai_utils.force_api_cache(True, api_cache_path)
+
+    # worker processes are reused, so we must start from a clean slate
+    control.reset()
+    control.begin(cache_path, auto_checkpoint=True)
+    try:
+        return scenario(**parameters)
+    finally:
+        control.end()
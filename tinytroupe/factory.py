@@ -8,7 +8,7 @@ logger = logging.getLogger("tinytroupe")
 from tinytroupe import openai_utils
 from tinytroupe.agent import TinyPerson
 import tinytroupe.utils as utils
-from tinytroupe.control import transactional
+from tinytroupe.control import transactional, current_simulation
 
 class TinyFactory:
     """
@@ -40,7 +40,7 @@ class TinyFactory:
         Sets the simulation if it is None. This allows free environments to be captured by specific simulation scopes
         if desired.
         """
-        for factory in TinyFactory.all_factories.values():
+        for factory in TinyFactory._factories_registry().values():
             if factory.simulation_id is None:
                 simulation.add_factory(factory)
 
@@ -50,17 +50,40 @@ class TinyFactory:
         Adds a factory to the list of all factories. Factory names must be unique,
         so if an factory with the same name already exists, an error is raised.
         """
-        if factory.name in TinyFactory.all_factories:
+        all_factories = TinyFactory._factories_registry()
+        if factory.name in all_factories:
             raise ValueError(f"Factory names must be unique, but '{factory.name}' is already defined.")
         else:
-            TinyFactory.all_factories[factory.name] = factory
+            all_factories[factory.name] = factory
     
+    @staticmethod
+    def get_factory_by_name(name: str):
+        """
+        Returns the factory with the specified name, or None if there is no such factory.
+        """
+        all_factories = TinyFactory._factories_registry()
+        if name in all_factories:
+            return all_factories[name]
+        else:
+            return None
+
     @staticmethod
     def clear_factories():
         """
         Clears the global list of all factories.
         """
-        TinyFactory.all_factories = {}
+        TinyFactory._factories_registry().clear()
+
+    @staticmethod
+    def _factories_registry() -> dict:
+        """
+        Returns the factories registry in scope: the one of the current simulation, if any, or the global one otherwise.
+        """
+        simulation = current_simulation()
+        if simulation is not None:
+            return simulation.all_factories
+        else:
+            return TinyFactory.all_factories
 
     ################################################################################################
     # Caching mechanisms
@@ -222,11 +245,8 @@ class TinyPersonFactory(TinyFactory):
         """
         Sets up the agent with the necessary elements.
         """
-        for key, value in configuration.items():
-            if isinstance(value, list):
-                agent.define_several(key, value)
-            else:
-                agent.define(key, value)
+        # everything is defined at once, so that the agent's prompt is reset only once
+        agent.define_many(configuration)
         
         # does not return anything, as we don't want to cache the agent object itself.
     
@@ -1,12 +1,23 @@
 import os
+import ast
 import openai
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI, DefaultAsyncHttpxClient
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+import httpx
+import asyncio
 import time
 import json
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager, asynccontextmanager
 import pickle
+import sqlite3
+import array
 import logging
 import configparser
 import tiktoken
+from llama_index.core.storage.kvstore.types import BaseKVStore
 from tinytroupe import utils
 
 logger = logging.getLogger("tinytroupe")
@@ -29,11 +40,16 @@ default["timeout"] = float(config["OpenAI"].get("TIMEOUT", "30.0"))
 default["max_attempts"] = float(config["OpenAI"].get("MAX_ATTEMPTS", "0.0"))
 default["waiting_time"] = float(config["OpenAI"].get("WAITING_TIME", "0.5"))
 default["exponential_backoff_factor"] = float(config["OpenAI"].get("EXPONENTIAL_BACKOFF_FACTOR", "5"))
+default["max_connections"] = int(config["OpenAI"].get("MAX_CONNECTIONS", "32"))
+default["max_requests_per_minute"] = int(config["OpenAI"].get("MAX_REQUESTS_PER_MINUTE", "0"))
+default["max_tokens_per_minute"] = int(config["OpenAI"].get("MAX_TOKENS_PER_MINUTE", "0"))
+default["max_concurrent_requests"] = int(config["OpenAI"].get("MAX_CONCURRENT_REQUESTS", "0"))
 
 default["embedding_model"] = config["OpenAI"].get("EMBEDDING_MODEL", "text-embedding-3-small")
 
 default["cache_api_calls"] = config["OpenAI"].getboolean("CACHE_API_CALLS", False)
-default["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "openai_api_cache.pickle")
+default["cache_file_name"] = config["OpenAI"].get("CACHE_FILE_NAME", "openai_api_cache.sqlite")
+default["cache_readable_requests"] = config["OpenAI"].getboolean("CACHE_READABLE_REQUESTS", False)
 
 ###########################################################################
 # Model calling helpers
@@ -73,6 +89,459 @@ class LLMCall:
         return f"LLMCall(messages={self.messages}, model_config={self.model_config}, model_output={self.model_output})"
 
 
+###########################################################################
+# API cache
+###########################################################################
+
+# Identifies how cache keys are computed, so that caches using other formats can be migrated.
+CACHE_KEY_FORMAT = "sha256-canonical-json-v1"
+
+_missing = object() # sentinel for cache misses, since None could be a legitimate cached value
+
+class ApiCache:
+    """
+    An on-disk cache of API responses, backed by SQLite. Contrary to pickling the whole cache at once, 
+    each new entry is written on its own, entries are only read when looked up, and several processes can 
+    read the same cache file while another one writes to it. Values are pickled, because some response 
+    objects are not JSON serializable.
+    """
+
+    def __init__(self, file_name:str) -> None:
+        """
+        Opens (or creates) the cache stored in the given file.
+
+        Args:
+        file_name (str): The name of the SQLite file used to store the cache.
+        """
+        self.file_name = file_name
+
+        # the same connection is shared by all threads, so we serialize access to it
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_name, timeout=60, check_same_thread=False, isolation_level=None)
+
+        with self._lock:
+            # write-ahead logging allows readers to proceed concurrently with a writer, and makes writes crash-safe
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS api_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, request TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+
+            # caches created before requests could be kept need the extra column
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(api_cache)")]
+            if "request" not in columns:
+                self._connection.execute("ALTER TABLE api_cache ADD COLUMN request TEXT")
+    
+    def get(self, key, default=None):
+        """
+        Returns the value cached under the given key, or the specified default if there's none.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM api_cache WHERE key = ?", (key,)).fetchone()
+        
+        return pickle.loads(row[0]) if row is not None else default
+
+    def get_many(self, keys:list) -> dict:
+        """
+        Returns the values cached under the given keys, all at once. Keys without a cached value are left out.
+        """
+        keys = list(keys)
+        rows = []
+        with self._lock:
+            # SQLite limits the number of parameters of each statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows += self._connection.execute(f"SELECT key, value FROM api_cache WHERE key IN ({', '.join('?' * len(chunk))})", 
+                                                 chunk).fetchall()
+        
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, request:str=None):
+        """
+        Caches the given value under the given key.
+
+        Args:
+        key (str): The key of the entry.
+        value: The value to cache.
+        request (str, optional): A human-readable description of the request that produced the value, for inspection purposes.
+        """
+        blob = pickle.dumps(value)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO api_cache (key, value, request) VALUES (?, ?, ?)", (key, blob, request))
+    
+    def delete(self, key) -> bool:
+        """
+        Removes the entry cached under the given key, if any, and tells whether there was one.
+        """
+        with self._lock:
+            return self._connection.execute("DELETE FROM api_cache WHERE key = ?", (key,)).rowcount > 0
+
+    def get_request(self, key) -> str:
+        """
+        Returns the human-readable request stored for the given key, if any.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT request FROM api_cache WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM api_cache WHERE key = ?", (key,)).fetchone() is not None
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM api_cache").fetchone()[0]
+    
+    def keys(self) -> list:
+        """
+        Returns all the cached keys.
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT key FROM api_cache")]
+    
+    def requests(self) -> dict:
+        """
+        Returns the human-readable requests of all the entries that have one, by key.
+        """
+        with self._lock:
+            return dict(self._connection.execute("SELECT key, request FROM api_cache WHERE request IS NOT NULL").fetchall())
+
+    def update(self, entries:dict):
+        """
+        Adds the given entries to the cache, all at once.
+        """
+        rows = [(key, pickle.dumps(value)) for key, value in entries.items()]
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany("INSERT OR REPLACE INTO api_cache (key, value) VALUES (?, ?)", rows)
+    
+    def rekey(self, key_function, keep_old_key_as_request:bool=False) -> int:
+        """
+        Changes the keys of all entries, all at once.
+
+        Args:
+        key_function (callable): Maps an old key to the new one, or to None if the entry should be left as is.
+        keep_old_key_as_request (bool): Whether to keep the old key as the human-readable request of the entry.
+
+        Returns:
+        The number of changed entries.
+        """
+        changed = 0
+        with self._lock:
+            old_keys = [row[0] for row in self._connection.execute("SELECT key FROM api_cache")]
+            with self._connection:
+                self._connection.execute("BEGIN")
+                for old_key in old_keys:
+                    new_key = key_function(old_key)
+                    if new_key is not None and new_key != old_key:
+                        if keep_old_key_as_request:
+                            self._connection.execute("UPDATE OR REPLACE api_cache SET key = ?, request = ? WHERE key = ?", (new_key, old_key, old_key))
+                        else:
+                            self._connection.execute("UPDATE OR REPLACE api_cache SET key = ? WHERE key = ?", (new_key, old_key))
+                        changed += 1
+        
+        return changed
+
+    def get_metadata(self, name:str) -> str:
+        """
+        Returns the value of the given metadata entry, or None if there's none.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM metadata WHERE name = ?", (name,)).fetchone()
+        
+        return row[0] if row is not None else None
+    
+    def set_metadata(self, name:str, value:str):
+        """
+        Sets the value of the given metadata entry.
+        """
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", (name, value))
+
+    def import_pickle(self, pickle_file_name:str) -> int:
+        """
+        Imports the entries of a legacy, whole-file, pickled cache.
+
+        Args:
+        pickle_file_name (str): The name of the pickle file to import.
+
+        Returns:
+        The number of imported entries.
+        """
+        with open(pickle_file_name, "rb") as f:
+            entries = pickle.load(f)
+
+        self.update(entries)
+        logger.info(f"Imported {len(entries)} entries from legacy API cache {pickle_file_name} into {self.file_name}.")
+        return len(entries)
+
+    def close(self):
+        """
+        Closes the underlying database connection.
+        """
+        with self._lock:
+            self._connection.close()
+
+
+class EmbeddingCache(BaseKVStore):
+    """
+    An on-disk, content-addressed cache of embeddings, keyed by the embedding model and a digest of the embedded text.
+    It is a llama-index key-value store, meant to be used as the `embeddings_cache` of llama-index embedding models, 
+    so that the same texts (e.g., the chunks of the same documents) are embedded only once, no matter how many agents
+    index them, nor in how many runs. Embeddings are kept in double precision, exactly as the model gave them, so that 
+    cached and fresh embeddings give the very same similarities. The underlying file is only opened when first used.
+    """
+
+    def __init__(self, file_name:str, model:str) -> None:
+        """
+        Prepares a cache for the embeddings of the given model, stored in the given file.
+
+        Args:
+        file_name (str): The name of the SQLite file used to store the cache. Several models can share the same file.
+        model (str): The name of the embedding model.
+        """
+        self.file_name = file_name
+        self.model = model
+
+        self._cache = None
+        self._lock = threading.Lock()
+    
+    def get_embedding(self, text:str) -> list:
+        """
+        Returns the cached embedding of the given text, or None if there's none.
+        """
+        return EmbeddingCache._decoded(self._ensure_cache().get(self._key(text)))
+    
+    def put_embedding(self, text:str, embedding:list):
+        """
+        Caches the embedding of the given text, along with the text itself, so that entries can be listed.
+        """
+        self._ensure_cache().put(self._key(text), array.array("d", embedding), 
+                                 request=json.dumps({"model": self.model, "text": text}))
+
+    def get_all_embeddings(self) -> dict:
+        """
+        Returns all the cached embeddings of this cache's model, by text. Embeddings cached by older versions, 
+        which did not keep the texts, cannot be listed.
+        """
+        texts = {}
+        for key, request in self._ensure_cache().requests().items():
+            try:
+                entry = json.loads(request)
+            except ValueError:
+                continue
+
+            if isinstance(entry, dict) and entry.get("model") == self.model and "text" in entry:
+                texts[key] = entry["text"]
+        
+        values = self._ensure_cache().get_many(texts.keys())
+        return {texts[key]: EmbeddingCache._decoded(value) for key, value in values.items()}
+
+    def close(self):
+        """
+        Closes the underlying cache, if it was ever opened.
+        """
+        with self._lock:
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+    def _key(self, text:str) -> str:
+        return utils.canonical_hash([self.model, text])
+
+    @staticmethod
+    def _decoded(value) -> list:
+        if value is None:
+            return None
+        
+        # older versions kept the raw bytes of float32 embeddings
+        if isinstance(value, bytes):
+            return array.array("f", value).tolist()
+        
+        return value.tolist()
+
+    def _ensure_cache(self) -> ApiCache:
+        with self._lock:
+            if self._cache is None:
+                self._cache = ApiCache(self.file_name)
+            
+            return self._cache
+
+    #
+    # The key-value store interface used by llama-index, whose keys are the embedded texts and whose values 
+    # map some id to the embedding. Collections are ignored, since keys already tell the models apart.
+    #
+
+    def get(self, key:str, collection:str=None) -> dict:
+        embedding = self.get_embedding(key)
+        return {self._key(key): embedding} if embedding is not None else None
+
+    def put(self, key:str, val:dict, collection:str=None):
+        for embedding in val.values():
+            self.put_embedding(key, embedding)
+
+    def delete(self, key:str, collection:str=None) -> bool:
+        return self._ensure_cache().delete(self._key(key))
+
+    def get_all(self, collection:str=None) -> dict:
+        return {text: {self._key(text): embedding} for text, embedding in self.get_all_embeddings().items()}
+
+    async def aget(self, key:str, collection:str=None) -> dict:
+        return self.get(key, collection)
+
+    async def aput(self, key:str, val:dict, collection:str=None):
+        self.put(key, val, collection)
+
+    async def adelete(self, key:str, collection:str=None) -> bool:
+        return self.delete(key, collection)
+
+    async def aget_all(self, collection:str=None) -> dict:
+        return self.get_all(collection)
+
+
+###########################################################################
+# Rate limiting
+###########################################################################
+
+class RateLimiter:
+    """
+    A client-side rate limiter, shared by all clients, that keeps requests within the configured quotas 
+    before they are sent, instead of waiting for the provider to reject them. It combines two token buckets
+    (one for requests, one for LLM tokens, both refilled continuously over a minute) with a bound on the number of 
+    requests in flight. Limits set to None (or 0) are not enforced.
+    """
+
+    # how often to check again for free capacity, in seconds
+    POLLING_INTERVAL = 0.05
+
+    def __init__(self, requests_per_minute:int=None, tokens_per_minute:int=None, max_concurrent_requests:int=None) -> None:
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.configure(requests_per_minute, tokens_per_minute, max_concurrent_requests)
+    
+    def configure(self, requests_per_minute:int=None, tokens_per_minute:int=None, max_concurrent_requests:int=None):
+        """
+        Sets the limits to enforce. Buckets start full.
+
+        Args:
+        requests_per_minute (int): The maximum number of requests per minute.
+        tokens_per_minute (int): The maximum number of tokens (prompt plus requested completion) per minute.
+        max_concurrent_requests (int): The maximum number of requests in flight at the same time.
+        """
+        with self._lock:
+            self.requests_per_minute = requests_per_minute or None
+            self.tokens_per_minute = tokens_per_minute or None
+            self.max_concurrent_requests = max_concurrent_requests or None
+
+            self._available_requests = self.requests_per_minute
+            self._available_tokens = self.tokens_per_minute
+            self._last_refill = time.monotonic()
+    
+    def is_enabled(self) -> bool:
+        return (self.requests_per_minute is not None) or (self.tokens_per_minute is not None) or \
+               (self.max_concurrent_requests is not None)
+
+    def _try_acquire(self, tokens:int) -> float:
+        """
+        Tries to reserve capacity for one request with the given number of tokens. 
+
+        Returns:
+        0 if the capacity was reserved, otherwise the number of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_refill
+            self._last_refill = now
+
+            # refill the buckets
+            if self.requests_per_minute is not None:
+                self._available_requests = min(self.requests_per_minute, self._available_requests + elapsed * self.requests_per_minute / 60.0)
+            if self.tokens_per_minute is not None:
+                # a single request larger than the whole bucket can never fit, so we just wait for a full bucket
+                tokens = min(tokens, self.tokens_per_minute)
+                self._available_tokens = min(self.tokens_per_minute, self._available_tokens + elapsed * self.tokens_per_minute / 60.0)
+
+            # how long until there's enough capacity?
+            wait = 0.0
+            if self.max_concurrent_requests is not None and self._in_flight >= self.max_concurrent_requests:
+                wait = max(wait, RateLimiter.POLLING_INTERVAL)
+            if self.requests_per_minute is not None and self._available_requests < 1:
+                wait = max(wait, (1 - self._available_requests) * 60.0 / self.requests_per_minute)
+            if self.tokens_per_minute is not None and self._available_tokens < tokens:
+                wait = max(wait, (tokens - self._available_tokens) * 60.0 / self.tokens_per_minute)
+            
+            if wait > 0:
+                return wait
+            
+            # enough capacity, so we take it
+            if self.requests_per_minute is not None:
+                self._available_requests -= 1
+            if self.tokens_per_minute is not None:
+                self._available_tokens -= tokens
+            self._in_flight += 1
+
+            return 0.0
+    
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+    
+    @contextmanager
+    def limit(self, tokens:int=0):
+        """
+        Blocks until there's capacity for one request with the given number of tokens, and holds an
+        in-flight slot until the context is exited.
+        """
+        if not self.is_enabled():
+            yield
+            return
+        
+        wait = self._try_acquire(tokens)
+        while wait > 0:
+            logger.debug(f"Rate limiter: waiting {wait:.2f} seconds for capacity.")
+            time.sleep(wait)
+            wait = self._try_acquire(tokens)
+        
+        try:
+            yield
+        finally:
+            self._release()
+    
+    @asynccontextmanager
+    async def limit_async(self, tokens:int=0):
+        """
+        Asynchronous counterpart of `limit`, which does not block the event loop while waiting.
+        """
+        if not self.is_enabled():
+            yield
+            return
+        
+        wait = self._try_acquire(tokens)
+        while wait > 0:
+            logger.debug(f"Rate limiter: waiting {wait:.2f} seconds for capacity.")
+            await asyncio.sleep(wait)
+            wait = self._try_acquire(tokens)
+        
+        try:
+            yield
+        finally:
+            self._release()
+
+# the rate limiter shared by all clients
+_rate_limiter = RateLimiter(requests_per_minute=default["max_requests_per_minute"],
+                            tokens_per_minute=default["max_tokens_per_minute"],
+                            max_concurrent_requests=default["max_concurrent_requests"])
+
+
 ###########################################################################
 # Client class
 ###########################################################################
@@ -82,10 +551,25 @@ class OpenAIClient:
     A utility class for interacting with the OpenAI API.
     """
 
+    # how many times errors for which the provider did not push back are retried right away, without waiting
+    MAX_IMMEDIATE_RETRIES = 2
+
+    # the tokenizer and message overheads of each model (or None, if its tokens cannot be counted), shared by all clients
+    _token_counting_schemes = {}
+
     def __init__(self, cache_api_calls=default["cache_api_calls"], cache_file_name=default["cache_file_name"]) -> None:
         logger.debug("Initializing OpenAIClient")
 
+        # the underlying SDK clients are created lazily and then reused, so that HTTP connections are kept alive
+        self.client = None
+        self.async_client = None
+        self._async_client_loop = None # async HTTP connections are bound to the event loop that created them
+
+        # all clients share the same quotas, so they share the same rate limiter
+        self.rate_limiter = _rate_limiter
+
         # should we cache api calls and reuse them?
+        self.api_cache = None
         self.set_api_cache(cache_api_calls, cache_file_name)
     
     def set_api_cache(self, cache_api_calls, cache_file_name=default["cache_file_name"]):
@@ -97,8 +581,14 @@ class OpenAIClient:
         """
         self.cache_api_calls = cache_api_calls
         self.cache_file_name = cache_file_name
+
+        # the previous cache, if any, is no longer used, so its connection must not be left open
+        if self.api_cache is not None:
+            self.api_cache.close()
+            self.api_cache = None
+
         if self.cache_api_calls:
-            # load the cache, if any
+            # open the cache, if any. Entries are loaded only when needed.
             self.api_cache = self._load_cache()
     
     
@@ -107,6 +597,71 @@ class OpenAIClient:
         Sets up the OpenAI API configurations for this client.
         """
         self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    
+    def _setup_async_from_config(self):
+        """
+        Sets up the asynchronous OpenAI API configurations for this client. A single connection pool,
+        bounded by the MAX_CONNECTIONS configuration, is shared by all asynchronous calls.
+        """
+        self.async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                        http_client=self._async_http_client())
+
+    def _async_http_client(self):
+        """
+        Returns a new asynchronous HTTP client, with a bounded connection pool.
+        """
+        return DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=default["max_connections"],
+                                                           max_keepalive_connections=default["max_connections"]))
+
+    def _ensure_client(self):
+        """
+        Makes sure the synchronous SDK client is set up, reusing it if it already exists.
+        """
+        if self.client is None:
+            self._setup_from_config()
+    
+    def _ensure_async_client(self):
+        """
+        Makes sure the asynchronous SDK client is set up for the running event loop, reusing it if it already exists.
+        """
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self._async_client_loop is not loop:
+            if self.async_client is not None:
+                self._discard_async_client()
+            
+            self._setup_async_from_config()
+            self._async_client_loop = loop
+
+    def _discard_async_client(self):
+        """
+        Drops the asynchronous SDK client of another event loop, closing its connections in that loop if it is still running.
+        """
+        async_client, loop = self.async_client, self._async_client_loop
+        self.async_client = None
+        self._async_client_loop = None
+
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(async_client.close(), loop)
+        else:
+            logger.warning(f"The asynchronous connections of {self.__class__.__name__} were left open by an event loop that is no longer running. "
+                           "Await openai_utils.aclose_clients() before closing event loops to release them.")
+
+    async def aclose(self):
+        """
+        Closes the asynchronous SDK client, along with its connection pool. It must be awaited in the event loop 
+        that used the client, before that loop closes. If the client is used again, a new one is set up.
+        """
+        if self.async_client is None:
+            return
+        
+        if self._async_client_loop is asyncio.get_running_loop():
+            async_client = self.async_client
+            self.async_client = None
+            self._async_client_loop = None
+
+            await async_client.close()
+        else:
+            self._discard_async_client()
 
     def send_message(self,
                     current_messages,
@@ -122,7 +677,9 @@ class OpenAIClient:
                      waiting_time=default["waiting_time"],
                      exponential_backoff_factor=default["exponential_backoff_factor"],
                      n = 1,
-                     echo=False):
+                     echo=False,
+                     stream_handler=None,
+                     response_format=None):
         """
         Sends a message to the OpenAI API and returns the response.
 
@@ -137,47 +694,42 @@ class OpenAIClient:
         stop (str): A string that, if encountered in the generated response, will cause the generation to stop.
         max_attempts (int): The maximum number of attempts to make before giving up on generating a response.
         timeout (int): The maximum number of seconds to wait for a response from the API.
+        stream_handler: If given, the response is streamed, and its text is passed to this object as it arrives,
+          piece by piece, through its `feed(text)` method. Its `reset()` method is called before each attempt. 
+          Cached responses are fed all at once. In any case, the complete response is still returned at the end.
+        response_format (dict): If given, constrains the format of the response, e.g., to a JSON schema 
+          (see OpenAI's structured outputs). Requires a model that supports it.
 
         Returns:
         A dictionary representing the generated response.
         """
 
-        def aux_exponential_backoff():
+        def aux_exponential_backoff(minimum_waiting_time=None):
             nonlocal waiting_time
-            logger.info(f"Request failed. Waiting {waiting_time} seconds between requests...")
-            time.sleep(waiting_time)
+            wait = max(waiting_time, minimum_waiting_time or 0)
+            logger.info(f"Request failed. Waiting {wait} seconds between requests...")
+            time.sleep(wait)
 
             # exponential backoff
             waiting_time = waiting_time * exponential_backoff_factor
         
 
-        # setup the OpenAI configurations for this client.
-        self._setup_from_config()
+        # setup the OpenAI configurations for this client, if not done yet.
+        self._ensure_client()
         
-        # We need to adapt the parameters to the API type, so we create a dictionary with them first
-        chat_api_params = {
-            "messages": current_messages,
-            "temperature": temperature,
-            "max_tokens":max_tokens,
-            "top_p": top_p,
-            "frequency_penalty": frequency_penalty,
-            "presence_penalty": presence_penalty,
-            "stop": stop,
-            "timeout": timeout,
-            "stream": False,
-            "n": n,
-        }
-
+        chat_api_params = self._compose_chat_api_params(current_messages, temperature, max_tokens, top_p,
+                                                        frequency_penalty, presence_penalty, stop, timeout, n,
+                                                        response_format)
+        
+        # tokens to account for in the rate limiter: the prompt and the requested completion
+        request_tokens = self._count_request_tokens(current_messages, model, max_tokens)
 
         i = 0
+        immediate_retries = 0
         while i < max_attempts:
+            from_cache = False
             try:
                 i += 1
-
-                try:
-                    logger.debug(f"Sending messages to OpenAI API. Token count={self._count_tokens(current_messages, model)}.")
-                except NotImplementedError:
-                    logger.debug(f"Token count not implemented for model {model}.")
                     
                 start_time = time.monotonic()
                 logger.debug(f"Calling model with client class {self.__class__.__name__}.")
@@ -185,54 +737,221 @@ class OpenAIClient:
                 ###############################################################
                 # call the model, either from the cache or from the API
                 ###############################################################
-                cache_key = str((model, chat_api_params)) # need string to be hashable
-                if self.cache_api_calls and (cache_key in self.api_cache):
-                    response = self.api_cache[cache_key]
-                else:
-                    logger.info(f"Waiting {waiting_time} seconds before next API request (to avoid throttling)...")
-                    time.sleep(waiting_time)
-                    
-                    response = self._raw_model_call(model, chat_api_params)
-                    if self.cache_api_calls:
-                        self.api_cache[cache_key] = response
-                        self._save_cache()
+                cache_key = self._cache_key(model, chat_api_params)
+                response = self._get_cached_response(cache_key)
+                from_cache = response is not None
+                if stream_handler is not None:
+                    stream_handler.reset()
+
+                if response is None:
+                    # throttling is up to the rate limiter, we only wait longer if the call fails
+                    with self.rate_limiter.limit(request_tokens):
+                        # the raw call may adapt the parameters, so it gets its own copy
+                        if stream_handler is None:
+                            response = self._raw_model_call(model, chat_api_params.copy())
+                        else:
+                            response = self._raw_model_call_streaming(model, chat_api_params.copy(), stream_handler.feed)
+
+                    # streamed or not, the request is the same, and so is its cache entry
+                    self._cache_response(cache_key, response, model, chat_api_params)
+                
+                elif stream_handler is not None:
+                    stream_handler.feed(self._raw_model_response_extractor(response).get("content") or "")
                 
                 
                 logger.debug(f"Got response from API: {response}")
                 end_time = time.monotonic()
                 logger.debug(
-                    f"Got response in {end_time - start_time:.2f} seconds after {i + 1} attempts.")
+                    f"Got response in {end_time - start_time:.2f} seconds after {i} attempts.")
 
                 return utils.sanitize_dict(self._raw_model_response_extractor(response))
 
-            except InvalidRequestError as e:
-                logger.error(f"[{i}] Invalid request error, won't retry: {e}")
+            except Exception as e:
+                if self._is_retriable_error(i, e):
+                    # cached responses do not involve the provider, so there's nothing to wait for
+                    if not from_cache and self._requires_backoff(e):
+                        aux_exponential_backoff(self._retry_after(e))
+                    
+                    # other errors are retried right away, but only a few times
+                    elif immediate_retries < OpenAIClient.MAX_IMMEDIATE_RETRIES:
+                        immediate_retries += 1
+                    else:
+                        logger.error(f"Giving up after {i} attempts, since the error persists: {e}")
+                        return None
+                else:
+                    # there's no point in retrying if the request is invalid
+                    # so we return None right away
+                    return None
+
+        logger.error(f"Failed to get response after {max_attempts} attempts.")
+        return None
+
+    async def send_message_async(self,
+                                 current_messages,
+                                 model=default["model"],
+                                 temperature=default["temperature"],
+                                 max_tokens=default["max_tokens"],
+                                 top_p=default["top_p"],
+                                 frequency_penalty=default["frequency_penalty"],
+                                 presence_penalty=default["presence_penalty"],
+                                 stop=[],
+                                 timeout=default["timeout"],
+                                 max_attempts=default["max_attempts"],
+                                 waiting_time=default["waiting_time"],
+                                 exponential_backoff_factor=default["exponential_backoff_factor"],
+                                 n = 1,
+                                 echo=False,
+                                 response_format=None):
+        """
+        Asynchronous counterpart of `send_message`, with the same arguments, retries, backoff and caching.
+        All asynchronous calls of the same event loop share a single, long-lived, connection pool, which is closed
+        by `aclose` (or, for all clients, by `aclose_clients`).
+
+        Returns:
+        A dictionary representing the generated response.
+        """
+
+        async def aux_exponential_backoff(minimum_waiting_time=None):
+            nonlocal waiting_time
+            wait = max(waiting_time, minimum_waiting_time or 0)
+            logger.info(f"Request failed. Waiting {wait} seconds between requests...")
+            await asyncio.sleep(wait)
+
+            # exponential backoff
+            waiting_time = waiting_time * exponential_backoff_factor
+
+        chat_api_params = self._compose_chat_api_params(current_messages, temperature, max_tokens, top_p,
+                                                        frequency_penalty, presence_penalty, stop, timeout, n,
+                                                        response_format)
+        
+        request_tokens = self._count_request_tokens(current_messages, model, max_tokens)
+
+        i = 0
+        immediate_retries = 0
+        while i < max_attempts:
+            from_cache = False
+            try:
+                i += 1
+
+                start_time = time.monotonic()
+                logger.debug(f"Calling model asynchronously with client class {self.__class__.__name__}.")
+
+                cache_key = self._cache_key(model, chat_api_params)
+                response = self._get_cached_response(cache_key)
+                from_cache = response is not None
+                if response is None:
+                    async with self.rate_limiter.limit_async(request_tokens):
+                        response = await self._raw_model_call_async(model, chat_api_params.copy())
+
+                    self._cache_response(cache_key, response, model, chat_api_params)
+
+                logger.debug(f"Got response from API: {response}")
+                end_time = time.monotonic()
+                logger.debug(
+                    f"Got response in {end_time - start_time:.2f} seconds after {i} attempts.")
+
+                return utils.sanitize_dict(self._raw_model_response_extractor(response))
 
-                # there's no point in retrying if the request is invalid
-                # so we return None right away
-                return None
-            
-            except openai.BadRequestError as e:
-                logger.error(f"[{i}] Invalid request error, won't retry: {e}")
-                
-                # there's no point in retrying if the request is invalid
-                # so we return None right away
-                return None
-            
-            except openai.RateLimitError:
-                logger.warning(
-                    f"[{i}] Rate limit error, waiting a bit and trying again.")
-                aux_exponential_backoff()
-            
-            except NonTerminalError as e:
-                logger.error(f"[{i}] Non-terminal error: {e}")
-                aux_exponential_backoff()
-                
             except Exception as e:
-                logger.error(f"[{i}] Error: {e}")
+                if self._is_retriable_error(i, e):
+                    if not from_cache and self._requires_backoff(e):
+                        await aux_exponential_backoff(self._retry_after(e))
+                    elif immediate_retries < OpenAIClient.MAX_IMMEDIATE_RETRIES:
+                        immediate_retries += 1
+                    else:
+                        logger.error(f"Giving up after {i} attempts, since the error persists: {e}")
+                        return None
+                else:
+                    return None
 
         logger.error(f"Failed to get response after {max_attempts} attempts.")
         return None
+
+    def _compose_chat_api_params(self, current_messages, temperature, max_tokens, top_p, 
+                                 frequency_penalty, presence_penalty, stop, timeout, n, response_format=None) -> dict:
+        """
+        We need to adapt the parameters to the API type, so we create a dictionary with them first.
+        """
+        chat_api_params = {
+            "messages": current_messages,
+            "temperature": temperature,
+            "max_tokens":max_tokens,
+            "top_p": top_p,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty,
+            "stop": stop,
+            "timeout": timeout,
+            "stream": False,
+            "n": n,
+        }
+
+        # only added when needed, so that other requests (and their cache keys) remain as they were
+        if response_format is not None:
+            chat_api_params["response_format"] = response_format
+
+        return chat_api_params
+
+    def _count_request_tokens(self, messages, model, max_tokens) -> int:
+        """
+        Counts the tokens a request may consume, for rate limiting purposes: the prompt plus the maximum completion.
+        """
+        prompt_tokens = None
+        try:
+            prompt_tokens = self._count_tokens(messages, model)
+            logger.debug(f"Sending messages to OpenAI API. Token count={prompt_tokens}.")
+        except NotImplementedError:
+            logger.debug(f"Token count not implemented for model {model}.")
+        
+        return (prompt_tokens or 0) + (max_tokens or 0)
+
+    def _is_retriable_error(self, i, e) -> bool:
+        """
+        Logs the error raised in the i-th attempt to call the model, and tells whether it is worth trying again.
+        """
+        if isinstance(e, (InvalidRequestError, openai.BadRequestError)):
+            logger.error(f"[{i}] Invalid request error, won't retry: {e}")
+            return False
+        
+        elif isinstance(e, openai.RateLimitError):
+            logger.warning(
+                f"[{i}] Rate limit error, waiting a bit and trying again.")
+        
+        elif isinstance(e, NonTerminalError):
+            logger.error(f"[{i}] Non-terminal error: {e}")
+        
+        else:
+            logger.error(f"[{i}] Error: {e}")
+        
+        return True
+    
+    def _requires_backoff(self, e) -> bool:
+        """
+        Whether the given error requires waiting (with exponential backoff) before trying again, i.e., whether the 
+        provider pushed back: rate limits, overloaded servers (HTTP 429 or 503), or any response asking to retry later. 
+        Other retriable errors are retried right away, a few times at most (see MAX_IMMEDIATE_RETRIES).
+        """
+        if isinstance(e, openai.RateLimitError):
+            return True
+        
+        if isinstance(e, openai.APIStatusError) and e.status_code in [429, 503]:
+            return True
+        
+        return self._retry_after(e) is not None
+    
+    @staticmethod
+    def _retry_after(e) -> float:
+        """
+        Returns how many seconds the provider asked to wait before retrying (through the Retry-After header of its 
+        response to the failed request), or None if it did not say.
+        """
+        response = getattr(e, "response", None)
+        if not isinstance(response, httpx.Response):
+            return None
+        
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
     
     def _raw_model_call(self, model, chat_api_params):
         """
@@ -245,6 +964,71 @@ class OpenAIClient:
                     **chat_api_params
                 )
 
+    def _raw_model_call_streaming(self, model, chat_api_params, on_text):
+        """
+        Calls the model through `_raw_model_call`, asking for the response to be streamed, and passes each piece
+        of its text to `on_text` as it arrives. Returns the complete response, as a non-streamed call would.
+        Custom clients that do not support streaming can simply ignore the request, and their whole response is 
+        then passed to `on_text` at once.
+        """
+        chat_api_params["stream"] = True
+        response = self._raw_model_call(model, chat_api_params)
+
+        if not isinstance(response, Iterator):
+            on_text(self._raw_model_response_extractor(response).get("content") or "")
+            return response
+
+        return self._assemble_streamed_response(response, on_text)
+
+    def _assemble_streamed_response(self, chunks, on_text):
+        """
+        Consumes the given streamed response chunks, passing the text of the first choice to `on_text` as it arrives, 
+        and assembles them into a complete response.
+        """
+        role = "assistant"
+        finish_reason = None
+        texts = []
+        last_chunk = None
+        for chunk in chunks:
+            last_chunk = chunk
+            for choice in chunk.choices:
+                # only the first choice is kept, as in non-streamed responses
+                if choice.index != 0:
+                    continue
+
+                if choice.delta.role is not None:
+                    role = choice.delta.role
+                if choice.delta.content:
+                    texts.append(choice.delta.content)
+                    on_text(choice.delta.content)
+                if choice.finish_reason is not None:
+                    finish_reason = choice.finish_reason
+        
+        if last_chunk is None:
+            raise NonTerminalError("The streamed response was empty.")
+
+        message = ChatCompletionMessage.model_construct(role=role, content="".join(texts))
+        return ChatCompletion.model_construct(id=last_chunk.id, created=last_chunk.created, model=last_chunk.model,
+                                              object="chat.completion",
+                                              choices=[Choice.model_construct(index=0, finish_reason=finish_reason, message=message)])
+
+    async def _raw_model_call_async(self, model, chat_api_params):
+        """
+        Asynchronously calls the OpenAI API with the given parameters. Subclasses should
+        override this method to implement their own asynchronous API calls. Custom clients that only 
+        override the synchronous `_raw_model_call` get it executed in a worker thread instead.
+        """
+        if type(self)._raw_model_call is not OpenAIClient._raw_model_call and \
+           type(self)._raw_model_call_async is OpenAIClient._raw_model_call_async:
+            self._ensure_client()
+            return await asyncio.to_thread(self._raw_model_call, model, chat_api_params)
+
+        self._ensure_async_client()
+        chat_api_params["model"] = model
+        return await self.async_client.chat.completions.create(
+                    **chat_api_params
+                )
+
     def _raw_model_response_extractor(self, response):
         """
         Extracts the response from the API response. Subclasses should
@@ -252,6 +1036,61 @@ class OpenAIClient:
         """
         return response.choices[0].message.to_dict()
 
+    def _cache_key(self, model, chat_api_params) -> str:
+        """
+        Computes the key under which the response to the given call is cached. This is a digest of the canonical
+        form of the request, so keys are compact and do not depend on the order of the parameters.
+        """
+        return utils.canonical_hash((model, chat_api_params))
+    
+    def _human_readable_request(self, model, chat_api_params) -> str:
+        """
+        Returns a human-readable description of the given call, kept along the cached response if so configured.
+        """
+        return utils.canonical_json((model, chat_api_params))
+
+    def _get_cached_response(self, cache_key):
+        """
+        Returns the cached response for the given key, or None if caching is disabled or there's no such response.
+        """
+        if self.cache_api_calls:
+            return self.api_cache.get(cache_key, None)
+        else:
+            return None
+    
+    def _cache_response(self, cache_key, response, model, chat_api_params):
+        """
+        Caches the given response, if caching is enabled.
+        """
+        if self.cache_api_calls:
+            request = self._human_readable_request(model, chat_api_params) if default["cache_readable_requests"] else None
+
+            # only the new entry is written to disk
+            self.api_cache.put(cache_key, response, request=request)
+    
+    def _migrate_cache_keys(self, cache:ApiCache) -> int:
+        """
+        Re-keys the entries of the given cache that still use the legacy key format, i.e., the string 
+        representation of the (model, parameters) tuple. Entries whose legacy key cannot be parsed are left as they are.
+        """
+        def aux_new_key(legacy_key):
+            try:
+                model, chat_api_params = ast.literal_eval(legacy_key)
+            except (ValueError, SyntaxError, TypeError):
+                return None
+            
+            # the model used to be (sometimes) added to the parameters themselves, but is not part of them anymore
+            chat_api_params = dict(chat_api_params)
+            chat_api_params.pop("model", None)
+
+            return self._cache_key(model, chat_api_params)
+
+        changed = cache.rekey(aux_new_key, keep_old_key_as_request=default["cache_readable_requests"])
+        cache.set_metadata("key_format", CACHE_KEY_FORMAT)
+
+        logger.info(f"Migrated {changed} entries of API cache {cache.file_name} to the current key format.")
+        return changed
+
     def _count_tokens(self, messages: list, model: str):
         """
         Count the number of OpenAI tokens in a list of messages using tiktoken.
@@ -261,7 +1100,39 @@ class OpenAIClient:
         Args:
         messages (list): A list of dictionaries representing the conversation history.
         model (str): The name of the model to use for encoding the string.
+
+        Returns:
+        The number of tokens, or None if the tokens of the model cannot be counted.
+        """
+        scheme = self._token_counting_scheme(model)
+        if scheme is None:
+            return None
+        
+        encoding, tokens_per_message, tokens_per_name = scheme
+        try:
+            num_tokens = 0
+            for message in messages:
+                num_tokens += tokens_per_message
+                for key, value in message.items():
+                    num_tokens += len(encoding.encode(value))
+                    if key == "name":
+                        num_tokens += tokens_per_name
+            num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+            return num_tokens
+        
+        except Exception as e:
+            logger.error(f"Error counting tokens: {e}")
+            return None
+
+    def _token_counting_scheme(self, model: str) -> tuple:
+        """
+        Returns the tokenizer, the tokens per message and the tokens per name used to count the tokens of the given 
+        model, or None if they cannot be counted. These are only determined once per model (loading a tokenizer is 
+        expensive, and might even require downloading it), so any problem is reported only once as well.
         """
+        if model in OpenAIClient._token_counting_schemes:
+            return OpenAIClient._token_counting_schemes[model]
+
         try:
             try:
                 encoding = tiktoken.encoding_for_model(model)
@@ -276,51 +1147,47 @@ class OpenAIClient:
                 "gpt-4-0613",
                 "gpt-4-32k-0613",
                 }:
-                tokens_per_message = 3
-                tokens_per_name = 1
+                scheme = (encoding, 3, 1)
             elif model == "gpt-3.5-turbo-0301":
-                tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-                tokens_per_name = -1  # if there's a name, the role is omitted
+                # every message follows <|start|>{role/name}\n{content}<|end|>\n and, if there's a name, the role is omitted
+                scheme = (encoding, 4, -1)
             elif "gpt-3.5-turbo" in model:
                 logger.debug("Token count: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-                return self._count_tokens(messages, model="gpt-3.5-turbo-0613")
+                scheme = self._token_counting_scheme("gpt-3.5-turbo-0613")
             elif ("gpt-4" in model) or ("ppo" in model):
                 logger.debug("Token count: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-                return self._count_tokens(messages, model="gpt-4-0613")
+                scheme = self._token_counting_scheme("gpt-4-0613")
             else:
                 raise NotImplementedError(
                     f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
                 )
-            num_tokens = 0
-            for message in messages:
-                num_tokens += tokens_per_message
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-            num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-            return num_tokens
         
         except Exception as e:
-            logger.error(f"Error counting tokens: {e}")
-            return None
+            logger.warning(f"Cannot count the tokens of model {model}, so they will be estimated instead: {e}")
+            scheme = None
+        
+        OpenAIClient._token_counting_schemes[model] = scheme
+        return scheme
 
-    def _save_cache(self):
+    def _load_cache(self):
         """
-        Saves the API cache to disk. We use pickle to do that because some obj
-        are not JSON serializable.
+        Opens the API cache on disk. If the configured cache file is a legacy pickle file, the cache is kept in a 
+        SQLite file of the same name instead (e.g., "cache.pickle" becomes "cache.sqlite"). Legacy entries (from the
+        configured pickle file, or else from the pickle file of the same name) are imported into it the first time.
         """
-        # use pickle to save the cache
-        pickle.dump(self.api_cache, open(self.cache_file_name, "wb"))
+        store_file_name, legacy_file_name = _api_cache_file_names(self.cache_file_name)
 
-    
-    def _load_cache(self):
+        import_legacy = (legacy_file_name is not None) and os.path.exists(legacy_file_name) and not os.path.exists(store_file_name)
 
-        """
-        Loads the API cache from disk.
-        """
-        # unpickle
-        return pickle.load(open(self.cache_file_name, "rb")) if os.path.exists(self.cache_file_name) else {}
+        cache = ApiCache(store_file_name)
+        if import_legacy:
+            cache.import_pickle(legacy_file_name)
+        
+        # keys from older versions must be brought up to date, once
+        if cache.get_metadata("key_format") != CACHE_KEY_FORMAT:
+            self._migrate_cache_keys(cache)
+        
+        return cache
 
     def get_embedding(self, text, model=default["embedding_model"]):
         """
@@ -333,6 +1200,7 @@ class OpenAIClient:
         Returns:
         The embedding of the text.
         """
+        self._ensure_client()
         response = self._raw_embedding_model_call(text, model)
         return self._raw_embedding_model_response_extractor(response)
     
@@ -369,6 +1237,16 @@ class AzureClient(OpenAIClient):
                                   api_version = config["OpenAI"]["AZURE_API_VERSION"],
                                   api_key = os.getenv("AZURE_OPENAI_KEY"))
     
+    def _setup_async_from_config(self):
+        """
+        Sets up the asynchronous Azure OpenAI Service API configurations for this client,
+        including the API endpoint and key.
+        """
+        self.async_client = AsyncAzureOpenAI(azure_endpoint= os.getenv("AZURE_OPENAI_ENDPOINT"),
+                                             api_version = config["OpenAI"]["AZURE_API_VERSION"],
+                                             api_key = os.getenv("AZURE_OPENAI_KEY"),
+                                             http_client=self._async_http_client())
+    
     def _raw_model_call(self, model, chat_api_params):
         """
         Calls the Azue OpenAI Service API with the given parameters.
@@ -379,6 +1257,17 @@ class AzureClient(OpenAIClient):
                     **chat_api_params
                 )
 
+    async def _raw_model_call_async(self, model, chat_api_params):
+        """
+        Asynchronously calls the Azure OpenAI Service API with the given parameters.
+        """
+        self._ensure_async_client()
+        chat_api_params["model"] = model
+
+        return await self.async_client.chat.completions.create(
+                    **chat_api_params
+                )
+
 
 class InvalidRequestError(Exception):
     """
@@ -392,6 +1281,18 @@ class NonTerminalError(Exception):
     """
     pass
 
+def _api_cache_file_names(cache_file_name:str) -> tuple:
+    """
+    Returns the name of the SQLite file used to store the API cache, and the name of the legacy 
+    pickle file it replaces. If the configured file is not a pickle file, the legacy one is its pickle sibling, 
+    so that caches under the old default name (openai_api_cache.pickle) are still found under the new one.
+    """
+    base_name, extension = os.path.splitext(cache_file_name)
+    if extension in [".pickle", ".pkl"]:
+        return base_name + ".sqlite", cache_file_name
+    else:
+        return cache_file_name, base_name + ".pickle"
+
 ###########################################################################
 # Clients registry
 #
@@ -410,12 +1311,14 @@ _api_type_override = None
 
 def register_client(api_type, client):
     """
-    Registers a client for the given API type.
+    Registers a client for the given API type. Clients share the same rate limiter, so that 
+    the configured quotas hold regardless of which client is used.
 
     Args:
     api_type (str): The API type for which we want to register the client.
     client: The client to register.
     """
+    client.rate_limiter = _rate_limiter
     _api_type_to_client[api_type] = client
 
 def _get_client_for_api_type(api_type):
@@ -439,6 +1342,33 @@ def client():
     logger.debug(f"Using  API type {api_type}.")
     return _get_client_for_api_type(api_type)
 
+async def aclose_clients():
+    """
+    Closes the asynchronous connections of all registered clients. It must be awaited in the event loop that used
+    them, before that loop closes (e.g., at the end of the coroutine given to `asyncio.run`).
+    """
+    for client in _api_type_to_client.values():
+        await client.aclose()
+
+def count_message_tokens(message:dict, model:str=None) -> int:
+    """
+    Counts the tokens a single message takes in a prompt, using the tokenizer of the given model (by default, the configured one).
+    If the tokenizer is not available, a rough estimate is given instead, which is still good enough for budgeting purposes.
+
+    Args:
+    message (dict): The message, with role and content. Other fields (e.g., the `refusal` of replies) are ignored.
+    model (str): The name of the model whose tokenizer is to be used.
+    """
+    # only the text actually given to the model counts (e.g., replies without content have it set to None)
+    message = {key: message[key] for key in ["role", "content"] if isinstance(message.get(key), str)}
+    tokens = client()._count_tokens([message], model if model is not None else default["model"])
+
+    if tokens is None:
+        # roughly 4 characters per token, plus the overhead of the message itself
+        return len(message.get("content", "")) // 4 + 4
+    else:
+        # the count includes the priming of the reply, which happens only once per prompt
+        return tokens - 3
 
 # TODO simplify the custom configuration methods below
 
@@ -464,6 +1394,17 @@ def force_api_cache(cache_api_calls, cache_file_name=default["cache_file_name"])
     for client in _api_type_to_client.values():
         client.set_api_cache(cache_api_calls, cache_file_name)
 
+def force_rate_limits(requests_per_minute:int=None, tokens_per_minute:int=None, max_concurrent_requests:int=None):
+    """
+    Forces the use of the given rate limits on all clients, thus overriding any other configuration.
+
+    Args:
+    requests_per_minute (int): The maximum number of requests per minute, or None for no limit.
+    tokens_per_minute (int): The maximum number of tokens per minute, or None for no limit.
+    max_concurrent_requests (int): The maximum number of requests in flight at the same time, or None for no limit.
+    """
+    _rate_limiter.configure(requests_per_minute, tokens_per_minute, max_concurrent_requests)
+
 def force_default_value(key, value):
     """
     Forces the use of the given default configuration value for the specified key, thus overriding any other configuration.
@@ -8,7 +8,9 @@ import sys
 import hashlib
 import textwrap
 import logging
+import functools
 import chevron
+import chevron.tokenizer
 import copy
 from typing import Collection
 from datetime import datetime
@@ -39,17 +41,34 @@ def compose_initial_LLM_messages_with_templates(system_template_name:str, user_t
 
     messages.append({"role": "system", 
                          "content": chevron.render(
-                             open(system_prompt_template_path).read(), 
+                             parse_prompt_template(system_prompt_template_path), 
                              rendering_configs)})
     
     # optionally add a user message
     if user_template_name is not None:
         messages.append({"role": "user", 
                             "content": chevron.render(
-                                    open(user_prompt_template_path).read(), 
+                                    parse_prompt_template(user_prompt_template_path), 
                                     rendering_configs)})
     return messages
 
+@functools.lru_cache(maxsize=None)
+def read_prompt_file(path:str) -> str:
+    """
+    Reads the specified prompt file. Prompt files do not change during execution, so they are read 
+    from disk only once.
+    """
+    with open(path, "r") as f:
+        return f.read()
+
+@functools.lru_cache(maxsize=None)
+def parse_prompt_template(path:str) -> tuple:
+    """
+    Returns the specified Mustache template already parsed, so that it can be rendered repeatedly (via `chevron.render`)
+    without being read and tokenized again every time.
+    """
+    return tuple(chevron.tokenizer.tokenize(read_prompt_file(path)))
+
 
 ################################################################################	
 # Model output utilities
@@ -76,6 +95,70 @@ def extract_json(text: str) -> dict:
     except Exception:
         return {}
 
+def repair_json(text: str) -> dict:
+    """
+    Extracts a JSON object from a string as `extract_json` does, but also repairs common defects that would
+    otherwise make it unparseable: trailing commas, and objects left unterminated (e.g., because the output was
+    cut short). Returns an empty dictionary if the object cannot be repaired.
+    """
+    start = text.find("{")
+    if start < 0:
+        return {}
+
+    repaired = []
+    closers = []
+    in_string = False
+    escaped = False
+    for char in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+                # invalid escape sequences, which show up sometimes
+                if char == "'":
+                    repaired[-1] = char
+                    continue
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]":
+            _strip_trailing_comma(repaired)
+            closers.pop()
+
+        repaired.append(char)
+
+        # anything after the object is ignored
+        if not closers:
+            break
+
+    # close whatever was left open
+    if in_string:
+        if escaped:
+            repaired.pop()
+        repaired.append('"')
+    _strip_trailing_comma(repaired)
+    if repaired[-1] == ":":
+        repaired.append("null")
+    repaired.extend(reversed(closers))
+
+    try:
+        value = json.loads("".join(repaired))
+    except ValueError:
+        return {}
+
+    return value if isinstance(value, dict) else {}
+
+def _strip_trailing_comma(chars: list):
+    while chars and chars[-1].isspace():
+        chars.pop()
+    if chars and chars[-1] == ",":
+        chars.pop()
+
 def extract_code_block(text: str) -> str:
     """
     Extracts a code block from a string, ignoring any text before the first 
@@ -93,6 +176,119 @@ def extract_code_block(text: str) -> str:
     except Exception:
         return ""
 
+class JsonStreamParser:
+    """
+    Parses a JSON object whose text arrives in pieces (e.g., streamed from a model), calling `on_value(path, value)`
+    as soon as each value within it is complete, where `path` is the tuple of keys and indexes leading to the value
+    (the empty tuple for the whole object). As in `extract_json`, any text before the first opening curly brace is
+    ignored, and so is anything after the matching closing one. Values that are not valid JSON are just skipped.
+    If given, `on_reset()` is called whenever parsing starts over, e.g., because the stream is being retried.
+    """
+
+    def __init__(self, on_value=None, on_reset=None):
+        self.on_value = on_value
+        self.on_reset = on_reset
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything fed so far, to start parsing a new object.
+        """
+        if self.on_reset is not None:
+            self.on_reset()
+
+        self.result = None # the whole object, once complete
+        self.done = False
+
+        self._chars = []
+        self._containers = [] # the objects and arrays currently open, innermost last
+        self._token_start = None # where the string or scalar being read started
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text:str):
+        """
+        Parses the next piece of text.
+        """
+        for char in text:
+            if self.done:
+                return
+
+            # skip anything before the object
+            if not self._containers and char != "{":
+                continue
+
+            self._chars.append(char)
+            self._parse_char(char, len(self._chars) - 1)
+
+    def _parse_char(self, char, position):
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+                self._complete_token(position)
+            return
+
+        # scalars (numbers, booleans, null) end right before the next delimiter
+        if self._token_start is not None:
+            if char not in ",:}]" and not char.isspace():
+                return
+            self._complete_token(position - 1)
+
+        if char == '"':
+            self._in_string = True
+            self._token_start = position
+        elif char in "{[":
+            path = self._child_path() if self._containers else ()
+            self._containers.append({"start": position, "path": path, "is_array": char == "[",
+                                     "index": 0, "key": None, "expecting_key": char == "{"})
+        elif char in "}]":
+            container = self._containers.pop()
+            self._complete_value(container["path"], container["start"], position)
+            if not self._containers:
+                self.done = True
+        elif char == ",":
+            container = self._containers[-1]
+            if container["is_array"]:
+                container["index"] += 1
+            else:
+                container["expecting_key"] = True
+        elif char == ":":
+            self._containers[-1]["expecting_key"] = False
+        elif not char.isspace():
+            self._token_start = position
+
+    def _child_path(self) -> tuple:
+        container = self._containers[-1]
+        return container["path"] + (container["index"] if container["is_array"] else container["key"],)
+
+    def _complete_token(self, end):
+        start, self._token_start = self._token_start, None
+
+        container = self._containers[-1]
+        if container["expecting_key"]:
+            try:
+                container["key"] = json.loads("".join(self._chars[start:end + 1]))
+            except ValueError:
+                container["key"] = None
+        else:
+            self._complete_value(self._child_path(), start, end)
+
+    def _complete_value(self, path, start, end):
+        try:
+            value = json.loads("".join(self._chars[start:end + 1]))
+        except ValueError:
+            return
+
+        if path == ():
+            self.result = value
+
+        if self.on_value is not None:
+            self.on_value(path, value)
+
 ################################################################################
 # Model control utilities
 ################################################################################    
@@ -190,14 +386,12 @@ def add_rai_template_variables_if_enabled(template_variables: dict) -> dict:
     )
 
     # Harmful content
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_harmful_content_prevention.md"), "r") as f:
-        rai_harmful_content_prevention_content = f.read()
+    rai_harmful_content_prevention_content = read_prompt_file(os.path.join(os.path.dirname(__file__), "prompts/rai_harmful_content_prevention.md"))
 
     template_variables['rai_harmful_content_prevention'] = rai_harmful_content_prevention_content if rai_harmful_content_prevention else None
 
     # Copyright infringement
-    with open(os.path.join(os.path.dirname(__file__), "prompts/rai_copyright_infringement_prevention.md"), "r") as f:
-        rai_copyright_infringement_prevention_content = f.read()
+    rai_copyright_infringement_prevention_content = read_prompt_file(os.path.join(os.path.dirname(__file__), "prompts/rai_copyright_infringement_prevention.md"))
 
     template_variables['rai_copyright_infringement_prevention'] = rai_copyright_infringement_prevention_content if rai_copyright_infringement_prevention else None
 
@@ -490,11 +684,35 @@ def custom_hash(obj):
 
     return hashlib.sha256(str(obj).encode()).hexdigest()
 
+def canonical_json(obj) -> str:
+    """
+    Returns a canonical JSON representation of the specified object, which does not depend on
+    the order of dictionary keys or on formatting choices. Values that are not JSON serializable
+    are represented by their string form.
+    """
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+def canonical_hash(obj) -> str:
+    """
+    Returns a compact, deterministic, hash for the specified object, computed over its canonical JSON 
+    representation. Contrary to `custom_hash`, equal objects always get the same hash, regardless of
+    dictionary key order.
+    """
+    return hashlib.sha256(canonical_json(obj).encode()).hexdigest()
+
 _fresh_id_counter = 0
 def fresh_id():
     """
     Returns a fresh ID for a new object. This is useful for generating unique IDs for objects.
+    If there's a current simulation, the ID is unique within that simulation.
     """
+    # local import to avoid circular dependencies
+    from tinytroupe.control import current_simulation
+    
+    simulation = current_simulation()
+    if simulation is not None:
+        return simulation.fresh_id()
+
     global _fresh_id_counter
     _fresh_id_counter += 1
     return _fresh_id_counter